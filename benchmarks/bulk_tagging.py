@@ -0,0 +1,70 @@
+""" bulk_tagging.py
+Compares per-pair tagging against api.apply_tags_bulk.
+
+    python benchmarks/bulk_tagging.py [file_count] [tags_per_file]
+"""
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umptag import api, database  # noqa: E402
+
+
+def make_files(count):
+    """ Creates `count` empty files spread over a few directories. """
+    paths = []
+    for i in range(count):
+        directory = "d%03d" % (i % 100)
+        os.makedirs(directory, exist_ok=True)
+        name = "f%07d" % i
+        open(os.path.join(directory, name), 'w').close()
+        paths.append((directory, name))
+    return paths
+
+
+def pairs_for(paths, tags_per_file):
+    for i, (directory, name) in enumerate(paths):
+        for j in range(tags_per_file):
+            yield (directory, name, "k%d" % j, "v%d" % ((i + j) % 50))
+
+
+def per_pair(conn, pairs):
+    with conn:
+        for (d, n, k, v) in pairs:
+            api.apply_tag(conn, d, n, k, v)
+
+
+def bulk(conn, pairs):
+    api.apply_tags_bulk(conn, pairs)
+
+
+def timed(func, paths, tags_per_file, db_name):
+    conn = database.initialize_conn(db_name, new_db=True)
+    start = time.perf_counter()
+    func(conn, pairs_for(paths, tags_per_file))
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def main(file_count=5000, tags_per_file=3):
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            paths = make_files(file_count)
+            total = file_count * tags_per_file
+            for (label, func, db_name) in (("per-pair", per_pair, "pair.db"),
+                                           ("bulk", bulk, "bulk.db")):
+                elapsed = timed(func, paths, tags_per_file, db_name)
+                print("%-9s %8d pairs in %7.3fs (%10.0f pairs/s)"
+                      % (label, total, elapsed, total / elapsed))
+        finally:
+            os.chdir(start_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,58 @@
+""" import_time.py
+Times what `umptag tags FILE` imports, start to finish, with no daemon
+running, from `python -X importtime`, and fails if the best run is over
+budget. Only what the interpreter doesn't import anyway is counted.
+
+    python benchmarks/import_time.py [runs] [budget_us]
+"""
+import os
+import os.path
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from umptag import database, filetags  # noqa: E402
+
+MAIN = 'import sys; from umptag import cli; sys.exit(cli.main())'
+
+
+def import_times(code, *argv, cwd=None):
+    """ Returns {module: cumulative microseconds}, for the modules imported
+    at the top level; the rest are counted in theirs. """
+    env = dict(os.environ, PYTHONPATH=ROOT,
+               UMPTAG_SOCKET=os.path.join(cwd or ROOT, 'no-daemon.sock'))
+    proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code, *argv],
+            cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+            universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if not name[1:].startswith(' '):
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+def main(runs=3, budget=50000):
+    startup = set(import_times('pass'))
+    with tempfile.TemporaryDirectory() as directory:
+        open(os.path.join(directory, 'a'), 'w').close()
+        conn = database.initialize_conn(
+            os.path.join(directory, database.DEFAULT_DB_NAME), True)
+        filetags.tag_files_bulk(conn, [('', 'a', None, None, False, '', 'foo')])
+        conn.commit()
+        conn.close()
+        best = min(sum(t for (m, t) in times.items() if m not in startup)
+                   for times in (import_times(MAIN, 'tags', 'a', cwd=directory)
+                                 for _ in range(runs)))
+    print("best of %d: %d us (budget %d us)" % (runs, best, budget))
+    return 0 if best < budget else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:3])))
@@ -0,0 +1,82 @@
+""" junction_index.py
+Times filetags.files_of_tag on a legacy (version 0) database and again
+after database.migrate has upgraded it in place.
+
+    python benchmarks/junction_index.py [junction_rows]
+"""
+import os
+import os.path
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umptag import database, filetags  # noqa: E402
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE files (
+    id integer PRIMARY KEY, directory text NOT NULL, name text NOT NULL,
+    size integer, mod_time timestamp, is_dir boolean,
+    CONSTRAINT path UNIQUE (directory, name));
+CREATE TABLE tags (
+    id integer PRIMARY KEY, key text DEFAULT '' NOT NULL, value text NOT NULL,
+    CONSTRAINT tag_pk UNIQUE (key, value));
+CREATE TABLE filetag_junction (
+    file_id int, tag_id int,
+    CONSTRAINT file_tag_pk PRIMARY KEY (file_id, tag_id));"""
+
+TAGS_PER_FILE = 10
+TAG_COUNT = 1000
+LOOKUPS = 50
+
+
+def build_legacy(db_loc, rows):
+    conn = sqlite3.connect(db_loc)
+    conn.executescript(LEGACY_SCHEMA)
+    file_count = rows // TAGS_PER_FILE
+    conn.executemany("INSERT INTO files (id, directory, name) VALUES (?,?,?)",
+                     ((i, "d%d" % (i % 1000), "f%d" % i)
+                      for i in range(1, file_count + 1)))
+    conn.executemany("INSERT INTO tags (id, value) VALUES (?,?)",
+                     ((i, "t%d" % i) for i in range(1, TAG_COUNT + 1)))
+    rand = random.Random(0)
+    conn.executemany("INSERT OR IGNORE INTO filetag_junction VALUES (?,?)",
+                     ((f, t) for f in range(1, file_count + 1)
+                      for t in rand.sample(range(1, TAG_COUNT + 1),
+                                           TAGS_PER_FILE)))
+    conn.commit()
+    conn.close()
+
+
+def time_lookups(conn):
+    rand = random.Random(1)
+    values = ["t%d" % rand.randint(1, TAG_COUNT) for _ in range(LOOKUPS)]
+    start = time.perf_counter()
+    for value in values:
+        filetags.files_of_tag(conn, '', value)
+    return (time.perf_counter() - start) / LOOKUPS
+
+
+def main(rows=1000000):
+    with tempfile.TemporaryDirectory() as tmp:
+        db_loc = os.path.join(tmp, database.DEFAULT_DB_NAME)
+        build_legacy(db_loc, rows)
+        conn = sqlite3.connect(db_loc)
+        before = time_lookups(conn)
+        conn.close()
+        start = time.perf_counter()
+        conn = database.initialize_conn(db_loc, new_db=False)
+        migration = time.perf_counter() - start
+        after = time_lookups(conn)
+        conn.close()
+    print("junction rows:        %d" % rows)
+    print("files_of_tag before:  %8.2f ms" % (before * 1000))
+    print("migration:            %8.2f s" % migration)
+    print("files_of_tag after:   %8.2f ms" % (after * 1000))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:2]))
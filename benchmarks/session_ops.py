@@ -0,0 +1,72 @@
+""" session_ops.py
+Single tag operations through a Session versus opening a connection per
+action, the way `database.database_cognant` does.
+
+    python benchmarks/session_ops.py [session_ops] [per_connection_ops]
+"""
+import os
+import os.path
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umptag import api, database, session  # noqa: E402
+
+
+FILE_COUNT = 1000
+TAG_COUNT = 200
+
+
+def operations(count):
+    """ Mostly applies; every fourth operation removes the tag that was
+    just applied. """
+    for i in range(count):
+        j = i - 1 if i % 4 == 3 else i
+        name = "f%d" % (j % FILE_COUNT)
+        tag = "t%d" % ((j // FILE_COUNT) % TAG_COUNT)
+        yield ('remove' if i % 4 == 3 else 'apply', name, tag)
+
+
+def per_connection(count):
+    def do(conn, op, name, tag):
+        if op == 'apply':
+            api.apply_tag(conn, '', name, tag)
+        else:
+            api.remove_tag(conn, '', name, tag)
+    action = database.database_cognant(do)
+    for (op, name, tag) in operations(count):
+        action(op, name, tag)
+
+
+def with_session(count):
+    with session.Session(fail_if_uninitialized=True) as s:
+        for (op, name, tag) in operations(count):
+            if op == 'apply':
+                s.apply_tag('', name, tag)
+            else:
+                s.remove_tag('', name, tag)
+
+
+def main(session_ops=100000, per_connection_ops=2000):
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            for i in range(FILE_COUNT):
+                open("f%d" % i, 'w').close()
+            for (label, func, count) in (
+                    ("per-connection", per_connection, per_connection_ops),
+                    ("session", with_session, session_ops)):
+                database.initialize_conn(database.DEFAULT_DB_NAME, True).close()
+                start = time.perf_counter()
+                func(count)
+                elapsed = time.perf_counter() - start
+                print("%-15s %7d ops in %7.3fs (%8.1f us/op)"
+                      % (label, count, elapsed, elapsed / count * 1e6))
+        finally:
+            os.chdir(start_dir)
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:3]))
@@ -0,0 +1,216 @@
+""" suite.py
+Times the main operations against a synthetic library (see synthetic.py)
+and writes the results as JSON, to keep around and compare between
+releases.
+
+    python benchmarks/suite.py [--files N] [--tags N] [--output FILE]
+                               [--baseline FILE] [--no-disk]
+
+Per-operation timings are for single calls committed one at a time, the
+way the CLI makes them; `tag_bulk` and `untag_bulk` are one call over
+`--batch` pairs, `tag_bulk` going straight to the bulk insert so it needs
+no files. `scan` and `repair` need the files on disk and are
+skipped with --no-disk, which you'll want for the biggest libraries.
+With --baseline, each operation's median is also printed as a ratio to
+the one in an earlier results file.
+"""
+import argparse
+import json
+import os
+import os.path
+import platform
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umptag import api, database, filetags, fs, query, repair  # noqa: E402
+from umptag.tags import format_tag  # noqa: E402
+import synthetic  # noqa: E402
+
+
+def summarize(times):
+    times = sorted(times)
+    total = sum(times)
+    return {
+        'count': len(times),
+        'total_s': total,
+        'mean_s': total / len(times),
+        'median_s': statistics.median(times),
+        'p95_s': times[min(len(times) - 1, int(len(times) * 0.95))],
+        'ops_per_s': len(times) / total if total else None,
+    }
+
+
+def measure(func, calls):
+    """ Times func(*args) for each args in calls. """
+    times = []
+    for args in calls:
+        start = time.perf_counter()
+        func(*args)
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+
+def committed(func):
+    def run(conn, *args):
+        with conn:
+            return func(conn, *args)
+    return run
+
+
+def run_suite(conn, library, rand, repeat=200, batch=10000):
+    """ Returns {operation: summary}. The tagging ones change the library,
+    so they run after the lookups. """
+    tags = library.tags
+    n = len(tags)
+    common, middling, rare = tags[:max(1, n // 100)], tags[n // 100:n // 10], tags[n // 10:]
+
+    def pick(pool):
+        return rand.choice(pool or tags)
+
+    def a_file():
+        return library.path(rand.randrange(library.file_count))
+
+    def term(tag):
+        return format_tag(*tag)
+
+    results = {}
+    results['tags_of_file'] = measure(
+            filetags.tags_of_file, [(conn, *a_file()) for _ in range(repeat)])
+    for (label, pool) in (('common', common), ('middling', middling), ('rare', rare)):
+        results['files_of_tag_' + label] = measure(
+                filetags.files_of_tag, [(conn, *pick(pool)) for _ in range(repeat)])
+    queries = {
+        'and_common_rare': lambda: "%s and %s" % (term(pick(common)), term(pick(rare))),
+        'and_middling': lambda: "%s and %s" % (term(pick(middling)), term(pick(middling))),
+        'or': lambda: "%s or %s" % (term(pick(middling)), term(pick(rare))),
+        'and_not': lambda: "%s and not %s" % (term(pick(middling)), term(pick(common))),
+        'nested': lambda: "(%s or %s) and %s" % (term(pick(rare)), term(pick(rare)),
+                                                 term(pick(common))),
+    }
+    for (label, make) in queries.items():
+        results['query_' + label] = measure(
+                api.run_tag_query, [(conn, make()) for _ in range(repeat)])
+
+    new_tags = [('bench', "n%d" % i) for i in range(repeat)]
+    tagged = [(*a_file(), *tag) for tag in new_tags]
+    results['tag'] = measure(committed(api.apply_tag),
+                             [(conn, *pair) for pair in tagged])
+    results['untag'] = measure(committed(api.remove_tag),
+                               [(conn, *pair) for pair in tagged])
+    # The bulk path proper; api.apply_tags_bulk would stat every file first.
+    mod_time = datetime.fromtimestamp(synthetic.MOD_TIME)
+    bulk_rows = [(*library.path(i % library.file_count), 0, mod_time, False,
+                  'bench', 'bulk') for i in range(batch)]
+    results['tag_bulk'] = measure(committed(filetags.tag_files_bulk),
+                                  [(conn, bulk_rows)])
+    results['untag_bulk'] = measure(
+            api.remove_tags_bulk, [(conn, [(d, n, k, v) for (d, n, _, _, _, k, v)
+                                           in bulk_rows])])
+    # Merge pairs of middling tags, each tag at most once.
+    merges = rand.sample(middling or tags, min(len(middling or tags) // 2 * 2, 2 * repeat))
+    results['merge'] = measure(
+            api.merge_tag, [(conn, *merges[i], *merges[i + 1])
+                            for i in range(0, len(merges) - 1, 2)])
+    return results
+
+
+def run_disk_suite(conn, library, rand, moves=100):
+    """ Scanning and repair, against the files on disk under the current
+    directory. """
+    results = {}
+    scratch = database.initialize_conn(':memory:', new_db=True)
+    results['scan'] = measure(
+            lambda: fs.add_files(scratch, fs.collect_files()), [()])
+    scratch.close()
+    results['repair_full'] = measure(repair.repair, [(conn, os.curdir, True)])
+    for i in rand.sample(range(library.file_count), min(moves, library.file_count)):
+        directory, name = library.path(i)
+        os.rename(os.path.join(directory, name),
+                  os.path.join(directory, name + '.moved'))
+    results['repair'] = measure(repair.repair, [(conn,)])
+    return results
+
+
+def compare(results, baseline):
+    for (op, summary) in sorted(results.items()):
+        old = baseline.get('results', {}).get(op)
+        if old is None:
+            print("%-24s %10.6fs  (new)" % (op, summary['median_s']))
+        else:
+            print("%-24s %10.6fs  x%.2f" % (op, summary['median_s'],
+                                            summary['median_s'] / old['median_s']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Times umptag operations.")
+    parser.add_argument('--files', type=int, default=10000)
+    parser.add_argument('--tags', type=int, default=1000)
+    parser.add_argument('--tags-per-file', type=int, default=4)
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='the exponent of the tag popularity distribution')
+    parser.add_argument('--keyed', type=float, default=0.5,
+                        help='the fraction of tags that are keyed')
+    parser.add_argument('--repeat', type=int, default=200,
+                        help='calls per single operation')
+    parser.add_argument('--batch', type=int, default=10000,
+                        help='pairs per bulk operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-disk', dest='disk', action='store_false',
+                        help="don't make the files, and skip scan and repair")
+    parser.add_argument('--output', help='where to write the JSON; stdout by default')
+    parser.add_argument('--baseline', help='earlier results to compare against')
+    args = parser.parse_args(argv)
+
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            conn = database.initialize_conn(database.DEFAULT_DB_NAME, new_db=True)
+            start = time.perf_counter()
+            library = synthetic.generate(conn, args.files, args.tags,
+                                         args.tags_per_file, args.zipf,
+                                         args.keyed, args.seed, args.disk)
+            generated = time.perf_counter() - start
+            rand = random.Random(args.seed)
+            results = run_suite(conn, library, rand, args.repeat, args.batch)
+            if args.disk:
+                results.update(run_disk_suite(conn, library, rand))
+            conn.close()
+        finally:
+            os.chdir(start_dir)
+
+    out = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'schema_version': database.SCHEMA_VERSION,
+        'parameters': {
+            'files': args.files, 'tags': args.tags,
+            'tags_per_file': args.tags_per_file, 'zipf': args.zipf,
+            'keyed': args.keyed, 'repeat': args.repeat, 'batch': args.batch,
+            'seed': args.seed, 'disk': args.disk,
+        },
+        'library': {'edges': library.edges, 'generate_s': generated},
+        'results': results,
+    }
+    text = json.dumps(out, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+""" synthetic.py
+Generates synthetic tag libraries straight into a database, for the
+benchmarks. Nothing goes through the tagging code paths, so a library of
+millions of files takes as long as the inserts do.
+
+Tag popularity follows a Zipf distribution: the tag of rank r is picked
+with probability proportional to 1 / (r + 1) ** s, so a few tags are on
+most files and most tags are on a few. Some tags are keyed (`year=v12`),
+the rest unkeyed (`t40`). Everything is seeded, so the same arguments give
+the same library.
+
+    python benchmarks/synthetic.py out.db [file_count] [tag_count]
+"""
+import itertools
+import os
+import os.path
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from umptag import database, fs  # noqa: E402
+
+
+KEYS = ('year', 'place', 'person', 'camera', 'project', 'kind', 'rating', 'album')
+FILES_PER_DIR = 100
+DIRS_PER_TOP = 100
+# Every file's mod_time, as a timestamp; set on disk too when there is a disk.
+MOD_TIME = 1500000000
+
+
+class Zipf:
+    """ Draws ranks in range(n), rank r with weight 1 / (r + 1) ** s. """
+    def __init__(self, n, s, rand):
+        self.ranks = range(n)
+        self.cum_weights = list(itertools.accumulate(
+                1 / (r + 1) ** s for r in self.ranks))
+        self.rand = rand
+
+    def sample(self, k=1):
+        return self.rand.choices(self.ranks, cum_weights=self.cum_weights, k=k)
+
+
+class Library(namedtuple('Library', ['file_count', 'tags', 'edges', 'seed'])):
+    """ tags :: [(key, value)], most popular first.
+    edges :: the number of file-tag relations. """
+    __slots__ = ()
+
+    @staticmethod
+    def path(i):
+        """ (directory, name) of the i-th file: two levels of directories
+        with FILES_PER_DIR files each. """
+        d = i // FILES_PER_DIR
+        return (os.path.join("d%03d" % (d // DIRS_PER_TOP), "e%03d" % (d % DIRS_PER_TOP)),
+                "f%08d" % i)
+
+
+def make_tags(count, keyed_fraction, rand):
+    tags = []
+    for r in range(count):
+        if rand.random() < keyed_fraction:
+            tags.append((KEYS[r % len(KEYS)], "v%d" % r))
+        else:
+            tags.append(('', "t%d" % r))
+    return tags
+
+
+def generate(conn, file_count=10000, tag_count=1000, tags_per_file=4,
+             zipf_s=1.1, keyed_fraction=0.5, seed=0, on_disk=False,
+             chunk_size=50000):
+    """ Fills an empty database with a library and returns its Library.
+    With `on_disk`, the files are also made, empty, under the current
+    directory, so that scanning and repair have something to look at.
+    Each file gets between 1 and 2 * tags_per_file - 1 distinct tags. """
+    rand = random.Random(seed)
+    tags = make_tags(tag_count, keyed_fraction, rand)
+    zipf = Zipf(tag_count, zipf_s, rand)
+    mod_time = datetime.fromtimestamp(MOD_TIME)
+    edges = 0
+    with conn:
+        conn.executemany("INSERT INTO tags (id, key, value) VALUES (?,?,?)",
+                         ((r + 1, key, value) for (r, (key, value)) in enumerate(tags)))
+        dir_ids = {}
+        for start in range(0, file_count, chunk_size):
+            files, junction = [], []
+            for i in range(start, min(start + chunk_size, file_count)):
+                directory, name = Library.path(i)
+                if on_disk:
+                    if directory not in dir_ids:
+                        os.makedirs(directory, exist_ok=True)
+                    path = os.path.join(directory, name)
+                    open(path, 'w').close()
+                    os.utime(path, (MOD_TIME, MOD_TIME))
+                files.append((i + 1, fs.get_or_add_dir_id(conn, directory, dir_ids),
+                              name, 0, mod_time, False))
+                k = rand.randint(1, 2 * tags_per_file - 1)
+                junction.extend((i + 1, r + 1) for r in set(zipf.sample(k)))
+            conn.executemany("""INSERT INTO file_entries
+                    (id, dir_id, name, size, mod_time, is_dir)
+                    VALUES (?,?,?,?,?,?)""", files)
+            conn.executemany("""INSERT OR IGNORE INTO filetag_junction
+                    (file_id, tag_id) VALUES (?,?)""", junction)
+            edges += len(junction)
+    return Library(file_count, tags, edges, seed)
+
+
+def main(db_loc, file_count=10000, tag_count=1000):
+    conn = database.initialize_conn(db_loc, new_db=True)
+    start = time.perf_counter()
+    library = generate(conn, file_count, tag_count)
+    elapsed = time.perf_counter() - start
+    conn.close()
+    print("%d files, %d tags, %d relations in %.2fs."
+          % (library.file_count, len(library.tags), library.edges, elapsed))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], *(int(arg) for arg in sys.argv[2:4]))
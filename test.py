@@ -14,6 +14,18 @@ def suite():
     load(suite, 'umptag.tests.test_filetag')
     load(suite, 'umptag.tests.test_api')
     load(suite, 'umptag.tests.test_database')
+    load(suite, 'umptag.tests.test_query')
+    load(suite, 'umptag.tests.test_repair')
+    load(suite, 'umptag.tests.test_hashing')
+    load(suite, 'umptag.tests.test_session')
+    load(suite, 'umptag.tests.test_cli')
+    load(suite, 'umptag.tests.test_daemon')
+    load(suite, 'umptag.tests.test_aio')
+    load(suite, 'umptag.tests.test_stats')
+    load(suite, 'umptag.tests.test_transfer')
+    load(suite, 'umptag.tests.test_sidecar')
+    load(suite, 'umptag.tests.test_watch')
+    load(suite, 'umptag.tests.test_federated')
     return suite
 
 
@@ -0,0 +1,455 @@
+""" actions.py
+What the subcommands in cli.py actually do. Each handler takes the parsed
+arguments and returns an exit code.
+
+Paths given on the command line are relative to the current directory,
+but the database stores them relative to the directory it lives in, so
+every handler turns them into (directory, name) pairs against that root
+and does its file work from there.
+
+Handlers import what they need beyond looking things up themselves, so a
+quick `umptag tags FILE` doesn't load the rest of the package. """
+import contextlib
+import itertools
+import os
+import os.path
+import sys
+
+from . import filetags, fs
+from . import database as db
+from .tags import format_tag
+
+
+def _open():
+    """ Returns (conn, root), or (None, None) with a message if there's no
+    database above the current directory. """
+    db_loc = db.find_database_filepath(db.DEFAULT_DB_NAME)
+    if db_loc is None:
+        print("No database detected. Run `umptag init` first.", file=sys.stderr)
+        return None, None
+    return db.initialize_conn(db_loc, new_db=False), os.path.dirname(db_loc)
+
+
+@contextlib.contextmanager
+def _at_root(root):
+    start = os.getcwd()
+    os.chdir(root)
+    try:
+        yield
+    finally:
+        os.chdir(start)
+
+
+def _parse_tag(tag):
+    """ 'key=value' -> (key, value); 'tag' -> (tag, None), an unkeyed tag
+    in the style of `api.apply_tag`. """
+    key, eq, value = tag.partition('=')
+    return (key, value) if eq else (tag, None)
+
+
+def _read_paths(stream, null=False, chunk_size=64 * 1024):
+    """ Yields paths from a binary stream, one per line or NUL-delimited,
+    without reading all of it first. """
+    if not null:
+        for line in stream:
+            line = line.rstrip(b'\r\n')
+            if line:
+                yield os.fsdecode(line)
+        return
+    rest = b''
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        *paths, rest = (rest + chunk).split(b'\0')
+        yield from (os.fsdecode(p) for p in paths if p)
+    if rest:
+        yield os.fsdecode(rest)
+
+
+def _files_and_tags(args):
+    """ Sorts out `tag`/`untag` arguments into (paths, tags).
+    Without --tags, the positionals are FILE TAG... as before, or just
+    TAG... when the paths come from stdin. With --tags, every positional is
+    a file. Paths from stdin come after any positional files. """
+    if args.tags is not None:
+        paths, tags = args.args, args.tags.split()
+    elif args.stdin:
+        paths, tags = [], args.args
+    else:
+        paths, tags = args.args[:1], args.args[1:]
+    if args.stdin:
+        paths = itertools.chain(paths,
+                                _read_paths(sys.stdin.buffer, args.null))
+    return paths, [_parse_tag(tag) for tag in tags]
+
+
+def _pairs(paths, tags, start, root):
+    """ (directory, name, key, value) for every path and tag. Paths are
+    relative to `start`, which needn't be the current directory. """
+    for path in paths:
+        directory, name = fs.split_path(os.path.join(start, path), root)
+        for (key, value) in tags:
+            yield (directory, name, key, value)
+
+
+def _change_tags(args, bulk_func, verb, recursive_func=None):
+    paths, tags = _files_and_tags(args)
+    if not tags:
+        print("No tags given.", file=sys.stderr)
+        return 1
+    conn, root = _open()
+    if conn is None:
+        return 1
+    start = os.getcwd()
+    try:
+        with _at_root(root):
+            if args.recursive:
+                count = 0
+                for path in paths:
+                    directory = os.path.relpath(os.path.join(start, path), root)
+                    count += recursive_func(conn, directory, tags)
+            else:
+                # Stdin is read as we go, after we've moved to the root.
+                count = bulk_func(conn, _pairs(paths, tags, start, root))
+    except FileNotFoundError as e:
+        print("No such file: %s" % e.filename, file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    print("%s %d tag(s)." % (verb, count))
+    return 0
+
+
+def do_tag(args):
+    from . import api
+    return _change_tags(args, api.apply_tags_bulk, "Applied",
+                        api.apply_tags_recursive)
+
+
+def do_untag(args):
+    from . import api
+    return _change_tags(args, api.remove_tags_bulk, "Removed",
+                        api.remove_tags_recursive)
+
+
+def do_init(args):
+    if os.path.exists(db.DEFAULT_DB_NAME):
+        print("Already initialized.")
+        return 1
+    db.initialize_conn(db.DEFAULT_DB_NAME, new_db=True).close()
+    print("Initialized %s." % os.path.abspath(db.DEFAULT_DB_NAME))
+    return 0
+
+
+def do_add(args):
+    from . import api
+    conn, root = _open()
+    if conn is None:
+        return 1
+    paths = [fs.split_path(path, root) for path in args.files]
+    with _at_root(root), api.write_transaction(conn):
+        fs.add_files(conn, ((d, n, *fs._stat_file(os.path.join(d, n)))
+                            for (d, n) in paths))
+    conn.close()
+    return 0
+
+
+def do_rm(args):
+    """ Takes every tag off the files, which drops them from the database. """
+    from . import api
+    conn, root = _open()
+    if conn is None:
+        return 1
+    pairs = [(*fs.split_path(path, root), key, value)
+             for path in args.files
+             for (key, value) in filetags.tags_of_file(
+                     conn, *fs.split_path(path, root))]
+    api.remove_tags_bulk(conn, pairs)
+    conn.close()
+    return 0
+
+
+def do_merge(args):
+    from . import api
+    if args.tag is None or args.merged is None:
+        print("Need a tag and a tag to merge into it.", file=sys.stderr)
+        return 1
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    out = api.merge_tag(conn, *_parse_tag(args.tag), *_parse_tag(args.merged))
+    conn.close()
+    return out
+
+
+def do_show(args):
+    conn, root = _open()
+    if conn is None:
+        return 1
+    for (key, value) in filetags.iter_tags_of_file(
+            conn, *fs.split_path(args.file or os.curdir, root)):
+        print(format_tag(key, value))
+    conn.close()
+    return 0
+
+
+def do_files(args):
+    """ Lists the files matching a tag predicate, relative to here. """
+    from . import query
+    conn, root = _open()
+    if conn is None:
+        return 1
+    try:
+        for (directory, name) in query.run_query(conn, ' '.join(args.query)):
+            print(os.path.relpath(os.path.join(root, directory, name)))
+    except query.QuerySyntaxError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+def do_search(args):
+    """ Lists the matching files in every database under --root, relative
+    to here. """
+    from . import federated, query
+
+    def on_skip(path, reason):
+        print("Skipped %s: %s" % (path, reason), file=sys.stderr)
+
+    paths = federated.databases(args.root, max_age=args.max_age, refresh=args.refresh)
+    try:
+        bases = {}
+        for (db_loc, directory, name) in federated.run_query(
+                ' '.join(args.query), paths, on_skip=on_skip):
+            if db_loc not in bases:
+                bases[db_loc] = os.path.relpath(os.path.dirname(db_loc))
+            print(os.path.normpath(os.path.join(bases[db_loc], directory, name)))
+    except query.QuerySyntaxError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+def do_ls(args):
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    for (directory, name) in conn.execute(
+            "SELECT directory, name FROM files ORDER BY directory, name"):
+        print(os.path.join(directory, name))
+    conn.close()
+    return 0
+
+
+def do_info(args):
+    conn, root = _open()
+    if conn is None:
+        return 1
+    (file_count,), (tag_count,) = (
+            conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()
+            for table in ('files', 'tags'))
+    print("Database: %s" % os.path.join(root, db.DEFAULT_DB_NAME))
+    print("%d file(s), %d tag(s)." % (file_count, tag_count))
+    _print_stats(conn, 5)
+    conn.close()
+    return 0
+
+
+def _print_stats(conn, limit):
+    from . import stats
+    top = stats.top_tags(conn, limit)
+    if top:
+        print("Most used tags:")
+        for (key, value, count) in top:
+            print("  %6d  %s" % (count, format_tag(key, value)))
+    pairs = stats.top_pairs(conn, limit)
+    if pairs:
+        print("Most used together:")
+        for (key_a, value_a, key_b, value_b, count) in pairs:
+            print("  %6d  %s, %s" % (count, format_tag(key_a, value_a),
+                                     format_tag(key_b, value_b)))
+
+
+def do_stats(args):
+    """ With --refresh N, first recounts which of the N most used tags go
+    together. """
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    if args.refresh is not None:
+        from . import stats
+        with conn:
+            stats.refresh_cooccurrence(conn, args.refresh)
+    _print_stats(conn, args.limit)
+    conn.close()
+    return 0
+
+
+def do_clean(args):
+    from . import api
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    tags_deleted, files_deleted = api.sweep_orphans(conn)
+    conn.close()
+    print("Removed %d tag(s) and %d file(s)." % (tags_deleted, files_deleted))
+    return 0
+
+
+def do_repair(args):
+    from . import repair
+    conn, root = _open()
+    if conn is None:
+        return 1
+    target = os.path.relpath(os.path.abspath(args.root), root)
+    with _at_root(root):
+        report = repair.repair(conn, target, args.full)
+    conn.close()
+    _print_report(report)
+    return 0
+
+
+def _print_report(report):
+    for (old, new) in report.moved:
+        print("moved: %s -> %s" % (old, new))
+    for path in report.modified:
+        print("modified: %s" % path)
+    for path in report.missing:
+        print("missing: %s" % path)
+
+
+def do_watch(args):
+    from . import repair, watch
+    conn, root = _open()
+    if conn is None:
+        return 1
+    target = os.path.relpath(os.path.abspath(args.root), root)
+
+    def on_flush(report):
+        _print_report(report)
+        sys.stdout.flush()
+
+    try:
+        with _at_root(root):
+            if not args.poll:
+                try:
+                    watcher = watch.Watcher(conn, target, args.debounce)
+                    try:
+                        # Catch up on what happened while nobody was watching.
+                        on_flush(repair.repair(conn, target))
+                        watcher.run(on_flush=on_flush)
+                    finally:
+                        watcher.close()
+                except OSError as e:
+                    print("Can't watch for changes (%s); polling instead."
+                          % (e.strerror or e), file=sys.stderr)
+            watch.poll(conn, target, args.interval, on_flush=on_flush)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        conn.close()
+    return 0
+
+
+def do_export(args):
+    from . import transfer
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        tag_count, file_count = transfer.dump(conn, out, args.binary)
+    finally:
+        if args.output != '-':
+            out.close()
+        conn.close()
+    print("Exported %d tag(s) and %d file(s)." % (tag_count, file_count),
+          file=sys.stderr)
+    return 0
+
+
+def do_import(args):
+    from . import transfer
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    try:
+        file_count, added = transfer.load(conn, stream)
+    except transfer.DumpError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        if args.input != '-':
+            stream.close()
+        conn.close()
+    print("Imported %d file(s), %d new tagging(s)." % (file_count, added))
+    return 0
+
+
+def do_sync(args):
+    from . import sidecar
+    conn, root = _open()
+    if conn is None:
+        return 1
+    try:
+        with _at_root(root):
+            if args.import_:
+                added = sidecar.import_tags(conn)
+            else:
+                written = sidecar.sync(conn, args.mode, args.full)
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        conn.close()
+    if args.import_:
+        print("Imported %d new tagging(s)." % added)
+    else:
+        print("Synced %d file(s)." % written)
+    return 0
+
+
+def do_compact(args):
+    from . import api
+    conn, _ = _open()
+    if conn is None:
+        return 1
+    removed = api.compact_changes(conn, args.upto)
+    conn.close()
+    print("Removed %d journal entries." % removed)
+    return 0
+
+
+def do_serve(args):
+    from . import daemon
+    try:
+        server = daemon.Server(args.socket)
+    except daemon.DaemonError as e:
+        print(e, file=sys.stderr)
+        return 1
+    import signal
+    signal.signal(signal.SIGTERM, lambda *_: server.stop())
+    print("Listening on %s." % server.path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+def do_hash(args):
+    from . import hashing
+    conn, root = _open()
+    if conn is None:
+        return 1
+    with _at_root(root):
+        count = hashing.fill_hashes(conn, args.force, args.workers)
+    conn.close()
+    print("Hashed %d file(s)." % count)
+    return 0
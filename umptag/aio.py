@@ -0,0 +1,206 @@
+""" aio.py
+The api module as coroutines, for use inside an asyncio event loop.
+
+SQLite calls and the `os.stat` done when a file is first tagged both
+block, so nothing runs on the loop itself:
+
+- Writes go to a single writer thread with its own connection. Whatever
+  writes are waiting when it comes round are run together in one
+  transaction (group commit), each under its own savepoint so one failing
+  doesn't take the others down with it. A write's coroutine returns once
+  its transaction has committed.
+- Reads run on a small pool of threads, each with its own connection.
+  WAL (see `database.PRAGMAS`) lets them carry on while the writer writes.
+
+At most `max_pending` operations can be in flight at once; past that,
+callers wait their turn instead of piling up work.
+
+    async with aio.Umptag() as ump:
+        await ump.apply_tag('photos', 'beach.jpg', 'year', '2018')
+        await ump.query('year=2018 and not blurry')
+"""
+import asyncio
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from . import api, database, filetags
+
+
+def _settle(future, ok, value):
+    if future.cancelled():
+        return
+    if ok:
+        future.set_result(value)
+    else:
+        future.set_exception(value)
+
+
+class Umptag:
+    """ Opens (or makes) the database the way `database.get_conn` would.
+    readers :: threads, and so connections, for reads.
+    max_pending :: how many operations may be in flight at once.
+    max_batch :: the most writes to commit together. """
+    def __init__(self, db_name=database.DEFAULT_DB_NAME, readers=4,
+                 max_pending=1024, max_batch=512, pragmas=None):
+        conn = database.get_conn(db_name, pragmas=pragmas)
+        self.db_loc = conn.execute("PRAGMA database_list").fetchone()[2]
+        conn.close()
+        self.pragmas = pragmas
+        self.max_pending = max_pending
+        self.max_batch = max_batch
+        self._semaphore = None  # Made on first use, on the running loop.
+        self.pending = 0  # Operations in flight.
+        self._writes = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop,
+                                        name='umptag-writer', daemon=True)
+        self._writer.start()
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(readers)
+        self._reader_conns = []
+        self._reader_lock = threading.Lock()
+        self._closed = False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    # Threads.
+    def _connect(self):
+        # Reader connections are closed from whichever thread calls close().
+        return database.initialize_conn(self.db_loc, new_db=False,
+                                        pragmas=self.pragmas,
+                                        check_same_thread=False)
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            stopping = False
+            while not stopping:
+                batch = [self._writes.get()]
+                while len(batch) < self.max_batch:
+                    try:
+                        batch.append(self._writes.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:  # Sent by close(), after the last write.
+                    batch.remove(None)
+                    stopping = True
+                if batch:
+                    self._run_batch(conn, batch)
+        finally:
+            conn.close()
+        # Anything that slipped in while close() was going on.
+        while True:
+            try:
+                job = self._writes.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None:
+                (_, _, future, loop) = job
+                loop.call_soon_threadsafe(_settle, future, False,
+                                          RuntimeError("This Umptag has been closed."))
+
+    def _run_batch(self, conn, batch):
+        """ Runs every job in one transaction and then settles their futures.
+        A job that raises is rolled back to its savepoint; if the
+        transaction itself fails, every job gets the error. """
+        results = []
+        try:
+            api._begin_immediate(conn)
+            for (func, args, _, _) in batch:
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((True, func(conn, *args)))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    results.append((False, e))
+                conn.execute("RELEASE job")
+            conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            results = [(False, e)] * len(batch)
+        for ((_, _, future, loop), (ok, value)) in zip(batch, results):
+            loop.call_soon_threadsafe(_settle, future, ok, value)
+
+    def _reader_conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            with self._reader_lock:
+                self._reader_conns.append(conn)
+        return conn
+
+    def _read_job(self, func, args):
+        return func(self._reader_conn(), *args)
+
+    # Submitting work.
+    async def _limited(self, make_future):
+        if self._closed:
+            raise RuntimeError("This Umptag has been closed.")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_pending)
+        async with self._semaphore:
+            self.pending += 1
+            try:
+                return await make_future()
+            finally:
+                self.pending -= 1
+
+    def _write(self, func, *args):
+        def submit():
+            loop = asyncio.get_running_loop()
+            future = loop.create_future()
+            self._writes.put((func, args, future, loop))
+            return future
+        return self._limited(submit)
+
+    def _read(self, func, *args):
+        def submit():
+            return asyncio.get_running_loop().run_in_executor(
+                    self._readers, self._read_job, func, args)
+        return self._limited(submit)
+
+    # Writes.
+    async def apply_tag(self, directory, name, key='', value=None):
+        return await self._write(api.apply_tag, directory, name, key, value)
+
+    async def apply_tags_bulk(self, pairs):
+        """ Takes a list rather than any iterable, since it's used on
+        another thread. """
+        return await self._write(api.apply_tags_bulk, list(pairs))
+
+    async def remove_tag(self, directory, name, key='', value=None):
+        return await self._write(api.remove_tag, directory, name, key, value)
+
+    async def merge_tag(self, primary_key='', primary_value=None,
+                        secondary_key='', secondary_value=None):
+        return await self._write(api.merge_tag, primary_key, primary_value,
+                                 secondary_key, secondary_value)
+
+    # Reads.
+    async def query(self, query_str, cols=('directory', 'name')):
+        return await self._read(api.run_tag_query, query_str, cols)
+
+    async def tags_of_file(self, directory, name):
+        return await self._read(filetags.tags_of_file, directory, name)
+
+    async def files_of_tag(self, key='', value=None):
+        if value is None and key != '':
+            key, value = '', key
+        return await self._read(filetags.files_of_tag, key, value)
+
+    async def close(self):
+        """ Waits for writes already submitted, then shuts everything down. """
+        if self._closed:
+            return
+        self._closed = True
+        loop = asyncio.get_running_loop()
+        self._writes.put(None)
+        await loop.run_in_executor(None, self._writer.join)
+        await loop.run_in_executor(None, self._readers.shutdown)
+        for conn in self._reader_conns:
+            conn.close()
@@ -1,15 +1,73 @@
 import sqlite3
+import contextlib
+import errno
 import functools
+import itertools
 import os.path
 import sys
-from typing import List
-from . import tags, fs, filetags
+import time
+from . import tags, fs, filetags, query
 from . import database as db
 
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import List
+
 
 DEFAULT_DB_NAME = db.DEFAULT_DB_NAME
 
 
+def retry_on_locked(attempts=5, delay=0.05, backoff=2.0):
+    """ Retries the decorated function when SQLite reports the database as
+    locked or busy, waiting `delay` seconds and then `backoff` times longer
+    after each failure. busy_timeout already covers most waiting; this is
+    for the cases SQLite gives up on straight away, like two readers trying
+    to become writers at the same time.
+    Only for functions that run their own transaction, since the failed one
+    is rolled back, and whose arguments can be used twice. """
+    def decorator(func):
+        @functools.wraps(func)
+        def out_func(conn, *args, **kwargs):
+            wait = delay
+            for attempt in range(attempts):
+                try:
+                    return func(conn, *args, **kwargs)
+                except sqlite3.OperationalError as e:
+                    message = str(e)
+                    if ('locked' not in message and 'busy' not in message
+                            or attempt == attempts - 1):
+                        raise
+                    conn.rollback()
+                    time.sleep(wait)
+                    wait *= backoff
+        return out_func
+    return decorator
+
+
+@retry_on_locked()
+def _begin_immediate(conn):
+    conn.execute("BEGIN IMMEDIATE")
+
+
+@contextlib.contextmanager
+def write_transaction(conn):
+    """ Like `with conn:`, except that the write lock is taken up front, with
+    retries, so the transaction can't fail halfway on a lock. Joins the
+    connection's open transaction if there is one, in which case whoever
+    opened it commits or rolls it back. """
+    if conn.in_transaction:
+        yield conn
+        return
+    _begin_immediate(conn)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
 class TagQuery:
     def __init__(self, conn=None, key='', value=None):
         if value is None and key != '':
@@ -48,11 +106,113 @@ def apply_tag(conn, directory, name, key='', value=None):
     return filetags.tag_file(conn, directory, name, key, value)
 
 
-def remove_tag(conn, directory, name, key='', value=None):
-    """ Removes the tag or key=value tag from the given target. """
+def apply_tags_bulk(conn, pairs, chunk_size=10000):
+    """ Applies many tags at once inside a single transaction.
+    pairs :: iterable of (directory, name, key, value); as with `apply_tag`,
+    a value of None means `key` is an unkeyed tag.
+    Returns the number of new file-tag relations. """
+    pairs = iter(pairs)
+    added = 0
+    with write_transaction(conn):
+        while True:
+            chunk = list(itertools.islice(pairs, chunk_size))
+            if not chunk:
+                break
+            stats = {}
+            rows = []
+            for (directory, name, key, value) in chunk:
+                if value is None:
+                    key, value = '', key
+                if (directory, name) not in stats:
+                    stats[(directory, name)] = fs._stat_file(
+                            os.path.join(directory, name))
+                rows.append((directory, name,
+                             *stats[(directory, name)], key, value))
+            added += filetags.tag_files_bulk(conn, rows)
+    return added
+
+
+def _subtree(prefix):
+    """ A directory the way it's stored: normalized, '' for the root. """
+    directory = os.path.normpath(prefix)
+    return '' if directory == os.curdir else directory
+
+
+def apply_tags_recursive(conn, prefix, tags, include=None, exclude=None,
+                         chunk_size=10000):
+    """ Applies the tags to everything below the directory `prefix`, itself
+    excluded, in a single transaction. The tree is listed with
+    `fs.collect_files`, whose records carry their stats, and tagged through
+    the bulk path a chunk at a time.
+    tags :: iterable of (key, value), a None value as in `apply_tag`.
+    include, exclude :: as in `fs.collect_files`; the database's own files
+                        are always skipped.
+    Returns the number of new file-tag relations.
+    Raises FileNotFoundError if `prefix` isn't a directory. """
+    if not os.path.isdir(prefix or os.curdir):
+        raise FileNotFoundError(errno.ENOENT, "No such directory", prefix)
+    tags = [('', key) if value is None else (key, value) for (key, value) in tags]
+    exclude = [exclude] if isinstance(exclude, str) else list(exclude or ())
+    exclude.append(db.DEFAULT_DB_NAME + '*')
+    records = fs.collect_files(prefix, include, exclude)
+    added = 0
+    with write_transaction(conn):
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+            added += filetags.tag_files_bulk(
+                    conn, [(*record, key, value) for record in chunk
+                           for (key, value) in tags])
+    return added
+
+
+def remove_tags_recursive(conn, prefix, tags, chunk_size=10000):
+    """ Removes the tags from every file in the database below `prefix`, in
+    a single transaction. Returns the number of relations removed. """
+    paths = fs.files_under(conn, _subtree(prefix)).fetchall()
+    return remove_tags_bulk(conn, ((d, n, key, value) for (d, n) in paths
+                                   for (key, value) in tags), chunk_size)
+
+
+def files_under(conn, prefix, query_str=None, cols=('directory', 'name')):
+    """ Returns the files in the directory `prefix` (relative to the
+    database's root, like every stored path) and below it; only the ones
+    matching the tag predicate if one is given. """
+    ids = None if query_str is None else query.compile_ids(conn, query_str)
+    return fs.files_under(conn, _subtree(prefix), cols, ids).fetchall()
+
+
+def remove_tag(conn, directory, name, key='', value=None, clean=True):
+    """ Removes the tag or key=value tag from the given target.
+    Pass clean=False to leave orphaned tags and files for `sweep_orphans`. """
     if value is None and key != '':
         key, value = '', key
-    return filetags.untag_file(conn, directory, name, key, value)
+    return filetags.untag_file(conn, directory, name, key, value, clean)
+
+
+def remove_tags_bulk(conn, pairs, chunk_size=10000):
+    """ Removes many (directory, name, key, value) tags in a single
+    transaction, then sweeps up orphans once at the end.
+    Returns the number of file-tag relations removed. """
+    pairs = iter(pairs)
+    removed = 0
+    with write_transaction(conn):
+        while True:
+            chunk = [(d, n, *(('', k) if v is None else (k, v)))
+                     for (d, n, k, v) in itertools.islice(pairs, chunk_size)]
+            if not chunk:
+                break
+            removed += filetags.untag_files_bulk(conn, chunk)
+        filetags.sweep_orphans(conn)
+    return removed
+
+
+def sweep_orphans(conn):
+    """ Deletes tags without files and files without tags.
+    Returns (tags_deleted, files_deleted). """
+    with write_transaction(conn):
+        return filetags.sweep_orphans(conn)
 
 
 def remove_tags(conn, directory, name, *args, **kwargs):
@@ -75,48 +235,81 @@ def merge_tag(conn, primary_key='', primary_value=None,
         primary_key, primary_value = '', primary_key
     if secondary_value is None and secondary_key != '':
         secondary_key, secondary_value = '', secondary_key
-    for (d, n) in TagQuery(conn, secondary_key, secondary_value).files:
-    # for (d, n) in filetags.files_of_tag(conn, secondary_key, secondary_value):
-        filetags.tag_file(conn, d, n, primary_key, primary_value)
-        remove_tag(conn, d, n, secondary_key, secondary_value)
+    return merge_tags(conn, (primary_key, primary_value),
+                      [(secondary_key, secondary_value)])
+
+
+def merge_tags(conn, destination, sources):
+    """ Merges many (key, value) tags into the destination (key, value) in
+    one transaction. Returns 1 if there was nothing to merge. """
+    with write_transaction(conn):
+        merged = filetags.merge_tags(conn, destination, sources)
+    return 0 if merged else 1
 
 
-def show_tags(conn, directory, name) -> List[str]:
+def show_tags(conn, directory, name) -> 'List[str]':
     """ Lists the tags applied to file. """
     raise NotImplementedError
 
 
-def show_files(conn, *args, **kwargs) -> List[str]:
+def show_files(conn, *args, **kwargs) -> 'List[str]':
     """ Lists the targets with all of the applied tags. """
     raise NotImplementedError
 
 
-# God, this is just... not good, right?
 def parse_tag_query(query_str):
     """ Given a string that has logical predicates, returns something to query.
-    Supports `and`, `or`, parentheses, and negation. """
-    """ Not doing parens or OR for now, though. """
-    # So, we want to use AND, OR, and NOT sql predicates.
-    # To do this, we need to generate conditions from the given tags.
-    # SELECT foo, bar FROM files WHERE <map string to a chain of conditions>
-    reg_str = "[& |]?(^[& |]+)[& |]?"
-    # queries = re.findall(reg_str, query_str)
-    queries = query_str.split()
-    for index, query in enumerate(queries):
-        if '=' in query:
-            try:
-                k, v = query.split()
-            except ValueError:  # Empty value -> Without that key.
-                k, v = query.strip('='), None
-            queries[index] = (k, v)
-        else:
-            queries[index] = ('', query)
-    conditions = []
-    for (k, v) in queries:
-        if v is not None and v[0] == '-':
-            conditions.append(("(key=? AND NOT value=?)", (k, v)))
-        else:
-            conditions.append(("(key=? AND value=?)", (k, v)))
+    Supports `and`, `or`, parentheses, and negation.
+    Returns (sql, params); see `query.compile_query`. """
+    return query.compile_query(query_str)
 
-def run_tag_query(query_tuple):
-    raise NotImplementedError
+
+def run_tag_query(conn, query_str, cols=('directory', 'name')):
+    """ Returns the files matching the tag predicate. """
+    return query.run_query(conn, query_str, cols).fetchall()
+
+
+def changes_since(conn, seq=0, until=None, batch_size=1000):
+    """ Yields the journal's entries after `seq`, up to and including
+    `until` if given, oldest first, a batch at a time:
+        (seq, kind, op, file_id, tag_id, path)
+    kind :: 'file', 'tag' or 'filetag'; op :: 'insert', 'update' or 'delete'.
+    path :: where the file was before an update or delete, else None.
+    Entries at or below what `compact_changes` last removed are gone. """
+    cursor = conn.execute("""SELECT seq, kind, op, file_id, tag_id, path
+            FROM changes WHERE seq > ? AND seq <= COALESCE(?, seq)
+            ORDER BY seq""", (seq, until))
+    return filetags._stream(cursor, batch_size)
+
+
+def latest_change(conn):
+    """ The seq of the newest journal entry; 0 if there's never been one. """
+    row = conn.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+    return 0 if row is None else row[0]
+
+
+def consumed(conn, consumer):
+    """ How far `consumer` has got through the journal; None if it's new. """
+    row = conn.execute("SELECT seq FROM sync_state WHERE consumer = ?",
+                       (consumer,)).fetchone()
+    return None if row is None else row[0]
+
+
+def mark_consumed(conn, consumer, seq):
+    """ Records that `consumer` has dealt with every entry up to `seq`. """
+    with write_transaction(conn):
+        conn.execute("INSERT OR REPLACE INTO sync_state (consumer, seq) VALUES (?,?)",
+                     (consumer, seq))
+
+
+def compact_changes(conn, seq=None):
+    """ Deletes the journal's entries up to and including `seq`, or by
+    default those every consumer in sync_state has seen (none, if there
+    are no consumers). Returns the number deleted. """
+    with write_transaction(conn):
+        if seq is None:
+            seq = conn.execute("SELECT MIN(seq) FROM sync_state").fetchone()[0]
+            if seq is None:
+                return 0
+        return conn.execute("DELETE FROM changes WHERE seq <= ?", (seq,)).rowcount
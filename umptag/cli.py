@@ -1,15 +1,6 @@
 import argparse
-from umptag.actions import (do_init,
-                            do_add,
-                            do_rm,
-                            do_tag,
-                            do_untag,
-                            do_merge,
-                            do_info,
-                            do_ls,
-                            do_show,
-                            do_clean
-                            )
+import importlib
+import sys
 
 
 """
@@ -21,7 +12,8 @@ from umptag.actions import (do_init,
 
     tmsu tag filename tag tag key=value
          tag --tags "tag tag tag" filename filename filename
-      Prints when a new tag is created.
+         find . -print0 | umptag tag --stdin -0 --tags "tag tag"
+      All in one transaction.
 
     tmsu merge tag_to_merge destination_tag
 
@@ -37,61 +29,181 @@ from umptag.actions import (do_init,
         Include "and", "or", parentheses, negation
 
 """
-parser = argparse.ArgumentParser(prog="umptag", description="Manages tagged files.")
-parser.set_defaults(func=lambda _: parser.print_help())
-subparsers = parser.add_subparsers(help='subparsers help', dest='command')
-
-init = subparsers.add_parser('init', help='initializes the folder as tag-aware')
-init.set_defaults(func=do_init)
+# Each subcommand's arguments. argparse spends longer adding arguments
+# than the rest of startup takes, so `build_parser` only adds the ones of
+# the command being run.
 
 """
 # Manipulate files.
-add = subparsers.add_parser('add', help='adds files to the database')
-add.add_argument('files', metavar='files', nargs='*')
-add.set_defaults(func=do_add)
+def add_add_arguments(add):
+    add.add_argument('files', metavar='files', nargs='*')
 
-rm = subparsers.add_parser('rm', help='removes files from the database')
-rm.add_argument('files', metavar='files', nargs='*')
-rm.set_defaults(func=do_rm)
+def add_rm_arguments(rm):
+    rm.add_argument('files', metavar='files', nargs='*')
 """
 
 # Manipulate tags.
-tag_ = subparsers.add_parser('tag', help='tag a file')
-tag_.add_argument('file', metavar='filepath', nargs='?')
-tag_.add_argument('tags', metavar='tag (tag...)', nargs='*')
-tag_.set_defaults(func=do_tag)
-
-untag_ = subparsers.add_parser('untag', help='tag a file')
-untag_.add_argument('file', metavar='filepath', nargs='?')
-untag_.add_argument('tags', metavar='tag', nargs='*')
-untag_.set_defaults(func=do_untag)
-
-merge_tag = subparsers.add_parser('merge', help='merge a tag with another tag')
-merge_tag.add_argument('tag', metavar='tag', nargs='?')
-merge_tag.add_argument('merged', metavar='tag_to_merge', nargs='?')
-merge_tag.set_defaults(func=do_merge)
+def add_tagging_arguments(subparser):
+    subparser.add_argument('args', metavar='file tag', nargs='*',
+                           help='a file then its tags, or just files with --tags')
+    subparser.add_argument('--tags', metavar='"tag tag key=value"',
+                           help='the tags to use; every argument is then a file')
+    subparser.add_argument('--stdin', '--from-stdin', dest='stdin',
+                           action='store_true',
+                           help='also read file paths from stdin, one per line')
+    subparser.add_argument('-0', '--null', action='store_true',
+                           help='paths on stdin are NUL-delimited, as from find -print0')
+    subparser.add_argument('-r', '--recursive', action='store_true',
+                           help='the files are directories; use everything under them')
+
+def add_merge_arguments(merge_tag):
+    merge_tag.add_argument('tag', metavar='tag', nargs='?')
+    merge_tag.add_argument('merged', metavar='tag_to_merge', nargs='?')
 
 # Display information.
-show = subparsers.add_parser('tags', help='displays tag information about a file')
-show.add_argument('file', metavar='file', nargs='?')
-show.set_defaults(func=do_show)
-
-info = subparsers.add_parser('info', help='prints off information about the database')
-info.set_defaults(func=do_info)
-
-ls = subparsers.add_parser('ls', help='lists all tagged files')
-ls.set_defaults(func=do_ls)
-
-"""
-show = subparsers.add_parser('show', help='')
-show.set_defaults(func=do_show)
-"""
+def add_show_arguments(show):
+    show.add_argument('file', metavar='file', nargs='?')
+
+def add_files_arguments(files):
+    files.add_argument('query', metavar='predicate', nargs='+',
+                       help='e.g. (vacation or trip) and year=2018 and not blurry')
+
+def add_search_arguments(search):
+    search.add_argument('query', nargs='+',
+                        help='e.g. (vacation or trip) and year=2018 and not blurry')
+    search.add_argument('--root', default='.', help='where to look for databases')
+    search.add_argument('--refresh', action='store_true',
+                        help='look for databases again rather than using the catalogue')
+    search.add_argument('--max-age', type=float, default=3600.0,
+                        help='seconds before the catalogue is looked over again')
+
+def add_repair_arguments(repair):
+    repair.add_argument('root', metavar='directory', nargs='?', default='.')
+    repair.add_argument('--full', action='store_true',
+                        help='rescan everything, not just changed directories')
+
+def add_watch_arguments(watch_):
+    watch_.add_argument('root', metavar='directory', nargs='?', default='.')
+    watch_.add_argument('--poll', action='store_true',
+                        help="repair every --interval seconds rather than using inotify")
+    watch_.add_argument('--interval', type=float, default=5.0,
+                        help='seconds between polls')
+    watch_.add_argument('--debounce', type=float, default=0.5,
+                        help='seconds of quiet before changes are applied')
+
+def add_hash_arguments(hash_):
+    hash_.add_argument('--force', action='store_true',
+                       help='rehash files even if they look unchanged')
+    hash_.add_argument('--workers', type=int, default=None,
+                       help='processes to use for large files')
+
+def add_export_arguments(export):
+    export.add_argument('-o', '--output', default='-',
+                        help='where to write; stdout by default')
+    export.add_argument('--binary', action='store_true',
+                        help='the length-prefixed binary format rather than NDJSON')
+
+def add_import_arguments(import_):
+    import_.add_argument('input', nargs='?', default='-', help='a dump, or - for stdin')
+
+def add_sync_arguments(sync):
+    sync.add_argument('--mode', choices=('auto', 'xattr', 'sidecar'), default='auto',
+                      help='extended attributes, .umptag-tags files, or xattrs where they work')
+    sync.add_argument('--full', action='store_true',
+                      help='rewrite every file, not just those changed since the last sync')
+    sync.add_argument('--import', dest='import_', action='store_true',
+                      help='read tags off the files into the database instead')
+
+def add_compact_arguments(compact):
+    compact.add_argument('--upto', metavar='SEQ', type=int, default=None,
+                         help='drop everything up to SEQ, seen or not')
+
+def add_serve_arguments(serve):
+    serve.add_argument('--socket', default=None,
+                       help='where to listen; defaults to $UMPTAG_SOCKET or a per-user socket')
+
+def add_stats_arguments(stats_):
+    stats_.add_argument('--limit', type=int, default=10, help='how many of each to show')
+    stats_.add_argument('--refresh', metavar='N', type=int, nargs='?', const=50,
+                        help='first recount pairs among the N most used tags (default 50)')
+
+def add_clean_arguments(clean):
+    clean.add_argument('confirm', action='store_true')
+
+# (name, help, handler, what adds its arguments), in the order --help lists them.
+COMMANDS = [
+    ('init', 'initializes the folder as tag-aware', 'do_init', None),
+    # ('add', 'adds files to the database', 'do_add', add_add_arguments),
+    # ('rm', 'removes files from the database', 'do_rm', add_rm_arguments),
+    ('tag', 'tag files', 'do_tag', add_tagging_arguments),
+    ('untag', 'untag files', 'do_untag', add_tagging_arguments),
+    ('merge', 'merge a tag with another tag', 'do_merge', add_merge_arguments),
+    ('tags', 'displays tag information about a file', 'do_show', add_show_arguments),
+    ('files', 'lists files matching a tag predicate', 'do_files', add_files_arguments),
+    ('search', 'lists matching files in every database under a directory',
+     'do_search', add_search_arguments),
+    ('repair', 'detects moved or modified files', 'do_repair', add_repair_arguments),
+    ('watch', 'keeps the database current as files change', 'do_watch',
+     add_watch_arguments),
+    ('hash', 'fills in content hashes of tagged files', 'do_hash', add_hash_arguments),
+    ('export', 'writes out every file and tag', 'do_export', add_export_arguments),
+    ('import', 'merges in what export wrote', 'do_import', add_import_arguments),
+    ('sync', "writes tags onto the files themselves", 'do_sync', add_sync_arguments),
+    ('compact', 'drops change journal entries already seen', 'do_compact',
+     add_compact_arguments),
+    ('serve', 'answers requests from a warm process', 'do_serve', add_serve_arguments),
+    ('info', 'prints off information about the database', 'do_info', None),
+    ('stats', 'shows the most used tags and pairs of tags', 'do_stats',
+     add_stats_arguments),
+    ('ls', 'lists all tagged files', 'do_ls', None),
+    # ('show', '', 'do_show', None),
+    ('clean', 'cleans superfluous files', 'do_clean', add_clean_arguments),
+]
+
+
+def build_parser(command=None):
+    """ The whole parser, or with `command` one that only knows that
+    subcommand, for when it's the one being run. """
+    parser = argparse.ArgumentParser(prog="umptag", description="Manages tagged files.")
+    parser.set_defaults(func=lambda _: parser.print_help())
+    parser.add_argument('--no-daemon', action='store_true',
+                        help="don't hand the command to a running `umptag serve`")
+    subparsers = parser.add_subparsers(help='subparsers help', dest='command')
+    for (name, help_, func, add_arguments) in COMMANDS:
+        if command is None or name == command:
+            subparser = subparsers.add_parser(name, help=help_)
+            if add_arguments is not None:
+                add_arguments(subparser)
+            subparser.set_defaults(func=func)
+    return parser
+
+
+def _command(argv):
+    """ The subcommand argv runs, or None if it's asking for help or
+    doesn't name one, so that the whole parser is needed. """
+    for arg in argv:
+        if arg in ('-h', '--help'):
+            return None
+        if not arg.startswith('-'):
+            return arg if any(arg == name for (name, _, _, _) in COMMANDS) else None
+    return None
+
+
+def resolve(func):
+    """ Handlers are named rather than imported, so that only the command
+    being run pays for the modules it needs. """
+    if isinstance(func, str):
+        func = getattr(importlib.import_module('umptag.actions'), func)
+    return func
 
-clean = subparsers.add_parser('clean', help='cleans superfluous files')
-clean.add_argument('confirm', action='store_true')
-clean.set_defaults(func=do_clean)
 
 def main():
-    args = parser.parse_args()
-    args.func(args)
-    return 0
+    argv = sys.argv[1:]
+    command = _command(argv)
+    args = build_parser(command).parse_args(argv)
+    if not args.no_daemon:
+        from umptag import client
+        code = client.run_command(args)
+        if code is not None:
+            return code
+    return resolve(args.func)(args) or 0
@@ -0,0 +1,169 @@
+""" client.py
+The CLI's side of `umptag serve`: finding the socket, talking to the
+daemon, and running the commands it can answer. The protocol is described
+in daemon.py.
+
+The CLI imports this module on every run to look for the daemon, so it
+keeps its imports to a minimum; the server lives in daemon.py. """
+import errno
+import os
+import os.path
+import struct
+import sys
+
+
+HEADER = struct.Struct('>I')
+MAX_MESSAGE = 64 * 1024 * 1024
+# The CLI commands the daemon can answer instead.
+COMMANDS = ('tags', 'files', 'tag', 'untag')
+
+
+class DaemonError(Exception):
+    """ The daemon couldn't carry out a request. """
+
+
+def socket_path():
+    """ $UMPTAG_SOCKET, or a per-user socket in the runtime directory, or
+    failing that in a per-user directory under $TMPDIR or /tmp. """
+    if os.environ.get('UMPTAG_SOCKET'):
+        return os.environ['UMPTAG_SOCKET']
+    base = os.environ.get('XDG_RUNTIME_DIR') or os.path.join(
+        os.environ.get('TMPDIR') or '/tmp', 'umptag-%d' % os.getuid())
+    return os.path.join(base, 'umptag-%d.sock' % os.getuid())
+
+
+def _check_owner(sock, path):
+    """ Raises PermissionError unless whoever is listening on sock is us:
+    from the peer's credentials where there are any, else from the
+    socket file's owner. """
+    import socket
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = struct.Struct('3i')  # pid, uid, gid
+        (_, uid, _) = creds.unpack(sock.getsockopt(
+            socket.SOL_SOCKET, socket.SO_PEERCRED, creds.size))
+    else:
+        uid = os.stat(path).st_uid
+    if uid != os.getuid():
+        raise PermissionError(errno.EPERM, "Another user is listening", path)
+
+
+# Framing.
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError("Connection closed mid-message.")
+        buf += chunk
+    return bytes(buf)
+
+
+def send_message(sock, obj):
+    import json
+    data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(len(data)) + data)
+
+
+def recv_message(sock):
+    """ Returns None if the other end hung up between messages. """
+    import json
+    header = sock.recv(HEADER.size)
+    if not header:
+        return None
+    if len(header) < HEADER.size:
+        header += _recv_exactly(sock, HEADER.size - len(header))
+    (size,) = HEADER.unpack(header)
+    if size > MAX_MESSAGE:
+        raise DaemonError("Message of %d bytes is too big." % size)
+    return json.loads(_recv_exactly(sock, size).decode('utf-8'))
+
+
+# Client.
+class Client:
+    """ Raises OSError on creation if there's no daemon listening, and
+    PermissionError if the one listening is someone else's. """
+    def __init__(self, path=None, timeout=10.0):
+        import socket
+        path = socket_path() if path is None else path
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+            _check_owner(self.sock, path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def call(self, op, **kwargs):
+        kwargs['op'] = op
+        send_message(self.sock, kwargs)
+        reply = recv_message(self.sock)
+        if reply is None:
+            raise DaemonError("The daemon hung up.")
+        if 'error' in reply:
+            raise DaemonError(reply['error'])
+        return reply['result']
+
+    def close(self):
+        self.sock.close()
+
+
+def run_command(args, path=None):
+    """ Carries out a parsed CLI command through the daemon, printing what
+    its handler in `actions` would. Returns the exit code, or None if the
+    command should run locally: the daemon isn't running, or can't do it. """
+    if (args.command not in COMMANDS or getattr(args, 'stdin', False)
+            or getattr(args, 'recursive', False)):
+        return None
+    path = socket_path() if path is None else path
+    if not os.path.exists(path):
+        return None
+    try:
+        client = Client(path)
+    except OSError:  # Stale socket.
+        return None
+    with client:
+        try:
+            return _COMMANDS[args.command](client, args)
+        except DaemonError as e:
+            print(e, file=sys.stderr)
+            return 1
+
+
+def _run_tags(client, args):
+    from .tags import format_tag
+    for (key, value) in client.call('tags', cwd=os.getcwd(),
+                                    path=os.path.abspath(args.file or os.curdir)):
+        print(format_tag(key, value))
+    return 0
+
+
+def _run_files(client, args):
+    for path in client.call('files', cwd=os.getcwd(), query=' '.join(args.query)):
+        print(os.path.relpath(path))
+    return 0
+
+
+def _run_change(op, verb):
+    def run(client, args):
+        from .actions import _files_and_tags
+        paths, tags = _files_and_tags(args)
+        if not tags:
+            print("No tags given.", file=sys.stderr)
+            return 1
+        count = client.call(op, paths=[os.path.abspath(p) for p in paths],
+                            tags=tags)
+        print("%s %d tag(s)." % (verb, count))
+        return 0
+    return run
+
+
+_COMMANDS = {'tags': _run_tags, 'files': _run_files,
+             'tag': _run_change('apply', "Applied"),
+             'untag': _run_change('remove', "Removed")}
@@ -0,0 +1,196 @@
+""" daemon.py
+`umptag serve`: a resident process that keeps a warm Session per database,
+so shell integrations asking about hundreds of files a second don't pay
+for interpreter startup, finding the database and connecting each time.
+
+It listens on a Unix domain socket. Every message, both ways, is a 4-byte
+big-endian length followed by that many bytes of UTF-8 JSON. Requests are
+{"op": ..., ...} and replies are {"result": ...} or {"error": message}; a
+client can send as many requests as it likes on one connection.
+
+    tags    {"path", "cwd"}     -> [[key, value], ...]
+    files   {"cwd", "query"}    -> [path, ...]
+    apply   {"paths", "tags"}   -> number of new relations
+    remove  {"paths", "tags"}   -> number of relations removed
+    ping    {}                  -> "pong"
+
+Paths are absolute both ways, and "cwd" is where the database is looked
+for from, as the CLI would; for tags it defaults to the path's directory.
+Tags are [key, value] pairs, with a null value for an unkeyed tag as in
+`api.apply_tag`. Requests are handled one at a time, on one thread, so
+the Sessions are never shared.
+
+The socket is only for its owner: it's made with mode 0600, in a
+directory only they can enter, and the client checks who is listening
+before it sends anything.
+
+The client side, which the CLI imports on every run, is in client.py. """
+import os
+import os.path
+import stat
+
+from .client import (Client, DaemonError, recv_message, send_message,
+                     socket_path)
+
+
+def _private_directory(path):
+    """ Makes path, mode 0700, if it isn't there. Raises DaemonError if
+    it's not a directory of ours that only we can get into. """
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid()
+            or info.st_mode & 0o077):
+        raise DaemonError("%s isn't a private directory of yours." % path)
+
+
+# Server.
+class Server:
+    """ Binds the socket straight away; call `serve_forever` to answer
+    requests and `stop` (from anywhere) to make it return.
+    max_databases :: how many Sessions to keep open at once. """
+    def __init__(self, path=None, max_databases=16, timeout=10.0):
+        import socket
+        from collections import OrderedDict
+        self.path = socket_path() if path is None else path
+        self.max_databases = max_databases
+        self.timeout = timeout
+        self.sessions = OrderedDict()  # database path -> Session
+        self.databases = {}  # directory -> database path
+        self._stopping = False
+        if path is None and not os.environ.get('UMPTAG_SOCKET'):
+            _private_directory(os.path.dirname(self.path))
+        if os.path.exists(self.path):
+            try:
+                Client(self.path).close()
+            except PermissionError:
+                raise DaemonError("%s belongs to another user." % self.path) from None
+            except OSError:  # Left behind by a daemon that died.
+                os.unlink(self.path)
+            else:
+                raise DaemonError("A daemon is already listening on %s." % self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)  # So it's never there with looser permissions.
+        try:
+            self.listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        self.listener.listen(64)
+
+    def _database(self, directory):
+        db_loc = self.databases.get(directory)
+        if db_loc is None or not os.path.exists(db_loc):
+            from . import database
+            db_loc = database.find_database_filepath(database.DEFAULT_DB_NAME,
+                                                     directory)
+            if db_loc is None:
+                raise DaemonError("No database above %s." % directory)
+            if len(self.databases) > 10000:
+                self.databases.clear()
+            self.databases[directory] = db_loc
+        return db_loc
+
+    def session(self, directory):
+        """ Returns (session, root) for the database covering directory. """
+        from . import database, session
+        db_loc = self._database(directory)
+        s = self.sessions.get(db_loc)
+        if s is None:
+            s = session.Session(conn=database.initialize_conn(db_loc, new_db=False))
+            self.sessions[db_loc] = s
+            if len(self.sessions) > self.max_databases:
+                self.sessions.popitem(last=False)[1].close()
+        else:
+            self.sessions.move_to_end(db_loc)
+        s.refresh()
+        return s, os.path.dirname(db_loc)
+
+    # Operations.
+    def op_ping(self):
+        return "pong"
+
+    def op_tags(self, path, cwd=None):
+        from . import fs
+        s, root = self.session(os.path.dirname(path) if cwd is None else cwd)
+        return s.tags_of_file(*fs.split_path(path, root))
+
+    def op_files(self, cwd, query):
+        s, root = self.session(cwd)
+        return [os.path.join(root, d, n) for (d, n) in s.query(query)]
+
+    def _change(self, paths, tags, method):
+        from . import actions, fs
+        by_database = {}
+        for path in paths:
+            s, root = self.session(os.path.dirname(path))
+            directory, name = fs.split_path(path, root)
+            pairs = by_database.setdefault(root, (s, []))[1]
+            pairs.extend((directory, name, key, value) for (key, value) in tags)
+        count = 0
+        for (root, (s, pairs)) in by_database.items():
+            with actions._at_root(root):
+                count += getattr(s, method)(pairs)
+            s.commit()
+        return count
+
+    def op_apply(self, paths, tags):
+        return self._change(paths, tags, 'apply_tags_bulk')
+
+    def op_remove(self, paths, tags):
+        return self._change(paths, tags, 'remove_tags_bulk')
+
+    def handle(self, request):
+        if not isinstance(request, dict):
+            return {'error': "Requests must be JSON objects."}
+        op = getattr(self, 'op_%s' % request.pop('op', None), None)
+        if op is None:
+            return {'error': "Unknown operation."}
+        try:
+            return {'result': op(**request)}
+        except Exception as e:  # Report it and carry on serving.
+            return {'error': "%s: %s" % (type(e).__name__, e)}
+
+    def _serve_one(self, conn):
+        """ Answers one request. Returns False once the client is done. """
+        try:
+            try:
+                request = recv_message(conn)
+            except ValueError:  # Not JSON; the frame's been read, though.
+                send_message(conn, {'error': "Requests must be JSON objects."})
+                return True
+            if request is None:
+                return False
+            send_message(conn, self.handle(request))
+        except (OSError, EOFError, DaemonError):
+            return False
+        return True
+
+    def serve_forever(self, poll_interval=0.5):
+        import selectors
+        with selectors.DefaultSelector() as selector:
+            selector.register(self.listener, selectors.EVENT_READ)
+            while not self._stopping:
+                for (key, _) in selector.select(poll_interval):
+                    if key.fileobj is self.listener:
+                        conn, _ = self.listener.accept()
+                        conn.settimeout(self.timeout)
+                        selector.register(conn, selectors.EVENT_READ)
+                    elif not self._serve_one(key.fileobj):
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
+            for key in list(selector.get_map().values()):
+                if key.fileobj is not self.listener:
+                    key.fileobj.close()
+        for s in self.sessions.values():
+            s.close()
+        self.sessions.clear()
+
+    def stop(self):
+        self._stopping = True
+
+    def close(self):
+        self.listener.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
@@ -8,17 +8,219 @@ import os.path
 DEFAULT_DB_NAME = ".umptag.db"
 
 
-schema = """
-CREATE TABLE files (
+# Bump this alongside a new entry in `migrations`.
+SCHEMA_VERSION = 7
+
+# File counts per tag, kept up to date by triggers (every tag has a row from
+# the moment it's made, so the one on the junction is a single update), and
+# pairwise counts for the most used tags, refreshed on demand by
+# `stats.refresh_cooccurrence`.
+stats_schema = """
+CREATE TABLE tag_stats (
+    tag_id integer PRIMARY KEY,
+    file_count integer NOT NULL DEFAULT 0
+);
+
+CREATE TABLE tag_cooccurrence (
+    tag_a integer, tag_b integer,
+    file_count integer NOT NULL,
+    PRIMARY KEY (tag_a, tag_b)
+) WITHOUT ROWID;
+
+CREATE TRIGGER tag_insert_stats AFTER INSERT ON tags
+BEGIN
+    INSERT INTO tag_stats (tag_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER junction_insert_stats AFTER INSERT ON filetag_junction
+BEGIN
+    UPDATE tag_stats SET file_count = file_count + 1 WHERE tag_id = NEW.tag_id;
+END;
+
+CREATE TRIGGER junction_delete_stats AFTER DELETE ON filetag_junction
+BEGIN
+    UPDATE tag_stats SET file_count = file_count - 1 WHERE tag_id = OLD.tag_id;
+END;
+
+CREATE TRIGGER tag_delete_stats AFTER DELETE ON tags
+BEGIN
+    DELETE FROM tag_stats WHERE tag_id = OLD.id;
+    DELETE FROM tag_cooccurrence WHERE tag_a = OLD.id OR tag_b = OLD.id;
+END;"""
+
+
+# Files are stored against an integer directory id instead of repeating
+# their directory's path, which makes the rows smaller and the (dir_id,
+# name) lookup an integer comparison. A directory row's path is its full
+# path, '' for the root, so a subtree is a range scan on the path index.
+# `files` is a view over the two in the old shape, writable through its
+# triggers, so reads and one-off writes needn't care; the busy write paths
+# in fs and filetags go to file_entries directly. Inserting through the
+# view only links a new directory to its parent when the parent is already
+# there, whereas `fs.get_or_add_dir_id` adds every level.
+# `scan_mtime` is the directory's mtime as of the last repair.
+# Paths are stored the way os.path writes them (see `fs.split_path`), so
+# the SQL below that splits or joins them is written with '/' and goes
+# through `_native` to use the platform's separator, as fs does.
+directories_schema = """
+CREATE TABLE directories (
+    id integer PRIMARY KEY,
+    parent_id integer,
+    name text NOT NULL,
+    path text NOT NULL UNIQUE,
+    scan_mtime timestamp
+);
+
+CREATE INDEX directories_parent_idx ON directories (parent_id);
+
+INSERT OR IGNORE INTO directories (id, parent_id, name, path) VALUES (1, NULL, '', '');
+
+CREATE TABLE file_entries (
     id integer PRIMARY KEY,
-    directory text NOT NULL,
+    dir_id integer NOT NULL REFERENCES directories (id),
     name text NOT NULL,
     size integer,
     mod_time timestamp,
     is_dir boolean,
-    CONSTRAINT path UNIQUE (directory, name)
+    hash text,
+    CONSTRAINT path UNIQUE (dir_id, name)
+);"""
+
+def _native(sql):
+    return sql if os.sep == '/' else sql.replace("'/'", "'%s'" % os.sep)
+
+
+files_view_schema = _native("""
+CREATE INDEX files_hash_idx ON file_entries (hash);
+
+CREATE VIEW files AS
+    SELECT file_entries.id AS id, directories.path AS directory,
+           file_entries.name AS name, file_entries.size AS size,
+           file_entries.mod_time AS mod_time, file_entries.is_dir AS is_dir,
+           file_entries.hash AS hash
+    FROM file_entries
+    INNER JOIN directories ON directories.id = file_entries.dir_id;
+
+CREATE TRIGGER files_insert INSTEAD OF INSERT ON files
+BEGIN
+    INSERT OR IGNORE INTO directories (parent_id, name, path) VALUES (
+        (SELECT id FROM directories WHERE path = rtrim(rtrim(NEW.directory,
+            replace(NEW.directory, '/', '')), '/')),
+        substr(NEW.directory, length(rtrim(NEW.directory,
+            replace(NEW.directory, '/', ''))) + 1),
+        NEW.directory);
+    INSERT INTO file_entries (id, dir_id, name, size, mod_time, is_dir, hash)
+        VALUES (NEW.id, (SELECT id FROM directories WHERE path = NEW.directory),
+                NEW.name, NEW.size, NEW.mod_time, NEW.is_dir, NEW.hash);
+END;
+
+CREATE TRIGGER files_update INSTEAD OF UPDATE ON files
+BEGIN
+    INSERT OR IGNORE INTO directories (parent_id, name, path) VALUES (
+        (SELECT id FROM directories WHERE path = rtrim(rtrim(NEW.directory,
+            replace(NEW.directory, '/', '')), '/')),
+        substr(NEW.directory, length(rtrim(NEW.directory,
+            replace(NEW.directory, '/', ''))) + 1),
+        NEW.directory);
+    UPDATE file_entries SET id = NEW.id,
+        dir_id = (SELECT id FROM directories WHERE path = NEW.directory),
+        name = NEW.name, size = NEW.size, mod_time = NEW.mod_time,
+        is_dir = NEW.is_dir, hash = NEW.hash
+    WHERE id = OLD.id;
+END;
+
+CREATE TRIGGER files_delete INSTEAD OF DELETE ON files
+BEGIN
+    DELETE FROM file_entries WHERE id = OLD.id;
+END;""")
+
+
+# A log of changes for whoever wants to catch up on them incrementally, in
+# the order they happened: `seq` is AUTOINCREMENT so it's never reused,
+# even once old entries are gone. Deleted relations keep the file's path,
+# since the file's row may well be gone by the time anyone looks.
+# `sync_state` is how far each consumer has got.
+journal_schema = _native("""
+CREATE TABLE changes (
+    seq integer PRIMARY KEY AUTOINCREMENT,
+    kind text NOT NULL,
+    op text NOT NULL,
+    file_id integer,
+    tag_id integer,
+    path text
+);
+
+CREATE TABLE sync_state (
+    consumer text PRIMARY KEY,
+    seq integer NOT NULL
 );
 
+CREATE TRIGGER junction_insert_journal AFTER INSERT ON filetag_junction
+BEGIN
+    INSERT INTO changes (kind, op, file_id, tag_id)
+        VALUES ('filetag', 'insert', NEW.file_id, NEW.tag_id);
+END;
+
+CREATE TRIGGER junction_delete_journal AFTER DELETE ON filetag_junction
+BEGIN
+    INSERT INTO changes (kind, op, file_id, tag_id, path)
+        VALUES ('filetag', 'delete', OLD.file_id, OLD.tag_id,
+                (SELECT CASE directory WHEN '' THEN name
+                        ELSE directory || '/' || name END
+                 FROM files WHERE id = OLD.file_id));
+END;""")
+
+
+# The journal's entries for files and tags themselves. A file's update and
+# delete entries keep the path it had before, so a move can be followed;
+# updates that leave the row as it was aren't logged.
+entity_journal_schema = _native("""
+CREATE TRIGGER file_insert_journal AFTER INSERT ON file_entries
+BEGIN
+    INSERT INTO changes (kind, op, file_id) VALUES ('file', 'insert', NEW.id);
+END;
+
+CREATE TRIGGER file_update_journal AFTER UPDATE ON file_entries
+WHEN OLD.id IS NOT NEW.id OR OLD.dir_id IS NOT NEW.dir_id
+  OR OLD.name IS NOT NEW.name OR OLD.size IS NOT NEW.size
+  OR OLD.mod_time IS NOT NEW.mod_time OR OLD.is_dir IS NOT NEW.is_dir
+  OR OLD.hash IS NOT NEW.hash
+BEGIN
+    INSERT INTO changes (kind, op, file_id, path)
+        VALUES ('file', 'update', NEW.id,
+                (SELECT CASE path WHEN '' THEN OLD.name
+                        ELSE path || '/' || OLD.name END
+                 FROM directories WHERE id = OLD.dir_id));
+END;
+
+CREATE TRIGGER file_delete_journal AFTER DELETE ON file_entries
+BEGIN
+    INSERT INTO changes (kind, op, file_id, path)
+        VALUES ('file', 'delete', OLD.id,
+                (SELECT CASE path WHEN '' THEN OLD.name
+                        ELSE path || '/' || OLD.name END
+                 FROM directories WHERE id = OLD.dir_id));
+END;
+
+CREATE TRIGGER tag_insert_journal AFTER INSERT ON tags
+BEGIN
+    INSERT INTO changes (kind, op, tag_id) VALUES ('tag', 'insert', NEW.id);
+END;
+
+CREATE TRIGGER tag_update_journal AFTER UPDATE ON tags
+WHEN OLD.key IS NOT NEW.key OR OLD.value IS NOT NEW.value
+BEGIN
+    INSERT INTO changes (kind, op, tag_id) VALUES ('tag', 'update', NEW.id);
+END;
+
+CREATE TRIGGER tag_delete_journal AFTER DELETE ON tags
+BEGIN
+    INSERT INTO changes (kind, op, tag_id) VALUES ('tag', 'delete', OLD.id);
+END;""")
+
+
+schema = directories_schema + files_view_schema + """
+
 CREATE TABLE tags (
     id integer PRIMARY KEY,
     key text DEFAULT '' NOT NULL,
@@ -27,23 +229,90 @@ CREATE TABLE tags (
 );
 
 CREATE TABLE filetag_junction (
+    file_id int, tag_id int,
+    CONSTRAINT file_tag_pk PRIMARY KEY (file_id, tag_id),
+    CONSTRAINT FK_files
+    FOREIGN KEY (file_id) REFERENCES file_entries (id),
+    CONSTRAINT FK_tags
+    FOREIGN KEY (tag_id) REFERENCES tags (id)
+) WITHOUT ROWID;
+
+CREATE INDEX junction_tag_idx ON filetag_junction (tag_id, file_id);
+""" + stats_schema + "\n" + journal_schema + "\n" + entity_journal_schema
+
+
+tables = ('directories', 'file_entries', 'tags', 'filetag_junction',
+          'tag_stats', 'tag_cooccurrence', 'changes', 'sync_state')
+# What `files` and `scanned_dirs` were before version 5.
+legacy_tables = ('files', 'scanned_dirs')
+
+
+# (version, script) pairs. Each script upgrades a database from the previous
+# version; `migrate` runs the ones newer than the database's user_version.
+migrations = [
+    (1, """
+CREATE TABLE filetag_junction_new (
     file_id int, tag_id int,
     CONSTRAINT file_tag_pk PRIMARY KEY (file_id, tag_id),
     CONSTRAINT FK_files
     FOREIGN KEY (file_id) REFERENCES files (id),
     CONSTRAINT FK_tags
     FOREIGN KEY (tag_id) REFERENCES tags (id)
-);"""
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO filetag_junction_new (file_id, tag_id)
+    SELECT file_id, tag_id FROM filetag_junction
+    WHERE file_id IS NOT NULL AND tag_id IS NOT NULL;
+DROP TABLE filetag_junction;
+ALTER TABLE filetag_junction_new RENAME TO filetag_junction;
+CREATE INDEX junction_tag_idx ON filetag_junction (tag_id, file_id);"""),
+    (2, """
+CREATE TABLE scanned_dirs (
+    directory text PRIMARY KEY,
+    mod_time timestamp
+);"""),
+    (3, """
+ALTER TABLE files ADD COLUMN hash text;
+CREATE INDEX files_hash_idx ON files (hash);"""),
+    (4, stats_schema + """
+INSERT INTO tag_stats (tag_id, file_count)
+    SELECT id, (SELECT COUNT(*) FROM filetag_junction WHERE tag_id = tags.id)
+    FROM tags;"""),
+    (5, directories_schema + _native("""
+INSERT OR IGNORE INTO directories (name, path)
+    WITH RECURSIVE dirs (path) AS (
+        SELECT directory FROM files
+        UNION SELECT directory FROM scanned_dirs
+        UNION SELECT rtrim(rtrim(path, replace(path, '/', '')), '/')
+              FROM dirs WHERE path != ''
+    )
+    SELECT substr(path, length(rtrim(path, replace(path, '/', ''))) + 1), path
+    FROM dirs ORDER BY path;
+UPDATE directories SET parent_id = (SELECT parent.id FROM directories parent
+        WHERE parent.path = rtrim(rtrim(directories.path,
+                                  replace(directories.path, '/', '')), '/'))
+    WHERE path != '';
+UPDATE directories SET scan_mtime = (SELECT mod_time FROM scanned_dirs
+        WHERE scanned_dirs.directory = directories.path);
+INSERT INTO file_entries (id, dir_id, name, size, mod_time, is_dir, hash)
+    SELECT files.id, directories.id, files.name, files.size,
+           files.mod_time, files.is_dir, files.hash
+    FROM files
+    INNER JOIN directories ON directories.path = files.directory;
+DROP TABLE files;
+DROP TABLE scanned_dirs;""") + files_view_schema),
+    (6, journal_schema),
+    (7, entity_journal_schema),
+]
 
 
-def find_database_filepath(db_name):
-    """ Returns a filepath that points to the database.
-    Returns None if not found. """
+def find_database_filepath(db_name, start=os.curdir):
+    """ Returns a filepath that points to the database, looking in `start`
+    and then up the hierarchy. Returns None if not found. """
     # db = os.path.abspath(db_name)
-    db = db_name
+    db = os.path.join(start, db_name)
     if os.path.exists(db):
         return os.path.abspath(db)
-    cur = os.path.abspath(os.path.curdir)
+    cur = os.path.abspath(start)
     cur, child = os.path.dirname(cur), cur  # go up the hierarchy
     while cur != child:  # because the parent dir of '/' is '/'
         db = os.path.join(cur, db_name)
@@ -57,26 +326,83 @@ def _initialize_tables(c, destructive=True):
     """ Creates a new database, wiping out the previous one if needed. 
     c :: Cursor. """
     if destructive:
+        # `files` is a view these days, but a table in older databases.
         c.executescript(';\n'.join(
-                "DROP TABLE IF EXISTS %s" % table for table in
-                ('files', 'tags', 'filetag_junction'))
+                "DROP %s IF EXISTS %s" % (type_.upper(), name)
+                for (type_, name) in c.execute("""SELECT type, name
+                    FROM sqlite_master WHERE type IN ('table', 'view')""")
+                if name in tables + legacy_tables)
                 )
     #with open(schema, 'r') as sch:
     c.executescript(schema)
+    c.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+
+
+def schema_version(c):
+    return c.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(c):
+    """ Upgrades the database in place to SCHEMA_VERSION.
+    A database without any tables is simply initialized. """
+    if c.execute("""SELECT 1 FROM sqlite_master
+            WHERE type = 'table' AND name = 'tags'""").fetchone() is None:
+        _initialize_tables(c, destructive=False)
+        return
+    version = schema_version(c)
+    for (target, script) in migrations:
+        if version < target:
+            c.executescript("BEGIN;\n%s;\nPRAGMA user_version = %d;\nCOMMIT;"
+                            % (script, target))
+            version = target
 
 
-def initialize_conn(db_loc, new_db):
+# These are process-wide, so there's no need to redo them per connection.
+sqlite3.register_adapter(bool, int)
+sqlite3.register_converter("boolean", lambda v: bool(int(v)))
+
+
+# Applied to every connection unless `initialize_conn` gets its own.
+# WAL lets readers carry on while someone writes, and busy_timeout makes
+# competing writers wait their turn instead of failing outright.
+PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # In KiB, when negative.
+    'temp_store': 'memory',
+    'busy_timeout': 10000,  # ms
+}
+
+
+def apply_pragmas(conn, pragmas):
+    """ `pragmas` is UNSAFE. """
+    for (name, value) in pragmas.items():
+        conn.execute("PRAGMA %s = %s" % (name, value))
+
+
+def initialize_conn(db_loc, new_db, cached_statements=128, pragmas=None,
+                    check_same_thread=True):
+    """ cached_statements :: how many prepared statements sqlite3 keeps
+    around for this connection.
+    pragmas :: {name: value}, defaulting to PRAGMAS.
+    check_same_thread :: as in sqlite3.connect. """
     conn = sqlite3.connect(db_loc,
-            detect_types=sqlite3.PARSE_DECLTYPES)
-    sqlite3.register_adapter(bool, int)
-    sqlite3.register_converter("boolean", lambda v: bool(int(v)))
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            cached_statements=cached_statements,
+            check_same_thread=check_same_thread)
+    apply_pragmas(conn, PRAGMAS if pragmas is None else pragmas)
     if new_db:
         _initialize_tables(conn)
+    else:
+        migrate(conn)
     return conn
 
 
 def get_conn(db_name=DEFAULT_DB_NAME,
         fail_if_uninitialized=False, **kwargs):
+    """ Finds (or makes) the database and connects to it.
+    Extra keyword arguments go to `initialize_conn`. """
     is_new = False
     if db_name != ":memory:":
         db_loc = find_database_filepath(db_name)
@@ -90,7 +416,7 @@ def get_conn(db_name=DEFAULT_DB_NAME,
             assert os.path.exists(db_loc)
     else:
         db_loc = ":memory:"
-    return initialize_conn(db_loc, new_db=is_new)
+    return initialize_conn(db_loc, new_db=is_new, **kwargs)
 
 
 def database_cognant(func, *args):
@@ -98,7 +424,10 @@ def database_cognant(func, *args):
     as the first argument. """
     # print("No database detected. Run `umptag init` first.")
     def out_func(*args, **kwargs):
-        with get_conn(fail_if_uninitialized=True) as conn:
-            out = func(conn, *args, **kwargs)
-        return out
+        conn = get_conn(fail_if_uninitialized=True)
+        try:
+            with conn:
+                return func(conn, *args, **kwargs)
+        finally:
+            conn.close()
     return out_func
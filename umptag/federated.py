@@ -0,0 +1,183 @@
+""" federated.py
+Runs a tag query across every database under a directory, for trees of
+projects that each have their own. `databases` finds them, walking the
+tree once and remembering what it found in a catalogue, so that later
+queries under the same root skip the walk until the entry is `max_age`
+seconds old. The catalogue is a small SQLite database of its own, at
+$UMPTAG_CATALOGUE or in the per-user cache directory.
+
+`run_query` attaches the databases read-only to an in-memory connection,
+as many at a time as SQLite allows (SQLITE_LIMIT_ATTACHED, 10 unless
+built otherwise), and asks each group for its matches in one statement,
+streaming the rows out before it moves on to the next group. """
+import os
+import os.path
+import sqlite3
+import time
+from urllib.parse import quote
+
+from . import database, filetags, query
+
+
+catalogue_schema = """
+CREATE TABLE IF NOT EXISTS roots (
+    root text PRIMARY KEY,
+    walked real NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS databases (
+    root text NOT NULL,
+    path text NOT NULL,
+    PRIMARY KEY (root, path)
+) WITHOUT ROWID;"""
+# What a database needs for a query to run against it.
+REQUIRED = {'files', 'tags', 'filetag_junction'}
+
+
+def catalogue_path():
+    """ $UMPTAG_CATALOGUE, or catalogue.db in the per-user cache directory. """
+    if os.environ.get('UMPTAG_CATALOGUE'):
+        return os.environ['UMPTAG_CATALOGUE']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(
+        os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'umptag', 'catalogue.db')
+
+
+def open_catalogue(path=None):
+    path = catalogue_path() if path is None else path
+    if path != ':memory:':
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.executescript(catalogue_schema)
+    return conn
+
+
+def discover(root, db_name=database.DEFAULT_DB_NAME):
+    """ Yields the path of every database under root, including its own. """
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        if db_name in filenames:
+            yield os.path.join(dirpath, db_name)
+
+
+def databases(root, catalogue=None, max_age=3600.0, refresh=False):
+    """ Returns the absolute paths of the databases under root, sorted,
+    from the catalogue if it walked root, or a directory above it, within
+    the last `max_age` seconds, and otherwise by walking root and
+    cataloguing what's there. Ones that have since gone are left out.
+    catalogue :: a connection from `open_catalogue`; one is opened and
+                 closed if not given. """
+    root = os.path.abspath(root)
+    conn = open_catalogue() if catalogue is None else catalogue
+    try:
+        cached = None
+        if not refresh:
+            cached = _cached(conn, root, time.time() - max_age)
+        if cached is None:
+            cached = sorted(os.path.abspath(path) for path in discover(root))
+            with conn:
+                conn.execute("DELETE FROM databases WHERE root = ?", (root,))
+                conn.executemany("INSERT INTO databases (root, path) VALUES (?,?)",
+                                 ((root, path) for path in cached))
+                conn.execute("INSERT OR REPLACE INTO roots (root, walked) VALUES (?,?)",
+                             (root, time.time()))
+        return [path for path in cached if os.path.exists(path)]
+    finally:
+        if catalogue is None:
+            conn.close()
+
+
+def _cached(conn, root, since):
+    """ The catalogued databases under root, or None if no fresh walk
+    covers it. """
+    for (walked_root,) in conn.execute(
+            "SELECT root FROM roots WHERE walked >= ? ORDER BY length(root) DESC",
+            (since,)):
+        if root == walked_root or root.startswith(os.path.join(walked_root, '')):
+            prefix = os.path.join(root, '')
+            return sorted(path for (path,) in conn.execute(
+                "SELECT path FROM databases WHERE root = ?", (walked_root,))
+                if path.startswith(prefix))
+    return None
+
+
+def attach_limit(conn):
+    """ How many databases the connection can attach. """
+    try:
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:  # Before Python 3.11; SQLite's default, then.
+        return 10
+
+
+def _uri(path):
+    """ A read-only URI, so that a database that's gone isn't made anew. """
+    return 'file:%s?mode=ro' % quote(os.path.abspath(path))
+
+
+def _attach(conn, paths, on_skip):
+    """ Attaches what it can of paths as db0, db1, ... Returns the
+    (schema, path) pairs that can be queried. """
+    attached = []
+    for path in paths:
+        schema = 'db%d' % len(attached)
+        try:
+            conn.execute("ATTACH DATABASE ? AS %s" % schema, (_uri(path),))
+            names = set(name for (name,) in conn.execute(
+                "SELECT name FROM %s.sqlite_master" % schema))
+        except sqlite3.Error as e:
+            _detach(conn, [(schema, path)])
+            if on_skip is not None:
+                on_skip(path, str(e))
+            continue
+        if not REQUIRED <= names:
+            conn.execute("DETACH DATABASE %s" % schema)
+            if on_skip is not None:
+                on_skip(path, "not an umptag database")
+            continue
+        attached.append((schema, path))
+    return attached
+
+
+def _detach(conn, attached):
+    for (schema, _) in attached:
+        try:
+            conn.execute("DETACH DATABASE %s" % schema)
+        except sqlite3.OperationalError:  # It never got attached.
+            pass
+
+
+def run_query(query_str, paths, batch_size=1000, on_skip=None):
+    """ Yields (database path, directory, name) for every file matching the
+    query in any of the databases at `paths`, database by database in the
+    order given, each one's files in path order. Databases that can't be
+    read are passed over, with (path, reason) going to `on_skip`.
+    Raises QuerySyntaxError before anything is opened. """
+    query.parse(query_str)
+    conn = sqlite3.connect('file::memory:', uri=True)
+    try:
+        limit = attach_limit(conn)
+        for start in range(0, len(paths), limit):
+            attached = _attach(conn, paths[start:start + limit], on_skip)
+            if not attached:
+                continue
+            try:
+                yield from _query_group(conn, query_str, attached, batch_size)
+            finally:
+                _detach(conn, attached)
+    finally:
+        conn.close()
+
+
+def _query_group(conn, query_str, attached, batch_size):
+    parts, params = [], []
+    for (i, (schema, path)) in enumerate(attached):
+        ids_sql, ids_params = query.compile_ids_in(conn, schema, query_str)
+        parts.append("SELECT %d, directory, name FROM %s.files WHERE id IN (%s)"
+                     % (i, schema, ids_sql))
+        params += ids_params
+    cursor = conn.execute(' UNION ALL '.join(parts) + " ORDER BY 1, 2, 3", params)
+    try:
+        for (i, directory, name) in filetags._stream(cursor, batch_size):
+            yield (attached[i][1], directory, name)
+    finally:
+        cursor.close()  # Or the DETACH would find the databases still in use.
@@ -1,9 +1,4 @@
-from typing import Union
-from datetime import datetime
-import sys
 import sqlite3
-import logging
-import os, os.path
 
 from . import tags
 from . import fs
@@ -63,7 +58,7 @@ def _column_safety(c, table, cols='*'):
 def file_safety(cols):
     # I coded a way to dynamically do this above, but it seems silly to query
     # the database each time if my columns aren't going to change that much.
-    table_columns = ['id', 'directory', 'name', 'size', 'mod_time', 'is_dir']
+    table_columns = ['id', 'directory', 'name', 'size', 'mod_time', 'is_dir', 'hash']
     if cols == '*' or all(col in table_columns for col in cols):
         return
     else:
@@ -99,47 +94,197 @@ def _unrelate_tag_and_file(c, directory, name, key, value):
         tag_id=(SELECT id FROM tags WHERE key = ? AND value = ?)""",
         (directory, name, key, value))
 
+def _relate_ids(c, file_id, tag_id) -> bool:
+    """ Returns False if the file already had the tag. """
+    return c.execute("""INSERT OR IGNORE INTO filetag_junction (file_id, tag_id)
+            VALUES (?,?)""", (file_id, tag_id)).rowcount == 1
+
+def _unrelate_ids(c, file_id, tag_id) -> bool:
+    """ Returns False if the file didn't have the tag. """
+    return c.execute("""DELETE FROM filetag_junction
+            WHERE file_id = ? AND tag_id = ?""", (file_id, tag_id)).rowcount == 1
+
+def _clean_orphan_ids(c, file_id, tag_id):
+    """ Deletes the tag and the file if nothing relates to them anymore,
+    and the file's directories if that leaves them empty.
+    Returns (tag_deleted, file_deleted). """
+    tag_deleted = file_deleted = False
+    if c.execute("SELECT NOT EXISTS (SELECT 1 FROM filetag_junction "
+                 "WHERE tag_id = ?)", (tag_id,)).fetchone()[0]:
+        c.execute("DELETE FROM tags WHERE id = ?", (tag_id,))
+        tag_deleted = True
+    if c.execute("SELECT NOT EXISTS (SELECT 1 FROM filetag_junction "
+                 "WHERE file_id = ?)", (file_id,)).fetchone()[0]:
+        (dir_id,) = c.execute("SELECT dir_id FROM file_entries WHERE id = ?",
+                              (file_id,)).fetchone()
+        c.execute("DELETE FROM file_entries WHERE id = ?", (file_id,))
+        fs.delete_empty_dirs(c, dir_id)
+        file_deleted = True
+    return tag_deleted, file_deleted
+
 # Public methods.
-def tags_of_file(c, directory, name, cols=('key', 'value')):
-    res = c.execute(f"""SELECT {', '.join(cols)} FROM filetag_junction J
+def _tags_of_file_cursor(c, directory, name, cols):
+    return c.execute(f"""SELECT {', '.join(cols)} FROM filetag_junction J
             INNER JOIN tags ON tags.id = J.tag_id
             INNER JOIN files ON files.id = J.file_id
             WHERE files.directory = ? AND files.name = ?""",
             (directory, name))
-    # res = [(r[1] if r[0] == '' else r) for r in res.fetchall()]
-    return res.fetchall()
 
-def files_of_tag(c, key, value, cols=('directory', 'name')):
-    res = c.execute(f"""SELECT {', '.join(cols)} FROM filetag_junction J
+def _files_of_tag_cursor(c, key, value, cols):
+    return c.execute(f"""SELECT {', '.join(cols)} FROM filetag_junction J
             INNER JOIN files on files.id = J.file_id
             INNER JOIN tags ON tags.id = J.tag_id
             WHERE tags.key = ? AND tags.value = ?""",
             (key, value))
-    return res.fetchall()
+
+def _stream(cursor, batch_size):
+    """ Yields rows `batch_size` at a time, so only one batch is in memory. """
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        yield from rows
+
+def tags_of_file(c, directory, name, cols=('key', 'value')):
+    # res = [(r[1] if r[0] == '' else r) for r in res.fetchall()]
+    return _tags_of_file_cursor(c, directory, name, cols).fetchall()
+
+def files_of_tag(c, key, value, cols=('directory', 'name')):
+    return _files_of_tag_cursor(c, key, value, cols).fetchall()
+
+def iter_tags_of_file(c, directory, name, cols=('key', 'value'), batch_size=1000):
+    """ Like `tags_of_file`, but streams the rows. """
+    return _stream(_tags_of_file_cursor(c, directory, name, cols), batch_size)
+
+def iter_files_of_tag(c, key, value, cols=('directory', 'name'), batch_size=1000):
+    """ Like `files_of_tag`, but streams the rows. """
+    return _stream(_files_of_tag_cursor(c, key, value, cols), batch_size)
+
+def file_has_tag(c, directory, name, key, value) -> bool:
+    return bool(c.execute("""SELECT EXISTS (SELECT 1 FROM filetag_junction
+            WHERE file_id = (SELECT id FROM files WHERE directory = ? AND name = ?)
+            AND tag_id = (SELECT id FROM tags WHERE key = ? AND value = ?))""",
+            (directory, name, key, value)).fetchone()[0])
+
+def file_has_tags(c, directory, name) -> bool:
+    return bool(c.execute("""SELECT EXISTS (SELECT 1 FROM filetag_junction
+            WHERE file_id = (SELECT id FROM files WHERE directory = ? AND name = ?))""",
+            (directory, name)).fetchone()[0])
+
+def tag_has_files(c, key, value) -> bool:
+    return bool(c.execute("""SELECT EXISTS (SELECT 1 FROM filetag_junction
+            WHERE tag_id = (SELECT id FROM tags WHERE key = ? AND value = ?))""",
+            (key, value)).fetchone()[0])
 
 # Actual usage
 def tag_file(c, directory, name, key, value):
-    fs.get_or_add_file(c, directory, name)
-    tags.get_or_add_tag(c, key, value)
-    try:
-        _relate_tag_and_file(c, directory, name, key, value)
-    except sqlite3.IntegrityError:
-        return 1
-    return 0
+    file_id = fs.get_or_add_file_id(c, directory, name)
+    tag_id = tags.get_or_add_tag_id(c, key, value)
+    return 0 if _relate_ids(c, file_id, tag_id) else 1
+
+def _stage_filetags(c, rows):
+    """ Loads (directory, name, size, mod_time, is_dir, key, value) rows
+    into a temporary staging table, emptying it first. """
+    c.execute("""CREATE TEMP TABLE IF NOT EXISTS staged_filetags (
+            directory text, name text, size integer, mod_time timestamp,
+            is_dir boolean, key text, value text)""")
+    c.execute("DELETE FROM staged_filetags")
+    c.executemany("""INSERT INTO staged_filetags
+            (directory, name, size, mod_time, is_dir, key, value)
+            VALUES (?,?,?,?,?,?,?)""", rows)
+
+def tag_files_bulk(c, rows):
+    """ Tags many files at once with a fixed number of statements.
+    rows :: iterable of (directory, name, size, mod_time, is_dir, key, value).
+    Files and tags that already exist are left alone, as are existing
+    relations. Returns the number of new relations. """
+    _stage_filetags(c, rows)
+    dir_ids = {}
+    for (directory,) in c.execute(
+            "SELECT DISTINCT directory FROM staged_filetags").fetchall():
+        fs.get_or_add_dir_id(c, directory, dir_ids)
+    c.execute("""INSERT OR IGNORE INTO file_entries
+            (dir_id, name, size, mod_time, is_dir)
+            SELECT directories.id, S.name, S.size, S.mod_time, S.is_dir
+            FROM staged_filetags S
+            INNER JOIN directories ON directories.path = S.directory
+            GROUP BY S.directory, S.name""")
+    c.execute("""INSERT OR IGNORE INTO tags (key, value)
+            SELECT DISTINCT key, value FROM staged_filetags""")
+    return c.execute("""INSERT OR IGNORE INTO filetag_junction (file_id, tag_id)
+            SELECT files.id, tags.id FROM staged_filetags S
+            INNER JOIN files ON files.directory = S.directory
+                AND files.name = S.name
+            INNER JOIN tags ON tags.key = S.key AND tags.value = S.value""").rowcount
 
-def untag_file(c, directory, name, key, value):
-    if (key, value) not in tags_of_file(c, directory, name):
+def merge_tags(c, destination, sources):
+    """ Moves every file from the source tags onto the destination tag and
+    deletes the sources, without touching the filesystem.
+    destination :: (key, value); created if needed.
+    sources :: iterable of (key, value); ones that don't exist are skipped.
+    Returns the number of source tags merged. """
+    source_ids = set(tags._get_tag_id(c, key, value) for (key, value) in sources
+                     if (key, value) != tuple(destination))
+    source_ids.discard(None)
+    if not source_ids:
+        return 0
+    dest_id = tags.get_or_add_tag_id(c, *destination)
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS merge_sources (id integer PRIMARY KEY)")
+    c.execute("DELETE FROM merge_sources")
+    c.executemany("INSERT INTO merge_sources (id) VALUES (?)",
+                  ((id_,) for id_ in source_ids))
+    c.execute("""INSERT OR IGNORE INTO filetag_junction (file_id, tag_id)
+            SELECT file_id, ? FROM filetag_junction
+            WHERE tag_id IN (SELECT id FROM merge_sources)""", (dest_id,))
+    c.execute("""DELETE FROM filetag_junction
+            WHERE tag_id IN (SELECT id FROM merge_sources)""")
+    c.execute("DELETE FROM tags WHERE id IN (SELECT id FROM merge_sources)")
+    return len(source_ids)
+
+def untag_files_bulk(c, rows):
+    """ Removes many (directory, name, key, value) relations at once.
+    Doesn't clean up orphans; follow up with `sweep_orphans`.
+    Returns the number of relations removed. """
+    c.execute("""CREATE TEMP TABLE IF NOT EXISTS staged_untags (
+            directory text, name text, key text, value text)""")
+    c.execute("DELETE FROM staged_untags")
+    c.executemany("""INSERT INTO staged_untags (directory, name, key, value)
+            VALUES (?,?,?,?)""", rows)
+    return c.execute("""DELETE FROM filetag_junction WHERE (file_id, tag_id) IN
+            (SELECT files.id, tags.id FROM staged_untags S
+             INNER JOIN files ON files.directory = S.directory
+                AND files.name = S.name
+             INNER JOIN tags ON tags.key = S.key AND tags.value = S.value)""").rowcount
+
+def untag_file(c, directory, name, key, value, clean=True):
+    """ With `clean` unset, orphaned tags and files are left for
+    `sweep_orphans` to pick up later. """
+    file_id = fs._get_file_id(c, directory, name)
+    tag_id = tags._get_tag_id(c, key, value)
+    if file_id is None or tag_id is None or not _unrelate_ids(c, file_id, tag_id):
         return 1
-    _unrelate_tag_and_file(c, directory, name, key, value)
-    clean_orphans(c, directory, name, key, value)
+    if clean:
+        _clean_orphan_ids(c, file_id, tag_id)
     return 0
 
+def sweep_orphans(c):
+    """ Deletes every tag and file that isn't related to anything, in two
+    statements, and then the directories left empty.
+    Returns (tags_deleted, files_deleted). """
+    tags_deleted = c.execute("""DELETE FROM tags WHERE id NOT IN
+            (SELECT tag_id FROM filetag_junction)""").rowcount
+    files_deleted = c.execute("""DELETE FROM file_entries WHERE id NOT IN
+            (SELECT file_id FROM filetag_junction)""").rowcount
+    if files_deleted:
+        fs.sweep_dirs(c)
+    return tags_deleted, files_deleted
+
 def clean_orphans(c, directory, name, key, value):
-    if files_of_tag(c, key, value) == []:
+    if not tag_has_files(c, key, value):
         tags.delete_tag(c, key, value)
     # NOTE: Should we keep track of files without tags? Why or why not?
     # Deciding no for right now.
-    if tags_of_file(c, directory, name) == []:
+    if not file_has_tags(c, directory, name):
         fs.delete_file(c, directory, name)
     return 0
 
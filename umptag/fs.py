@@ -1,13 +1,86 @@
-from typing import Union
 from datetime import datetime
+import fnmatch
+import itertools
 import os
+import stat
 import sqlite3
 
-def collect_files(root_dir=os.curdir, filter_=lambda x: True):
-    # This is probably just going to wrap os.walk.
-    os.walk(root_dir)
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import Union
 
-def _get_file_properties(c, directory, name, cols=('directory', 'name')) -> Union[tuple, None]:
+
+def _matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def _scan_directory(directory, include, exclude, follow_symlinks):
+    """ Lists a single directory. Returns (records, subdirectories).
+    Everything comes from the DirEntry, so there's one stat per entry at
+    most (none for the type on most platforms). """
+    records, subdirs = [], []
+    try:
+        with os.scandir(directory or os.curdir) as it:
+            entries = list(it)
+    except OSError:  # Unreadable or vanished; os.walk skips these too.
+        return records, subdirs
+    for entry in entries:
+        if exclude and _matches(entry.name, exclude):
+            continue
+        try:
+            is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+            st = entry.stat(follow_symlinks=follow_symlinks)
+        except OSError:  # Broken symlinks and such.
+            continue
+        path = os.path.join(directory, entry.name)
+        if is_dir:
+            subdirs.append(path)
+        if not include or _matches(entry.name, include):
+            records.append((directory, entry.name, st.st_size,
+                            datetime.fromtimestamp(st.st_mtime), is_dir))
+    return records, subdirs
+
+def collect_files(root_dir=os.curdir, include=None, exclude=None,
+                  workers=8, follow_symlinks=False):
+    """ Yields (directory, name, size, mod_time, is_dir) for everything
+    under root_dir, directories included.
+    Each directory is listed on a thread pool, so slow (network) filesystems
+    have several listings in flight at once. Records come out in no
+    particular order.
+    include :: glob patterns a name has to match to be yielded.
+    exclude :: glob patterns for names to skip; excluded directories
+               aren't descended into. """
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    if isinstance(include, str):
+        include = (include,)
+    if isinstance(exclude, str):
+        exclude = (exclude,)
+    root_dir = os.path.normpath(root_dir)
+    if root_dir == os.curdir:
+        root_dir = ''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_scan_directory, root_dir, include, exclude,
+                               follow_symlinks)}
+        try:
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    records, subdirs = future.result()
+                    pending.update(pool.submit(_scan_directory, subdir, include,
+                                               exclude, follow_symlinks)
+                                   for subdir in subdirs)
+                    yield from records
+        finally:  # We might have been closed early.
+            for future in pending:
+                future.cancel()
+
+def split_path(path, root=os.curdir):
+    """ Returns (directory, name) for the path relative to root, the way
+    paths are stored: normalized, with '' for the root itself. """
+    rel = os.path.relpath(os.path.abspath(path), os.path.abspath(root))
+    directory, name = os.path.split(rel)
+    return directory, name
+
+def _get_file_properties(c, directory, name, cols=('directory', 'name')) -> 'Union[tuple, None]':
     """ All values: ("directory", "name", "size", "mod_time", "is_dir")
     `cols` is UNSAFE. """
     # WARNING: Yeah, I'm using the string input thing.
@@ -15,7 +88,7 @@ def _get_file_properties(c, directory, name, cols=('directory', 'name')) -> Unio
     return c.execute(f"""SELECT {', '.join(cols)} FROM files WHERE
             directory = ? AND name = ? LIMIT 1""", (directory, name)).fetchone()
 
-def _get_file_property(c, directory, name, col) -> Union[str, int, float, None]:
+def _get_file_property(c, directory, name, col) -> 'Union[str, int, float, None]':
     try:
         return _get_file_properties(c, directory, name, cols=(col,))[0]
     except IndexError:
@@ -25,6 +98,11 @@ def _get_file_from_id(c, id_, cols=('directory', 'name')):
     return c.execute(f"""SELECT {', '.join(cols)} FROM files WHERE
             id = ?""", (id_,)).fetchone()
 
+def _get_file_id(c, directory, name) -> 'Union[int, None]':
+    row = c.execute("SELECT id FROM files WHERE directory = ? AND name = ?",
+                    (directory, name)).fetchone()
+    return None if row is None else row[0]
+
 # Possibly public.
 def _get_file(c, directory, name):
     # TODO Take a look at what exactly I'm intending here.
@@ -32,27 +110,139 @@ def _get_file(c, directory, name):
     Can be replaced with a _file_exists thing. """
     return _get_file_properties(c, directory, name, cols=('directory', 'name'))
 
-def _add_file(c, directory, name):
-    """ Adds a file. Raises an IntegrityError if it already exists.
+def _stat_file(path):
+    """ Returns (size, mod_time, is_dir) for the path with a single stat. """
+    st = os.stat(path)
+    return (st.st_size, datetime.fromtimestamp(st.st_mtime),
+            stat.S_ISDIR(st.st_mode))
+
+def _get_dir_id(c, directory) -> 'Union[int, None]':
+    row = c.execute("SELECT id FROM directories WHERE path = ?",
+                    (directory,)).fetchone()
+    return None if row is None else row[0]
+
+def get_or_add_dir_id(c, directory, cache=None) -> int:
+    """ Returns the id of the directory, adding it and any of its parents
+    that are missing.
+    cache :: path -> id, checked first and filled in; a dict will do. """
+    if cache is not None:
+        dir_id = cache.get(directory)
+        if dir_id is not None:
+            return dir_id
+    dir_id = _get_dir_id(c, directory)
+    if dir_id is None:
+        parent, name = os.path.split(directory)
+        parent_id = get_or_add_dir_id(c, parent, cache) if parent != directory else None
+        dir_id = c.execute("""INSERT INTO directories (parent_id, name, path)
+                VALUES (?,?,?)""", (parent_id, name, directory)).lastrowid
+    if cache is not None:
+        cache[directory] = dir_id
+    return dir_id
+
+# A directory row that can go: nothing in it, and repair hasn't kept it
+# for its scan_mtime.
+_EMPTY_DIRECTORY = """directories.path != '' AND directories.scan_mtime IS NULL
+        AND NOT EXISTS (SELECT 1 FROM file_entries
+                        WHERE file_entries.dir_id = directories.id)
+        AND NOT EXISTS (SELECT 1 FROM directories child
+                        WHERE child.parent_id = directories.id)"""
+
+def delete_empty_dirs(c, dir_id) -> int:
+    """ Deletes the directory if it's empty, then its parent if that's
+    empty now, and so on up. Returns how many were deleted. """
+    deleted = 0
+    while dir_id is not None:
+        row = c.execute("SELECT parent_id FROM directories WHERE id = ? AND "
+                        + _EMPTY_DIRECTORY, (dir_id,)).fetchone()
+        if row is None:
+            break
+        c.execute("DELETE FROM directories WHERE id = ?", (dir_id,))
+        deleted += 1
+        dir_id = row[0]
+    return deleted
+
+def sweep_dirs(c) -> int:
+    """ Deletes every empty directory, a level of the tree per statement.
+    Returns how many were deleted. """
+    deleted = 0
+    while True:
+        count = c.execute("DELETE FROM directories WHERE " + _EMPTY_DIRECTORY).rowcount
+        if not count:
+            return deleted
+        deleted += count
+
+def _add_file(c, directory, name, with_hash=False, dir_cache=None):
+    """ Adds a file and returns its id.
+    Raises an IntegrityError if it already exists. Only reads the file's contents if `with_hash` is set.
     c :: Cursor. """
     path = os.path.join(directory, name)
-    size = round(os.stat(path).st_size, 6)
-    mod_time = datetime.fromtimestamp(os.stat(path).st_mtime)
-    is_dir = os.path.isdir(path)
-    c.execute("""INSERT INTO files (directory, name, size, mod_time, is_dir)
-                 VALUES (?,?,?,?,?)""",
-              (directory, name, size, mod_time, is_dir))
-    return
+    size, mod_time, is_dir = _stat_file(path)
+    hash_ = None
+    if with_hash and not is_dir:
+        from . import hashing
+        hash_ = hashing.hash_file(path)
+    dir_id = get_or_add_dir_id(c, directory, dir_cache)
+    return c.execute("""INSERT INTO file_entries
+                 (dir_id, name, size, mod_time, is_dir, hash)
+                 VALUES (?,?,?,?,?,?)""",
+              (dir_id, name, size, mod_time, is_dir, hash_)).lastrowid
+
+def add_files(c, records, chunk_size=10000):
+    """ Adds (directory, name, size, mod_time, is_dir) records, such as the
+    ones from `collect_files`. Files already in the database are skipped. """
+    dir_ids = {}
+    records = iter(records)
+    while True:
+        chunk = [(get_or_add_dir_id(c, d, dir_ids), n, size, mod_time, is_dir)
+                 for (d, n, size, mod_time, is_dir)
+                 in itertools.islice(records, chunk_size)]
+        if not chunk:
+            break
+        c.executemany("""INSERT OR IGNORE INTO file_entries
+                         (dir_id, name, size, mod_time, is_dir)
+                         VALUES (?,?,?,?,?)""", chunk)
 
 def delete_file(c, directory, name):
-    cmd_str = "DELETE FROM files WHERE directory = ? AND name = ?"
+    cmd_str = """DELETE FROM file_entries WHERE id =
+            (SELECT id FROM files WHERE directory = ? AND name = ?)"""
     c.execute(cmd_str, (directory, name))
 
-def get_or_add_file(c, directory, name, **kw) -> Union[tuple, None]:
+def files_under(c, directory, cols=('directory', 'name'), ids=None):
+    """ Returns a cursor over every file in the directory and the ones below
+    it, ordered by path. The directories are a range of the path index,
+    '' being everything.
+    ids :: (sql, params) selecting file ids to keep to, as from
+           `query.compile_ids`.
+    `cols` is UNSAFE. """
+    conditions, params = [], []
+    if directory != '':
+        # Everything that starts with directory + os.sep sorts between these.
+        prefix = directory + os.sep
+        conditions.append("(directory = ? OR (directory >= ? AND directory < ?))")
+        params += [directory, prefix, prefix[:-1] + chr(ord(os.sep) + 1)]
+    if ids is not None:
+        conditions.append("id IN (%s)" % ids[0])
+        params += ids[1]
+    where = "WHERE " + " AND ".join(conditions) if conditions else ""
+    return c.execute(f"""SELECT {', '.join(cols)} FROM files {where}
+            ORDER BY directory, name""", params)
+
+def get_or_add_file(c, directory, name, with_hash=False, **kw) -> 'Union[tuple, None]':
+    if with_hash:  # Don't read the whole file just to hit the constraint.
+        existing = _get_file(c, directory, name)
+        if existing is not None:
+            return existing
     try:
-        _add_file(c, directory, name)
+        _add_file(c, directory, name, with_hash)
     except sqlite3.IntegrityError:
         pass
     return _get_file(c, directory, name)
     #return c.execute("SELECT directory, name FROM files WHERE directory = ? AND name = ? LIMIT 1").fetchone()
 
+def get_or_add_file_id(c, directory, name, with_hash=False, dir_cache=None) -> int:
+    """ Like `get_or_add_file`, but returns the id, and only stats the file
+    if it isn't in the database yet. """
+    file_id = _get_file_id(c, directory, name)
+    if file_id is None:
+        file_id = _add_file(c, directory, name, with_hash, dir_cache)
+    return file_id
@@ -0,0 +1,96 @@
+""" hashing.py
+Content fingerprints for files, stored in `file_entries.hash`.
+
+Hashing is opt-in: tagging doesn't read file contents unless asked to.
+Small files are read through a fixed-size buffer in this process; large
+files are memory-mapped and hashed on a process pool. """
+import hashlib
+import mmap
+import os
+import os.path
+
+from . import fs
+
+
+CHUNK_SIZE = 1 << 20  # 1 MiB
+LARGE_FILE = 16 << 20  # Files at least this big go to the process pool.
+
+
+def hash_file(path, chunk_size=CHUNK_SIZE):
+    """ Returns the hex blake2b digest of the file's contents. """
+    digest = hashlib.blake2b()
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= chunk_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for start in range(0, size, chunk_size):
+                        digest.update(view[start:start+chunk_size])
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while True:
+                read = f.readinto(buf)
+                if not read:
+                    break
+                digest.update(view[:read])
+    return digest.hexdigest()
+
+
+def _hash_or_none(path):
+    try:
+        return hash_file(path)
+    except OSError:  # Vanished or unreadable.
+        return None
+
+
+def hash_files(paths_and_sizes, workers=None, large=LARGE_FILE):
+    """ Yields (path, digest) for each (path, size). Files of at least
+    `large` bytes are hashed on a process pool with `workers` processes.
+    The digest is None if the file couldn't be read. """
+    small, big = [], []
+    for (path, size) in paths_and_sizes:
+        (big if size >= large else small).append(path)
+    if big:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(path, pool.submit(_hash_or_none, path)) for path in big]
+            for path in small:  # Do the small ones while we wait.
+                yield (path, _hash_or_none(path))
+            for (path, future) in futures:
+                yield (path, future.result())
+    else:
+        for path in small:
+            yield (path, _hash_or_none(path))
+
+
+def fill_hashes(c, force=False, workers=None, large=LARGE_FILE):
+    """ Computes hashes for files in the database that need one, in a
+    single transaction. Files that already have a hash and whose size and
+    mod_time still match the stored row are skipped unless `force`.
+    Returns the number of rows updated. """
+    todo = {}
+    for (id_, d, n, size, mod_time, hash_) in c.execute("""SELECT id,
+            directory, name, size, mod_time, hash FROM files
+            WHERE NOT is_dir OR is_dir IS NULL""").fetchall():
+        path = os.path.join(d, n)
+        try:
+            stats = fs._stat_file(path)
+        except OSError:
+            continue
+        if not force and hash_ is not None and (size, mod_time) == stats[:2]:
+            continue
+        todo[path] = (id_, stats)
+    updates = []
+    for (path, digest) in hash_files(((path, stats[0]) for (path, (_, stats))
+                                      in todo.items()), workers, large):
+        if digest is not None:
+            id_, (size, mod_time, _) = todo[path]
+            updates.append((size, mod_time, digest, id_))
+    with c:
+        c.executemany("""UPDATE file_entries SET size = ?, mod_time = ?, hash = ?
+                WHERE id = ?""", updates)
+    return len(updates)
@@ -0,0 +1,258 @@
+""" query.py
+Parses tag predicates and compiles them into a single SQL statement.
+
+    (vacation or trip) and year=2018 and not blurry
+
+Terms are either `value` (an unkeyed tag), `key=value`, or `key=` (any tag
+with that key). They combine with `and`/`&` (also implied between adjacent
+terms), `or`/`|`, `not`/`!`/a leading `-`, and parentheses.
+
+Tags that are and-ed together are matched with a chain of junction
+lookups starting from the first one, so `run_query` puts the rarest tag
+first according to `tag_stats`. """
+import functools
+import re
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+_token_re = re.compile(r"\s*(\(|\)|&|\||!|[^\s()&|!]+)")
+_keywords = {'and': '&', 'or': '|', 'not': '!'}
+
+
+def tokenize(query_str):
+    tokens = []
+    pos = 0
+    query_str = query_str.rstrip()
+    while pos < len(query_str):
+        match = _token_re.match(query_str, pos)
+        if match is None:
+            raise QuerySyntaxError("Can't read query at %r." % query_str[pos:])
+        token = match.group(1)
+        token = _keywords.get(token.lower(), token)
+        if len(token) > 1 and token.startswith('-'):
+            tokens.extend(('!', token[1:]))
+        else:
+            tokens.append(token)
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    """ Recursive descent over the token list. Produces nested tuples:
+    ('tag', key, value), ('key', key), ('not', node),
+    ('and', [nodes]) and ('or', [nodes]). """
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            raise QuerySyntaxError("Empty query.")
+        node = self.parse_or()
+        if self.peek() is not None:
+            raise QuerySyntaxError("Unexpected %r." % self.peek())
+        return node
+
+    def parse_or(self):
+        nodes = [self.parse_and()]
+        while self.peek() == '|':
+            self.take()
+            nodes.append(self.parse_and())
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self):
+        nodes = [self.parse_not()]
+        while self.peek() not in (None, '|', ')'):
+            if self.peek() == '&':
+                self.take()
+            nodes.append(self.parse_not())
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_not(self):
+        if self.peek() == '!':
+            self.take()
+            return ('not', self.parse_not())
+        return self.parse_atom()
+
+    def parse_atom(self):
+        token = self.take()
+        if token == '(':
+            node = self.parse_or()
+            if self.take() != ')':
+                raise QuerySyntaxError("Unbalanced parentheses.")
+            return node
+        if token is None or token in ('&', '|', ')'):
+            raise QuerySyntaxError("Expected a tag, got %r." % token)
+        return parse_term(token)
+
+
+def parse_term(term):
+    """ `value`, `key=value` or `key=`. """
+    if '=' not in term:
+        return ('tag', '', term)
+    key, value = term.split('=', 1)
+    if value == '':
+        return ('key', key)
+    return ('tag', key, value)
+
+
+def parse(query_str):
+    return _Parser(tokenize(query_str)).parse()
+
+
+def _freeze(node):
+    """ Lists to tuples, so trees can be cache keys. """
+    if node[0] in ('and', 'or'):
+        return (node[0], tuple(_freeze(child) for child in node[1]))
+    if node[0] == 'not':
+        return ('not', _freeze(node[1]))
+    return node
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_frozen(query_str):
+    return _freeze(parse(query_str))
+
+
+def _estimate(c, node, prefix=''):
+    """ Roughly how many files the node matches. Only plain terms are
+    looked up; anything else goes last. """
+    from . import stats
+    if node[0] == 'tag':
+        return stats.tag_count(c, node[1], node[2], prefix)
+    if node[0] == 'key':
+        return stats.key_count(c, node[1], prefix)
+    return float('inf')
+
+
+def order_by_rarity(c, node, prefix=''):
+    """ Sorts the terms of every `and` rarest first, by the statistics of
+    the tables named with `prefix`. """
+    kind = node[0]
+    if kind == 'not':
+        return ('not', order_by_rarity(c, node[1], prefix))
+    if kind == 'or':
+        return ('or', tuple(order_by_rarity(c, child, prefix) for child in node[1]))
+    if kind == 'and':
+        children = [order_by_rarity(c, child, prefix) for child in node[1]]
+        return ('and', tuple(sorted(children, key=lambda n: _estimate(c, n, prefix))))
+    return node
+
+
+def _join_tags(tag_nodes, prefix=''):
+    """ Files with every one of the tags. SQLite walks the junction rows of
+    the first tag and checks each file against the others by primary key;
+    CROSS JOIN stops it from picking a different order. """
+    tables = ["%sfiletag_junction j0" % prefix]
+    conditions, params = [], []
+    for (i, (_, key, value)) in enumerate(tag_nodes):
+        if i:
+            tables.append("%sfiletag_junction j%d" % (prefix, i))
+            conditions.append("j%d.file_id = j0.file_id" % i)
+        conditions.append("j%d.tag_id = (SELECT id FROM %stags "
+                          "WHERE key = ? AND value = ?)" % (i, prefix))
+        params += [key, value]
+    return ("SELECT j0.file_id FROM %s WHERE %s"
+            % (' CROSS JOIN '.join(tables), ' AND '.join(conditions)), params)
+
+
+def _compile_node(node, prefix=''):
+    """ Returns (sql, params, is_compound). The SQL selects one column of
+    file ids from the tables named with `prefix`, e.g. 'db1.', if any. """
+    kind = node[0]
+    if kind == 'tag':
+        return ("SELECT file_id FROM {0}filetag_junction WHERE tag_id = "
+                "(SELECT id FROM {0}tags WHERE key = ? AND value = ?)".format(prefix),
+                [node[1], node[2]], False)
+    if kind == 'key':
+        return ("SELECT file_id FROM {0}filetag_junction WHERE tag_id IN "
+                "(SELECT id FROM {0}tags WHERE key = ?)".format(prefix),
+                [node[1]], False)
+    if kind == 'not':
+        sql, params = _operand(node[1], prefix)
+        return ("SELECT id FROM %sfiles EXCEPT %s" % (prefix, sql), params, True)
+    if kind == 'or':
+        parts = [_operand(child, prefix) for child in node[1]]
+        return (' UNION '.join(sql for (sql, _) in parts),
+                [p for (_, params) in parts for p in params], True)
+    # 'and': join the tags, intersect that with the other positive
+    # operands, then subtract the negated ones.
+    positives = [child for child in node[1] if child[0] != 'not']
+    negatives = [child[1] for child in node[1] if child[0] == 'not']
+    tag_nodes = [child for child in positives if child[0] == 'tag']
+    if len(tag_nodes) > 1:
+        first = positives.index(tag_nodes[0])
+        positives = [child for child in positives if child[0] != 'tag']
+        positives.insert(first, ('tags', tag_nodes))
+    if positives:
+        parts = [_join_tags(child[1], prefix) if child[0] == 'tags'
+                 else _operand(child, prefix) for child in positives]
+        sql = ' INTERSECT '.join(sql for (sql, _) in parts)
+        params = [p for (_, params) in parts for p in params]
+    else:
+        sql, params = "SELECT id FROM %sfiles" % prefix, []
+    for child in negatives:
+        child_sql, child_params = _operand(child, prefix)
+        sql += ' EXCEPT ' + child_sql
+        params += child_params
+    return (sql, params, True)
+
+
+def _operand(node, prefix=''):
+    """ SQLite doesn't allow parenthesized compound selects as operands, so
+    compound children are wrapped in a subquery. """
+    sql, params, is_compound = _compile_node(node, prefix)
+    if is_compound:
+        sql = "SELECT * FROM (%s)" % sql
+    return sql, params
+
+
+@functools.lru_cache(maxsize=256)
+def compile_tree(tree, cols=('directory', 'name')):
+    """ Returns (sql, params) selecting `cols` of every file matching the
+    (frozen) parse tree. `cols` is UNSAFE. """
+    sql, params, _ = _compile_node(tree)
+    return ("SELECT %s FROM files WHERE id IN (%s) ORDER BY directory, name"
+            % (', '.join(cols), sql), tuple(params))
+
+
+def compile_query(query_str, cols=('directory', 'name')):
+    """ Returns (sql, params) selecting `cols` of every matching file, with
+    the terms in the order they were written. Cached by query string. """
+    return compile_tree(_parse_frozen(query_str), cols)
+
+
+def compile_ids(c, query_str):
+    """ Returns (sql, params) selecting just the ids of the matching files,
+    rarest tags first, for use inside a bigger query. """
+    sql, params, _ = _compile_node(order_by_rarity(c, _parse_frozen(query_str)))
+    return sql, params
+
+
+def compile_ids_in(c, schema, query_str):
+    """ Like `compile_ids`, but against the database attached to c as
+    `schema`, by its own statistics. One without a tag_stats table keeps
+    the terms in the order they were written. `schema` is UNSAFE. """
+    tree = _parse_frozen(query_str)
+    if c.execute("SELECT 1 FROM %s.sqlite_master WHERE type = 'table' "
+                 "AND name = 'tag_stats'" % schema).fetchone():
+        tree = order_by_rarity(c, tree, schema + '.')
+    sql, params, _ = _compile_node(tree, schema + '.')
+    return sql, params
+
+
+def run_query(c, query_str, cols=('directory', 'name')):
+    """ Like `compile_query`, but with the rarest tags first. """
+    tree = order_by_rarity(c, _parse_frozen(query_str))
+    return c.execute(*compile_tree(tree, cols))
@@ -0,0 +1,243 @@
+""" repair.py
+Brings the files table back in line with the filesystem.
+
+Directory modification times are kept in `directories.scan_mtime`. A repair stats
+each of those directories and only lists the ones whose mtime changed,
+plus any new directories found inside them. Files that vanished are
+matched up with files that appeared by (size, mod_time), or by content
+hash where one is stored, so a moved file keeps its row, and with it its
+tags.
+
+Editing a file in place doesn't touch its directory's mtime, so use
+`full=True` to catch those. `repair_directories` and `apply_moves` are
+the same thing for callers that already know what changed, such as the
+watcher. Paths are relative to the current directory, same as when
+tagging. """
+import os
+import os.path
+import stat
+from collections import defaultdict, namedtuple
+from datetime import datetime
+
+from . import fs, hashing
+
+
+Report = namedtuple('Report', ['moved', 'modified', 'missing'])
+
+
+def _dir_mtime(directory):
+    """ Returns None if the directory is gone. """
+    try:
+        st = os.stat(directory or os.curdir)
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return None
+    return datetime.fromtimestamp(st.st_mtime)
+
+
+def _under(directory, root):
+    return root == '' or directory == root or directory.startswith(root + os.sep)
+
+
+def _list_directories(scanned, known_dirs, root, full):
+    """ Returns (listings, dir_mtimes).
+    listings :: {directory: records} for every directory we looked inside.
+    dir_mtimes :: {directory: mod_time} for every directory that exists. """
+    listings = {}
+    dir_mtimes = {}
+    walk_roots = []
+    if full or not scanned:
+        walk_roots.append(root)
+        listings[root] = []
+        mod_time = _dir_mtime(root)
+        if mod_time is not None:
+            dir_mtimes[root] = mod_time
+    else:
+        for directory in set(scanned) | known_dirs:
+            mod_time = _dir_mtime(directory)
+            if mod_time is None:
+                continue
+            dir_mtimes[directory] = mod_time
+            if mod_time != scanned.get(directory):
+                records, subdirs = fs._scan_directory(directory, None, None, False)
+                listings[directory] = records
+                walk_roots.extend(d for d in subdirs
+                                  if d not in scanned and d not in known_dirs)
+        for top in walk_roots:
+            listings.setdefault(top, [])
+    for top in walk_roots:
+        for record in fs.collect_files(top):
+            listings.setdefault(record[0], []).append(record)
+    for records in list(listings.values()):
+        for (d, n, _, mod_time, is_dir) in records:
+            if is_dir:
+                path = os.path.join(d, n)
+                dir_mtimes.setdefault(path, mod_time)
+                if full or not scanned:
+                    listings.setdefault(path, [])
+    return listings, dir_mtimes
+
+
+def _match_moves(vanished, candidates):
+    """ Pairs each vanished row with the one candidate record that has the
+    same (size, mod_time). Rows with a stored hash that don't pair up that
+    way are compared against the contents of same-sized candidates.
+    Ambiguous matches are left alone. """
+    by_key = defaultdict(list)
+    for record in candidates:
+        by_key[(record[2], record[3])].append(record)
+    vanished_keys = defaultdict(int)
+    for row in vanished:
+        vanished_keys[(row[3], row[4])] += 1
+    moved, unmatched = [], []
+    claimed = set()
+    for row in vanished:
+        key = (row[3], row[4])
+        if None not in key and vanished_keys[key] == 1 and len(by_key[key]) == 1:
+            moved.append((row, by_key[key][0]))
+            claimed.add(by_key[key][0][:2])
+        else:
+            unmatched.append(row)
+    by_size = defaultdict(list)
+    for record in candidates:
+        if not record[4] and record[:2] not in claimed:
+            by_size[record[2]].append(record)
+    digests = {}
+    missing = []
+    for row in unmatched:
+        matches = []
+        if row[5] is not None:
+            for record in by_size[row[3]]:
+                if record[:2] in claimed:
+                    continue
+                if record[:2] not in digests:
+                    digests[record[:2]] = hashing._hash_or_none(
+                            os.path.join(*record[:2]))
+                if digests[record[:2]] == row[5]:
+                    matches.append(record)
+        if len(matches) == 1:
+            moved.append((row, matches[0]))
+            claimed.add(matches[0][:2])
+        else:
+            missing.append(row)
+    return moved, missing
+
+
+def repair(c, root_dir=os.curdir, full=False):
+    """ Detects moved, modified and missing files under root_dir and updates
+    their rows in a single transaction. Missing files are only reported.
+    Returns a Report of paths: moved as (old, new) pairs. """
+    root = os.path.normpath(root_dir)
+    if root == os.curdir:
+        root = ''
+    known = defaultdict(dict)
+    for row in c.execute(
+            "SELECT id, directory, name, size, mod_time, hash FROM files"):
+        if _under(row[1], root):
+            known[row[1]][row[2]] = row
+    scanned = {d: mod_time for (d, mod_time) in c.execute("""SELECT path,
+                   scan_mtime FROM directories WHERE scan_mtime IS NOT NULL""")
+               if _under(d, root)}
+    listings, dir_mtimes = _list_directories(scanned, set(known), root, full)
+    return _reconcile(c, known, listings, dir_mtimes, scanned)
+
+
+def _reconcile(c, known, listings, dir_mtimes, looked_at):
+    """ Compares the rows in `known` ({directory: {name: row}}) with the
+    `listings` and updates them, along with the scan_mtime of every
+    directory in `dir_mtimes`, and clears it for those in `looked_at` that
+    have gone. Rows in a directory that was neither listed nor found
+    are taken to have vanished. """
+    vanished, modified, modified_paths, candidates = [], [], [], []
+    for directory, records in listings.items():
+        rows = known.get(directory, {})
+        for record in records:
+            (_, n, size, mod_time, is_dir) = record
+            if n not in rows:
+                candidates.append(record)
+            elif (size, mod_time) != rows[n][3:5]:
+                modified.append((size, mod_time, is_dir, rows[n][0]))
+                modified_paths.append(os.path.join(directory, n))
+        present = set(record[1] for record in records)
+        vanished.extend(row for (n, row) in rows.items() if n not in present)
+    for directory, rows in known.items():
+        if directory not in listings and directory not in dir_mtimes:
+            vanished.extend(rows.values())
+    moved, missing = _match_moves(vanished, candidates)
+
+    with c:
+        dir_ids = {}
+        c.executemany("""UPDATE file_entries SET dir_id = ?, name = ?, size = ?,
+                mod_time = ?, is_dir = ? WHERE id = ?""",
+                [(fs.get_or_add_dir_id(c, record[0], dir_ids), *record[1:], row[0])
+                 for (row, record) in moved])
+        c.executemany("""UPDATE file_entries SET size = ?, mod_time = ?,
+                is_dir = ?, hash = NULL WHERE id = ?""", modified)
+        c.executemany("UPDATE directories SET scan_mtime = NULL WHERE path = ?",
+                      [(d,) for d in looked_at if d not in dir_mtimes])
+        c.executemany("UPDATE directories SET scan_mtime = ? WHERE id = ?",
+                      [(mod_time, fs.get_or_add_dir_id(c, d, dir_ids))
+                       for (d, mod_time) in dir_mtimes.items()])
+
+    return Report(
+        moved=[(os.path.join(*row[1:3]), os.path.join(*record[:2]))
+               for (row, record) in moved],
+        modified=modified_paths,
+        missing=[os.path.join(*row[1:3]) for row in missing])
+
+
+def repair_directories(c, directories):
+    """ Like `repair`, but only lists the given directories and not what's
+    below them, for when something else knows where things changed.
+    Moves are matched up among these directories. Returns a Report. """
+    directories = set(directories)
+    known = defaultdict(dict)
+    for directory in directories:
+        for row in c.execute("""SELECT id, directory, name, size, mod_time, hash
+                FROM files WHERE directory = ?""", (directory,)):
+            known[directory][row[2]] = row
+    listings, dir_mtimes = {}, {}
+    for directory in directories:
+        mod_time = _dir_mtime(directory)
+        if mod_time is not None:
+            dir_mtimes[directory] = mod_time
+            listings[directory] = fs._scan_directory(directory, None, None, False)[0]
+    return _reconcile(c, known, listings, dir_mtimes, directories)
+
+
+def apply_moves(c, moves):
+    """ Moves the rows for each (old, new) pair of paths, in order, and the
+    rows under `old` too when it's a directory: renames that were seen
+    happening, so there's nothing to match up. A row already at the new
+    path was for a file the rename replaced, and is dropped along with its
+    relations. Paths without rows are skipped. Returns a Report. """
+    moved = []
+    dir_ids = {}
+    with c:
+        for (old, new) in moves:
+            rows = [(fs._get_file_id(c, *os.path.split(old)), old, new)]
+            if old != '':
+                rows += [(id_, os.path.join(d, n), os.path.join(new + d[len(old):], n))
+                         for (id_, d, n) in fs.files_under(
+                             c, old, ('id', 'directory', 'name')).fetchall()]
+            for (file_id, src, dest) in rows:
+                if file_id is None:
+                    continue
+                directory, name = os.path.split(dest)
+                replaced = fs._get_file_id(c, directory, name)
+                if replaced is not None and replaced != file_id:
+                    _drop_file(c, replaced)
+                c.execute("UPDATE file_entries SET dir_id = ?, name = ? WHERE id = ?",
+                          (fs.get_or_add_dir_id(c, directory, dir_ids), name, file_id))
+                moved.append((src, dest))
+    return Report(moved=moved, modified=[], missing=[])
+
+
+def _drop_file(c, file_id):
+    tag_ids = [(tag_id,) for (tag_id,) in c.execute(
+        "SELECT tag_id FROM filetag_junction WHERE file_id = ?", (file_id,))]
+    c.execute("DELETE FROM filetag_junction WHERE file_id = ?", (file_id,))
+    c.execute("DELETE FROM file_entries WHERE id = ?", (file_id,))
+    c.executemany("""DELETE FROM tags WHERE id = ? AND NOT EXISTS
+            (SELECT 1 FROM filetag_junction WHERE tag_id = tags.id)""", tag_ids)
@@ -1,15 +1,80 @@
+DROP VIEW IF EXISTS files;
 DROP TABLE IF EXISTS files;
-CREATE TABLE files (
+DROP TABLE IF EXISTS scanned_dirs;
+DROP TABLE IF EXISTS directories;
+DROP TABLE IF EXISTS file_entries;
+DROP TABLE IF EXISTS tags;
+DROP TABLE IF EXISTS filetag_junction;
+DROP TABLE IF EXISTS tag_stats;
+DROP TABLE IF EXISTS tag_cooccurrence;
+DROP TABLE IF EXISTS changes;
+DROP TABLE IF EXISTS sync_state;
+
+CREATE TABLE directories (
+    id integer PRIMARY KEY,
+    parent_id integer,
+    name text NOT NULL,
+    path text NOT NULL UNIQUE,
+    scan_mtime timestamp
+);
+
+CREATE INDEX directories_parent_idx ON directories (parent_id);
+
+INSERT OR IGNORE INTO directories (id, parent_id, name, path) VALUES (1, NULL, '', '');
+
+CREATE TABLE file_entries (
     id integer PRIMARY KEY,
-    directory text NOT NULL,
+    dir_id integer NOT NULL REFERENCES directories (id),
     name text NOT NULL,
     size integer,
     mod_time timestamp,
     is_dir boolean,
-    CONSTRAINT path UNIQUE (directory, name)
+    hash text,
+    CONSTRAINT path UNIQUE (dir_id, name)
 );
+CREATE INDEX files_hash_idx ON file_entries (hash);
+
+CREATE VIEW files AS
+    SELECT file_entries.id AS id, directories.path AS directory,
+           file_entries.name AS name, file_entries.size AS size,
+           file_entries.mod_time AS mod_time, file_entries.is_dir AS is_dir,
+           file_entries.hash AS hash
+    FROM file_entries
+    INNER JOIN directories ON directories.id = file_entries.dir_id;
+
+CREATE TRIGGER files_insert INSTEAD OF INSERT ON files
+BEGIN
+    INSERT OR IGNORE INTO directories (parent_id, name, path) VALUES (
+        (SELECT id FROM directories WHERE path = rtrim(rtrim(NEW.directory,
+            replace(NEW.directory, '/', '')), '/')),
+        substr(NEW.directory, length(rtrim(NEW.directory,
+            replace(NEW.directory, '/', ''))) + 1),
+        NEW.directory);
+    INSERT INTO file_entries (id, dir_id, name, size, mod_time, is_dir, hash)
+        VALUES (NEW.id, (SELECT id FROM directories WHERE path = NEW.directory),
+                NEW.name, NEW.size, NEW.mod_time, NEW.is_dir, NEW.hash);
+END;
+
+CREATE TRIGGER files_update INSTEAD OF UPDATE ON files
+BEGIN
+    INSERT OR IGNORE INTO directories (parent_id, name, path) VALUES (
+        (SELECT id FROM directories WHERE path = rtrim(rtrim(NEW.directory,
+            replace(NEW.directory, '/', '')), '/')),
+        substr(NEW.directory, length(rtrim(NEW.directory,
+            replace(NEW.directory, '/', ''))) + 1),
+        NEW.directory);
+    UPDATE file_entries SET id = NEW.id,
+        dir_id = (SELECT id FROM directories WHERE path = NEW.directory),
+        name = NEW.name, size = NEW.size, mod_time = NEW.mod_time,
+        is_dir = NEW.is_dir, hash = NEW.hash
+    WHERE id = OLD.id;
+END;
+
+CREATE TRIGGER files_delete INSTEAD OF DELETE ON files
+BEGIN
+    DELETE FROM file_entries WHERE id = OLD.id;
+END;
 
-DROP TABLE IF EXISTS tags;
 CREATE TABLE tags (
     id integer PRIMARY KEY,
     key text DEFAULT '' NOT NULL,
@@ -17,12 +82,117 @@ CREATE TABLE tags (
     CONSTRAINT tag_pk UNIQUE (key, value)
 );
 
-DROP TABLE IF EXISTS filetag_junction;
 CREATE TABLE filetag_junction (
     file_id int, tag_id int,
     CONSTRAINT file_tag_pk PRIMARY KEY (file_id, tag_id),
     CONSTRAINT FK_files
-    FOREIGN KEY (file_id) REFERENCES files (id),
+    FOREIGN KEY (file_id) REFERENCES file_entries (id),
     CONSTRAINT FK_tags
     FOREIGN KEY (tag_id) REFERENCES tags (id)
+) WITHOUT ROWID;
+
+CREATE INDEX junction_tag_idx ON filetag_junction (tag_id, file_id);
+
+CREATE TABLE tag_stats (
+    tag_id integer PRIMARY KEY,
+    file_count integer NOT NULL DEFAULT 0
 );
+
+CREATE TABLE tag_cooccurrence (
+    tag_a integer, tag_b integer,
+    file_count integer NOT NULL,
+    PRIMARY KEY (tag_a, tag_b)
+) WITHOUT ROWID;
+
+CREATE TRIGGER tag_insert_stats AFTER INSERT ON tags
+BEGIN
+    INSERT INTO tag_stats (tag_id) VALUES (NEW.id);
+END;
+
+CREATE TRIGGER junction_insert_stats AFTER INSERT ON filetag_junction
+BEGIN
+    UPDATE tag_stats SET file_count = file_count + 1 WHERE tag_id = NEW.tag_id;
+END;
+
+CREATE TRIGGER junction_delete_stats AFTER DELETE ON filetag_junction
+BEGIN
+    UPDATE tag_stats SET file_count = file_count - 1 WHERE tag_id = OLD.tag_id;
+END;
+
+CREATE TRIGGER tag_delete_stats AFTER DELETE ON tags
+BEGIN
+    DELETE FROM tag_stats WHERE tag_id = OLD.id;
+    DELETE FROM tag_cooccurrence WHERE tag_a = OLD.id OR tag_b = OLD.id;
+END;
+
+CREATE TABLE changes (
+    seq integer PRIMARY KEY AUTOINCREMENT,
+    kind text NOT NULL,
+    op text NOT NULL,
+    file_id integer,
+    tag_id integer,
+    path text
+);
+
+CREATE TABLE sync_state (
+    consumer text PRIMARY KEY,
+    seq integer NOT NULL
+);
+
+CREATE TRIGGER junction_insert_journal AFTER INSERT ON filetag_junction
+BEGIN
+    INSERT INTO changes (kind, op, file_id, tag_id)
+        VALUES ('filetag', 'insert', NEW.file_id, NEW.tag_id);
+END;
+
+CREATE TRIGGER junction_delete_journal AFTER DELETE ON filetag_junction
+BEGIN
+    INSERT INTO changes (kind, op, file_id, tag_id, path)
+        VALUES ('filetag', 'delete', OLD.file_id, OLD.tag_id,
+                (SELECT CASE directory WHEN '' THEN name
+                        ELSE directory || '/' || name END
+                 FROM files WHERE id = OLD.file_id));
+END;
+
+CREATE TRIGGER file_insert_journal AFTER INSERT ON file_entries
+BEGIN
+    INSERT INTO changes (kind, op, file_id) VALUES ('file', 'insert', NEW.id);
+END;
+
+CREATE TRIGGER file_update_journal AFTER UPDATE ON file_entries
+WHEN OLD.id IS NOT NEW.id OR OLD.dir_id IS NOT NEW.dir_id
+  OR OLD.name IS NOT NEW.name OR OLD.size IS NOT NEW.size
+  OR OLD.mod_time IS NOT NEW.mod_time OR OLD.is_dir IS NOT NEW.is_dir
+  OR OLD.hash IS NOT NEW.hash
+BEGIN
+    INSERT INTO changes (kind, op, file_id, path)
+        VALUES ('file', 'update', NEW.id,
+                (SELECT CASE path WHEN '' THEN OLD.name
+                        ELSE path || '/' || OLD.name END
+                 FROM directories WHERE id = OLD.dir_id));
+END;
+
+CREATE TRIGGER file_delete_journal AFTER DELETE ON file_entries
+BEGIN
+    INSERT INTO changes (kind, op, file_id, path)
+        VALUES ('file', 'delete', OLD.id,
+                (SELECT CASE path WHEN '' THEN OLD.name
+                        ELSE path || '/' || OLD.name END
+                 FROM directories WHERE id = OLD.dir_id));
+END;
+
+CREATE TRIGGER tag_insert_journal AFTER INSERT ON tags
+BEGIN
+    INSERT INTO changes (kind, op, tag_id) VALUES ('tag', 'insert', NEW.id);
+END;
+
+CREATE TRIGGER tag_update_journal AFTER UPDATE ON tags
+WHEN OLD.key IS NOT NEW.key OR OLD.value IS NOT NEW.value
+BEGIN
+    INSERT INTO changes (kind, op, tag_id) VALUES ('tag', 'update', NEW.id);
+END;
+
+CREATE TRIGGER tag_delete_journal AFTER DELETE ON tags
+BEGIN
+    INSERT INTO changes (kind, op, tag_id) VALUES ('tag', 'delete', OLD.id);
+END;
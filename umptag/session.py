@@ -0,0 +1,240 @@
+""" session.py
+The "Connected class" sketched in filetags: one object that holds a
+connection and exposes the public operations without the caller having to
+pass it around.
+
+Opening a connection means finding the database and checking its schema,
+so a Session does that once instead of once per action. The single-tag
+paths work on ids and always issue the same SQL text, which keeps them in
+sqlite3's prepared statement cache; `cached_statements` sets its size. """
+import os
+from collections import OrderedDict
+
+from . import api, database, filetags, fs, hashing, query, repair, tags
+
+
+def _split_tag(key, value):
+    """ A lone tag is an unkeyed tag, as in `api.apply_tag`. """
+    if value is None and key != '':
+        key, value = '', key
+    return key, value
+
+
+class TagCache:
+    """ A least-recently-used map of (key, value) -> tag id. """
+    def __init__(self, size=1024):
+        self.size = size
+        self._ids = OrderedDict()
+
+    def get(self, key, value):
+        tag_id = self._ids.get((key, value))
+        if tag_id is not None:
+            self._ids.move_to_end((key, value))
+        return tag_id
+
+    def put(self, key, value, tag_id):
+        self._ids[(key, value)] = tag_id
+        self._ids.move_to_end((key, value))
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+    def discard(self, key, value):
+        self._ids.pop((key, value), None)
+
+    def clear(self):
+        self._ids.clear()
+
+
+class DirCache:
+    """ A least-recently-used map of directory path -> directory id, in the
+    shape `fs.get_or_add_dir_id` wants. """
+    def __init__(self, size=4096):
+        self.size = size
+        self._ids = OrderedDict()
+
+    def get(self, path):
+        dir_id = self._ids.get(path)
+        if dir_id is not None:
+            self._ids.move_to_end(path)
+        return dir_id
+
+    def __setitem__(self, path, dir_id):
+        self._ids[path] = dir_id
+        self._ids.move_to_end(path)
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+
+    def clear(self):
+        self._ids.clear()
+
+
+class Session:
+    """ Go through the Session for anything that deletes tags, or its tag id
+    cache will go stale.
+    With `deferred_cleanup`, removing a tag only touches the junction, and
+    orphaned tags and files are swept up in one go on commit. """
+    def __init__(self, db_name=database.DEFAULT_DB_NAME, conn=None,
+                 cached_statements=256, fail_if_uninitialized=False,
+                 tag_cache_size=1024, deferred_cleanup=False, pragmas=None,
+                 dir_cache_size=4096):
+        if conn is None:
+            conn = database.get_conn(db_name, fail_if_uninitialized,
+                                     cached_statements=cached_statements,
+                                     pragmas=pragmas)
+        self.conn = conn
+        self.tag_cache = TagCache(tag_cache_size)
+        self.dir_cache = DirCache(dir_cache_size)
+        self.deferred_cleanup = deferred_cleanup
+        self._needs_sweep = False
+        self._data_version = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        self.close()
+
+    def commit(self):
+        if self._needs_sweep:
+            self.sweep_orphans()
+        self.conn.commit()
+
+    def rollback(self):
+        """ Tags and directories added in the transaction are gone, so are
+        their ids. """
+        self.conn.rollback()
+        self.tag_cache.clear()
+        self.dir_cache.clear()
+        self._needs_sweep = False
+
+    def sweep_orphans(self):
+        out = filetags.sweep_orphans(self.conn)
+        self.tag_cache.clear()
+        self.dir_cache.clear()
+        self._needs_sweep = False
+        return out
+
+    def refresh(self):
+        """ Drops the cached ids if another connection has committed
+        since we last looked, because it might have deleted some tags.
+        For long-lived sessions, like the daemon's. """
+        version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self.tag_cache.clear()
+            self.dir_cache.clear()
+            self._data_version = version
+
+    def close(self):
+        self.conn.close()
+
+    # Tag ids.
+    def tag_id(self, key, value, add=False):
+        """ Returns None if the tag doesn't exist and `add` isn't set. """
+        tag_id = self.tag_cache.get(key, value)
+        if tag_id is None:
+            if add:
+                tag_id = tags.get_or_add_tag_id(self.conn, key, value)
+            else:
+                tag_id = tags._get_tag_id(self.conn, key, value)
+            if tag_id is not None:
+                self.tag_cache.put(key, value, tag_id)
+        return tag_id
+
+    def delete_tag(self, key='', value=None):
+        key, value = _split_tag(key, value)
+        tags.delete_tag(self.conn, key, value)
+        self.tag_cache.discard(key, value)
+
+    # Tagging.
+    def apply_tag(self, directory, name, key='', value=None):
+        """ Returns 1 if the file already had the tag, like `api.apply_tag`. """
+        key, value = _split_tag(key, value)
+        file_id = fs.get_or_add_file_id(self.conn, directory, name,
+                                        dir_cache=self.dir_cache)
+        tag_id = self.tag_id(key, value, add=True)
+        return 0 if filetags._relate_ids(self.conn, file_id, tag_id) else 1
+
+    def apply_tags_bulk(self, pairs, chunk_size=10000):
+        return api.apply_tags_bulk(self.conn, pairs, chunk_size)
+
+    def remove_tag(self, directory, name, key='', value=None):
+        key, value = _split_tag(key, value)
+        file_id = fs._get_file_id(self.conn, directory, name)
+        tag_id = self.tag_id(key, value)
+        if (file_id is None or tag_id is None
+                or not filetags._unrelate_ids(self.conn, file_id, tag_id)):
+            return 1
+        if self.deferred_cleanup:
+            self._needs_sweep = True
+            return 0
+        tag_deleted, file_deleted = filetags._clean_orphan_ids(
+                self.conn, file_id, tag_id)
+        if tag_deleted:
+            self.tag_cache.discard(key, value)
+        if file_deleted:  # Its directories might have gone with it.
+            self.dir_cache.clear()
+        return 0
+
+    def remove_tags_bulk(self, pairs, chunk_size=10000):
+        out = api.remove_tags_bulk(self.conn, pairs, chunk_size)
+        self.tag_cache.clear()
+        self.dir_cache.clear()
+        return out
+
+    def remove_tags(self, directory, name, *args, **kwargs):
+        results = [self.remove_tag(directory, name, arg) for arg in args]
+        results += [self.remove_tag(directory, name, k, v)
+                    for (k, v) in kwargs.items()]
+        return 1 if any(results) else 0
+
+    def merge_tag(self, primary_key='', primary_value=None,
+                  secondary_key='', secondary_value=None):
+        out = api.merge_tag(self.conn, primary_key, primary_value,
+                            secondary_key, secondary_value)
+        self.tag_cache.discard(*_split_tag(secondary_key, secondary_value))
+        return out
+
+    def merge_tags(self, destination, sources):
+        sources = list(sources)
+        out = api.merge_tags(self.conn, destination, sources)
+        for (key, value) in sources:
+            self.tag_cache.discard(key, value)
+        return out
+
+    def clean_orphans(self, directory, name, key='', value=None):
+        key, value = _split_tag(key, value)
+        filetags.clean_orphans(self.conn, directory, name, key, value)
+        self.tag_cache.discard(key, value)
+
+    # Looking things up.
+    def tags_of_file(self, directory, name):
+        return filetags.tags_of_file(self.conn, directory, name)
+
+    def files_of_tag(self, key='', value=None):
+        return filetags.files_of_tag(self.conn, *_split_tag(key, value))
+
+    def iter_tags_of_file(self, directory, name, batch_size=1000):
+        return filetags.iter_tags_of_file(self.conn, directory, name,
+                                          batch_size=batch_size)
+
+    def iter_files_of_tag(self, key='', value=None, batch_size=1000):
+        return filetags.iter_files_of_tag(self.conn, *_split_tag(key, value),
+                                          batch_size=batch_size)
+
+    def has_tag(self, directory, name, key='', value=None):
+        return filetags.file_has_tag(self.conn, directory, name,
+                                     *_split_tag(key, value))
+
+    def query(self, query_str):
+        return query.run_query(self.conn, query_str).fetchall()
+
+    # Maintenance.
+    def repair(self, root_dir=os.curdir, full=False):
+        return repair.repair(self.conn, root_dir, full)
+
+    def fill_hashes(self, force=False, workers=None):
+        return hashing.fill_hashes(self.conn, force, workers)
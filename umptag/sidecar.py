@@ -0,0 +1,231 @@
+""" sidecar.py
+Mirrors each file's tags onto the file itself, for tools that don't read
+the database: as JSON in the `user.umptag.tags` extended attribute, or,
+where the filesystem (or platform) won't take one, in a `.umptag-tags`
+JSON file in the file's directory that maps names to their tags.
+
+    [["", "vacation"], ["year", "2018"]]
+
+`sync` only rewrites the files whose tags have changed, or that have
+moved, since the last sync, going by the `changes` journal, and records
+how far it got in `sync_state`. `import_tags` goes the other way, adding whatever tags it
+finds on disk to the database. Paths are relative to the current
+directory, as when tagging. """
+import errno
+import itertools
+import json
+import os
+import os.path
+from collections import defaultdict
+
+from . import api, filetags
+
+
+XATTR = 'user.umptag.tags'
+SIDECAR_NAME = '.umptag-tags'
+CONSUMER = 'sidecar'
+MODES = ('auto', 'xattr', 'sidecar')
+
+
+def _encode(tags):
+    return json.dumps(sorted(tags), separators=(',', ':'))
+
+
+def read_sidecar(directory):
+    """ Returns {name: [[key, value], ...]}; empty if there's no sidecar. """
+    try:
+        with open(os.path.join(directory, SIDECAR_NAME), encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+class _Sidecars:
+    """ Edits to sidecar files, saved up and written a directory at a time. """
+    def __init__(self):
+        self.edits = defaultdict(dict)  # directory -> {name: tags or None}
+
+    def set(self, directory, name, tags):
+        self.edits[directory][name] = tags or None
+
+    def flush(self):
+        for directory, edits in self.edits.items():
+            path = os.path.join(directory, SIDECAR_NAME)
+            entries = read_sidecar(directory)
+            before = len(entries)
+            for name, tags in edits.items():
+                if tags is None:
+                    entries.pop(name, None)
+                else:
+                    entries[name] = sorted(tags)
+            if entries:
+                tmp = path + '.tmp'
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(entries, f, sort_keys=True)
+                os.replace(tmp, path)
+            elif before or os.path.exists(path):
+                os.remove(path)
+        self.edits.clear()
+
+
+def _set_xattr(path, tags):
+    """ Returns False if the file exists but can't take the attribute. """
+    try:
+        if tags:
+            os.setxattr(path, XATTR, _encode(tags).encode('utf-8'))
+        else:
+            try:
+                os.removexattr(path, XATTR)
+            except OSError as e:
+                if e.errno != errno.ENODATA:
+                    raise
+    except FileNotFoundError:
+        return True  # Nothing to tag; the journal will catch up with it.
+    except OSError as e:
+        if _unsupported(e):
+            return False
+        raise
+    return True
+
+
+def _unsupported(e):
+    return e.errno in (errno.ENOTSUP, errno.EOPNOTSUPP, errno.EPERM, errno.EACCES)
+
+
+def _tags_of_ids(c, file_ids, chunk_size=500):
+    """ Yields (file_id, directory, name, [(key, value), ...]) for every id
+    that still has a row, in chunks of ids. """
+    file_ids = list(file_ids)
+    for i in range(0, len(file_ids), chunk_size):
+        chunk = file_ids[i:i + chunk_size]
+        marks = ','.join('?' * len(chunk))
+        tags = defaultdict(list)
+        for (file_id, key, value) in c.execute("""SELECT file_id, key, value
+                FROM filetag_junction INNER JOIN tags ON tags.id = tag_id
+                WHERE file_id IN (%s)""" % marks, chunk):
+            tags[file_id].append((key, value))
+        for (file_id, directory, name) in c.execute(
+                "SELECT id, directory, name FROM files WHERE id IN (%s)" % marks, chunk):
+            yield (file_id, directory, name, tags[file_id])
+
+
+def pending(c, consumer=CONSUMER):
+    """ Returns (last seq synced, or None if never, latest seq). """
+    return api.consumed(c, consumer), api.latest_change(c)
+
+
+def sync(c, mode='auto', full=False):
+    """ Writes out the tags of every file that changed since the last sync,
+    or of every file with `full` (or the first time). Files that have lost
+    all their tags have theirs removed. Returns the number of files written.
+    mode :: 'xattr', 'sidecar', or 'auto' for xattrs where they work and
+            sidecars elsewhere. """
+    if mode not in MODES:
+        raise ValueError("mode must be one of %s." % ', '.join(MODES))
+    if mode != 'sidecar' and not hasattr(os, 'setxattr'):
+        if mode == 'xattr':
+            raise OSError("Extended attributes aren't supported here.")
+        mode = 'sidecar'
+    since, latest = pending(c)
+    old_paths = defaultdict(set)
+    # Seqs have no gaps, so one just after `since` means nothing's been
+    # compacted away that we haven't seen.
+    oldest = c.execute("SELECT MIN(seq) FROM changes").fetchone()[0]
+    if since is not None and since < latest and (oldest or latest + 1) > since + 1:
+        full = True
+    if full or since is None:
+        file_ids = [id_ for (id_,) in c.execute("SELECT id FROM files")]
+    else:
+        file_ids, renamed_tags = set(), set()
+        for (_, kind, op, file_id, tag_id, path) in api.changes_since(c, since, latest):
+            if kind == 'tag':
+                if op == 'update':
+                    renamed_tags.add(tag_id)
+                continue
+            if kind == 'file' and op == 'insert':
+                continue  # Nothing to write until it's tagged.
+            file_ids.add(file_id)
+            if path is not None:
+                old_paths[file_id].add(path)
+        for tag_id in renamed_tags:
+            file_ids.update(file_id for (file_id,) in c.execute(
+                "SELECT file_id FROM filetag_junction WHERE tag_id = ?", (tag_id,)))
+    sidecars = _Sidecars()
+    written = set()
+    for (file_id, directory, name, tags) in _tags_of_ids(c, file_ids):
+        path = os.path.join(directory, name)
+        written.add(path)
+        if mode == 'sidecar' or not _set_xattr(path, tags):
+            if mode == 'xattr':
+                raise OSError("Can't set extended attributes on %s." % path)
+            sidecars.set(directory, name, tags)
+    # Paths files have left, or whose rows have gone; take the tags off,
+    # unless another file has just been written there.
+    for paths in old_paths.values():
+        for path in paths:
+            path = os.path.normpath(path)
+            if path in written:
+                continue
+            if mode != 'sidecar':
+                _set_xattr(path, [])
+            if mode != 'xattr':
+                sidecars.set(*os.path.split(path), None)
+    sidecars.flush()
+    api.mark_consumed(c, CONSUMER, latest)
+    return len(written)
+
+
+def _tag_list(found):
+    """ found, if it's a list of [key, value] strings; otherwise it isn't
+    ours, and there are none. """
+    if isinstance(found, list) and all(
+            isinstance(tag, list) and len(tag) == 2
+            and all(isinstance(part, str) for part in tag) for tag in found):
+        return found
+    return []
+
+
+def _found_tags(root_dir):
+    """ Yields (directory, name, size, mod_time, is_dir, key, value) for the
+    tags in the xattrs and sidecars under root_dir. """
+    from . import fs
+    sidecar_dir, entries = None, {}
+    for (directory, name, size, mod_time, is_dir) in fs.collect_files(
+            root_dir, exclude=(SIDECAR_NAME, SIDECAR_NAME + '.tmp')):
+        found = []
+        if hasattr(os, 'getxattr'):
+            try:
+                found = _tag_list(json.loads(
+                    os.getxattr(os.path.join(directory, name), XATTR)))
+            except (OSError, ValueError):  # None there, or not ours.
+                pass
+        # Files come a directory at a time, so one sidecar is read at a time.
+        if directory != sidecar_dir:
+            sidecar_dir = directory
+            try:
+                entries = read_sidecar(directory)
+            except ValueError:
+                entries = {}
+            if not isinstance(entries, dict):
+                entries = {}
+        for (key, value) in found + _tag_list(entries.get(name)):
+            yield (directory, name, size, mod_time, is_dir, key, value)
+
+
+def import_tags(c, root_dir=os.curdir, chunk_size=10000):
+    """ Adds the tags found in xattrs and sidecars under root_dir to the
+    database, `chunk_size` rows at a time. Returns the number of new
+    relations. """
+    rows = _found_tags(root_dir)
+    since, latest = pending(c)
+    added = 0
+    with api.write_transaction(c):
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            added += filetags.tag_files_bulk(c, chunk)
+    if since == latest:
+        # Nothing else was waiting, so there's no need to write these back out.
+        api.mark_consumed(c, CONSUMER, api.latest_change(c))
+    return added
@@ -0,0 +1,82 @@
+""" stats.py
+Tag cardinalities and co-occurrence.
+
+`tag_stats` holds the number of files for every tag, kept current by
+triggers on the junction, so a count is a single primary key lookup
+rather than a scan of the tag's files. Pairwise co-occurrence is only
+worth keeping for the most used tags and costs a self-join of the
+junction to work out, so `tag_cooccurrence` is filled by
+`refresh_cooccurrence` when asked and goes stale as files are tagged. """
+
+
+def tag_count(c, key, value, prefix=''):
+    """ The number of files with the tag; 0 if it doesn't exist. `prefix`
+    names the tables' schema, e.g. 'db1.', if any, and is UNSAFE. """
+    row = c.execute("""SELECT file_count FROM {0}tag_stats
+            WHERE tag_id = (SELECT id FROM {0}tags WHERE key = ? AND value = ?)"""
+            .format(prefix), (key, value)).fetchone()
+    return 0 if row is None else row[0]
+
+
+def key_count(c, key, prefix=''):
+    """ The number of (file, tag) relations for any tag with the key, which
+    is an upper bound on the number of files. """
+    return c.execute("""SELECT COALESCE(SUM(file_count), 0) FROM {0}tag_stats
+            WHERE tag_id IN (SELECT id FROM {0}tags WHERE key = ?)"""
+            .format(prefix), (key,)).fetchone()[0]
+
+
+def top_tags(c, limit=10):
+    """ Returns [(key, value, file_count)], most used first. """
+    return c.execute("""SELECT key, value, file_count FROM tag_stats
+            INNER JOIN tags ON tags.id = tag_stats.tag_id
+            ORDER BY file_count DESC, key, value LIMIT ?""", (limit,)).fetchall()
+
+
+def rebuild(c):
+    """ Recounts every tag from the junction, in case the counts have
+    drifted, e.g. after the junction was edited with triggers off. """
+    c.execute("DELETE FROM tag_stats")
+    c.execute("""INSERT INTO tag_stats (tag_id, file_count)
+            SELECT id, (SELECT COUNT(*) FROM filetag_junction
+                        WHERE tag_id = tags.id)
+            FROM tags""")
+
+
+def refresh_cooccurrence(c, top_n=50):
+    """ Recomputes how many files each pair of the `top_n` most used tags
+    share. Pairs are stored both ways round. Returns the number of rows. """
+    c.execute("DELETE FROM tag_cooccurrence")
+    return c.execute("""INSERT INTO tag_cooccurrence (tag_a, tag_b, file_count)
+            SELECT a.tag_id, b.tag_id, COUNT(*)
+            FROM filetag_junction a
+            INNER JOIN filetag_junction b
+                ON b.file_id = a.file_id AND b.tag_id != a.tag_id
+            WHERE a.tag_id IN (SELECT tag_id FROM tag_stats
+                               ORDER BY file_count DESC, tag_id LIMIT :n)
+              AND b.tag_id IN (SELECT tag_id FROM tag_stats
+                               ORDER BY file_count DESC, tag_id LIMIT :n)
+            GROUP BY a.tag_id, b.tag_id""", {'n': top_n}).rowcount
+
+
+def top_pairs(c, limit=10):
+    """ Returns [(key_a, value_a, key_b, value_b, file_count)] from the last
+    refresh, most shared first. """
+    return c.execute("""SELECT a.key, a.value, b.key, b.value, file_count
+            FROM tag_cooccurrence
+            INNER JOIN tags a ON a.id = tag_a
+            INNER JOIN tags b ON b.id = tag_b
+            WHERE tag_a < tag_b
+            ORDER BY file_count DESC, a.key, a.value, b.key, b.value
+            LIMIT ?""", (limit,)).fetchall()
+
+
+def cooccurring(c, key, value, limit=10):
+    """ Returns [(key, value, file_count)] for the tags most often found
+    with the given one, as of the last refresh. """
+    return c.execute("""SELECT tags.key, tags.value, file_count
+            FROM tag_cooccurrence
+            INNER JOIN tags ON tags.id = tag_b
+            WHERE tag_a = (SELECT id FROM tags WHERE key = ? AND value = ?)
+            ORDER BY file_count DESC, tags.key, tags.value LIMIT ?""",
+            (key, value, limit)).fetchall()
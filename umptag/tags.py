@@ -1,9 +1,8 @@
-import logging
-from typing import Tuple, Union, List
-from sqlite3 import (Cursor,  # Used for typechecking
-                     OperationalError,
-                     IntegrityError,
-                     DatabaseError)
+# These are only for type checkers; importing them costs CLI startup time.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from sqlite3 import Cursor
+    from typing import Union
 
 
 # def tag_safety(cols: Union[str, List[str]]) -> None:
@@ -23,11 +22,19 @@ from sqlite3 import (Cursor,  # Used for typechecking
 
 
 # Just the tag stuff.
-def _add_tag(c: Cursor, key: str, value: str):
-    c.execute("INSERT INTO tags (key, value) VALUES (?,?)", (key, value))
+def _add_tag(c: 'Cursor', key: str, value: str) -> int:
+    """ Returns the new tag's id. """
+    return c.execute("INSERT INTO tags (key, value) VALUES (?,?)",
+                     (key, value)).lastrowid
 
 
-def _exists_tag(c: Cursor, key: str, value: str) -> bool:
+def _get_tag_id(c: 'Cursor', key: str, value: str) -> 'Union[int, None]':
+    row = c.execute("SELECT id FROM tags WHERE key = ? AND value = ?",
+                    (key, value)).fetchone()
+    return None if row is None else row[0]
+
+
+def _exists_tag(c: 'Cursor', key: str, value: str) -> bool:
     """ Returns True if the (key, value) pair is in the database. """
     cmd_str = "SELECT key, value FROM tags WHERE key = ? AND value = ? LIMIT 1"
     return c.execute(cmd_str, (key, value)).fetchone() is not None
@@ -37,7 +44,7 @@ def _exists_tag(c: Cursor, key: str, value: str) -> bool:
     return (key, value) if exists else None
     """
 
-def delete_tag(c: Cursor, key: str, value: str) -> bool:
+def delete_tag(c: 'Cursor', key: str, value: str) -> bool:
     cmd_str = "DELETE FROM tags WHERE key = ? AND value = ?"
     c.execute(cmd_str, (key, value))
 
@@ -47,3 +54,15 @@ def get_or_add_tag(c, key, value):
     if not _exists_tag(c, key, value):
         _add_tag(c, key, value)
     return (key, value)
+
+def get_or_add_tag_id(c, key, value) -> int:
+    """ Like `get_or_add_tag`, but returns the tag's id. """
+    tag_id = _get_tag_id(c, key, value)
+    if tag_id is None:
+        tag_id = _add_tag(c, key, value)
+    return tag_id
+
+
+def format_tag(key, value):
+    """ How a tag is written on the command line: `value`, or `key=value`. """
+    return value if key == '' else "%s=%s" % (key, value)
@@ -0,0 +1,93 @@
+""" test_aio.py:
+Testcases for umptag.aio. """
+import asyncio
+import contextlib
+import os
+import time
+from pathlib import Path
+from . import RealFS_DBTester
+from .. import aio, api, database, filetags
+
+
+class AioTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.names = ['f%d' % i for i in range(50)]
+        for n in self.names:
+            Path(n).touch()
+        database.initialize_conn(database.DEFAULT_DB_NAME, True).close()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        super().tearDown()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    def stored_tags(self, name):
+        with contextlib.closing(database.get_conn()) as c:
+            return set(filetags.tags_of_file(c, '', name))
+
+    def test_roundtrip(self):
+        async def go():
+            async with aio.Umptag() as ump:
+                self.assertEqual(0, await ump.apply_tag('', 'f0', 'foo'))
+                self.assertEqual(1, await ump.apply_tag('', 'f0', 'foo'))
+                await ump.apply_tag('', 'f0', 'k', 'v')
+                self.assertEqual({('', 'foo'), ('k', 'v')},
+                                 set(await ump.tags_of_file('', 'f0')))
+                self.assertEqual([('', 'f0')], await ump.query('foo and k=v'))
+                await ump.merge_tag('bar', None, 'foo', None)
+                self.assertEqual([('', 'f0')], await ump.files_of_tag('bar'))
+                self.assertEqual(0, await ump.remove_tag('', 'f0', 'bar'))
+        self.run_async(go())
+        self.assertEqual({('k', 'v')}, self.stored_tags('f0'))
+
+    def test_group_commit(self):
+        """ Concurrent writes share transactions, and a failing one doesn't
+        take its batch down with it. """
+        async def go():
+            async with aio.Umptag() as ump:
+                run_batch = ump._run_batch
+                def counting(conn, batch):
+                    batches.append(len(batch))
+                    run_batch(conn, batch)
+                ump._run_batch = counting
+                writes = [ump.apply_tag('', n, 'foo') for n in self.names]
+                writes.append(ump.apply_tag('', 'nonexistent', 'foo'))
+                results = await asyncio.gather(*writes, return_exceptions=True)
+                self.assertEqual(0, ump.pending)
+                return results
+        batches = []
+        results = self.run_async(go())
+        self.assertEqual(len(self.names) + 1, sum(batches))
+        self.assertLess(len(batches), len(self.names) + 1)
+        self.assertEqual([0] * len(self.names), results[:-1])
+        self.assertIsInstance(results[-1], FileNotFoundError)
+        for n in self.names:
+            self.assertEqual({('', 'foo')}, self.stored_tags(n))
+        self.assertEqual(set(), self.stored_tags('nonexistent'))
+
+    def test_backpressure(self):
+        async def go():
+            async with aio.Umptag(max_pending=2) as ump:
+                def slow_apply(conn, directory, name, key):
+                    # On the writer thread, while the rest are waiting.
+                    seen.append(ump.pending)
+                    time.sleep(0.005)
+                    return api.apply_tag(conn, directory, name, key)
+                await asyncio.gather(*(ump._write(slow_apply, '', n, 'foo')
+                                       for n in self.names))
+        seen = []
+        self.run_async(go())
+        self.assertEqual(len(self.names), len(seen))
+        self.assertEqual(2, max(seen))
+
+    def test_closed(self):
+        async def go():
+            ump = aio.Umptag()
+            await ump.close()
+            with self.assertRaises(RuntimeError):
+                await ump.apply_tag('', 'f0', 'foo')
+        self.run_async(go())
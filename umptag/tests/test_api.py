@@ -1,5 +1,6 @@
 """ test_api.py:
 TestCases for umptag.api. """
+import contextlib
 import logging
 import os
 import os.path
@@ -43,9 +44,16 @@ class TagChangeTester(RealFS_DBTester):
                 # Path(dp, stem).touch()
                 # self.fs.create_file(dp+os.sep+stem)
                 # self.dirpaths[dp].append(stem)
-        database.initialize_conn(self.db_name, True)
+        database.initialize_conn(self.db_name, True).close()
         return
 
+    @contextlib.contextmanager
+    def connect(self):
+        """ Like `with conn:`, and closes it afterwards. """
+        with contextlib.closing(database.get_conn(self.db_name)) as c:
+            with c:
+                yield c
+
 
 class AddRemove_TagChangeTester(TagChangeTester):
     def setUp(self):
@@ -56,14 +64,14 @@ class AddRemove_TagChangeTester(TagChangeTester):
         """ Testing api.apply_tag on single file. """
         d, n = os.path.split(choice(self.filepaths))
         tg = make_random_word()
-        with database.get_conn(self.db_name) as c:
+        with self.connect() as c:
             api.apply_tag(c, d, n, tg)  # TESTED FUNCTION
         with self.subTest(directory=d, name=d, tg=tg):
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 out = filetags.tags_of_file(c, d, n)
             self.assertEqual(out[0], ('', tg))
         with self.subTest(directory=d, name=n, tg=tg):
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 out = filetags.files_of_tag(c, '', tg)
             self.assertEqual(out[0], (d, n))
         return  # Because otherwise we'll get LOST
@@ -73,15 +81,15 @@ class AddRemove_TagChangeTester(TagChangeTester):
         """ Testing api.remove_tag on a single file. """
         d, n = os.path.split(choice(self.filepaths))
         tg = make_random_word()
-        with database.get_conn(self.db_name) as c:
+        with self.connect() as c:
             api.apply_tag(c, d, n, tg)
             api.remove_tag(c, d, n, tg)
         with self.subTest(directory=d, name=n, tg=tg):
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 out = filetags.tags_of_file(c, d, n)
             self.assertEqual(out, [])
         with self.subTest(directory=d, name=n, tg=tg):
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 out = filetags.files_of_tag(c, '', tg)
             self.assertEqual(out, [])
         return  # Because otherwise we'll get LOST
@@ -116,10 +124,10 @@ class AddRemove_TagChangeTester(TagChangeTester):
                         # We note which tag we're putting on the file for Later.
                         attached_tags[(d, n)].add((random_key, random_tag))
                         # And we tag the file.
-                        with database.get_conn(self.db_name) as c:
+                        with self.connect() as c:
                             apply_tag(c, d, n)
                         # And we test if it's been tagged.
-                        with database.get_conn(self.db_name) as c:
+                        with self.connect() as c:
                             self.assertIn((d, n),
                                           filetags.files_of_tag(c,
                                               random_key,
@@ -127,7 +135,7 @@ class AddRemove_TagChangeTester(TagChangeTester):
                             self.assertIn((random_key, random_tag),
                                           filetags.tags_of_file(c, d, n))
                     # We finished tagging the files.
-                    with database.get_conn(self.db_name) as c:
+                    with self.connect() as c:
                         # What actually got tagged.
                         actually_tagged = set(filetags.files_of_tag(c, random_key, random_tag))
                     if DEBUG:
@@ -137,10 +145,11 @@ class AddRemove_TagChangeTester(TagChangeTester):
                         print()
                     self.assertEqual(files_to_tag, actually_tagged)
             # This is Later, after the keyed and then after unkeyed.
-            for file, file_tags in attached_tags.items():
-                # We make sure that the files have the tags we wanted them to have.
-                self.assertEqual(set(filetags.tags_of_file(c, *file)),
-                                 file_tags)
+            with self.connect() as c:
+                for file, file_tags in attached_tags.items():
+                    # We make sure that the files have the tags we wanted them to have.
+                    self.assertEqual(set(filetags.tags_of_file(c, *file)),
+                                     file_tags)
 
     def test_remove_tag(self):
         """ Testing api.remove_tag on multiple files. """
@@ -172,10 +181,10 @@ class AddRemove_TagChangeTester(TagChangeTester):
                                        for _ in range(randint(1, len_fp-2)))
                     for (d, n) in files_to_tag:
                         attached_tags[(d, n)].add((random_key, random_tag))
-                        with database.get_conn(self.db_name) as c:
+                        with self.connect() as c:
                             apply_tag(c, d, n)
                         # Make sure we actually tagged it.
-                        with database.get_conn(self.db_name) as c:
+                        with self.connect() as c:
                             self.assertIn((d, n),
                                           filetags.files_of_tag(c,
                                               random_key,
@@ -185,7 +194,7 @@ class AddRemove_TagChangeTester(TagChangeTester):
                     while files_to_tag:
                         rm_d, rm_n = files_to_tag.pop()
                         attached_tags[(rm_d, rm_n)].remove((random_key, random_tag))
-                        with database.get_conn(self.db_name) as c:
+                        with self.connect() as c:
                             remove_tag(c, rm_d, rm_n)
                             self.assertNotIn((random_key, random_tag),
                                     filetags.tags_of_file(c, rm_d, rm_n))
@@ -193,10 +202,107 @@ class AddRemove_TagChangeTester(TagChangeTester):
                                     filetags.files_of_tag(c,
                                                           random_key,
                                                           random_tag))
-                        self.assertEqual(attached_tags[(rm_d, rm_n)],
-                                set(filetags.tags_of_file(c, rm_d, rm_n)))
+                            self.assertEqual(attached_tags[(rm_d, rm_n)],
+                                    set(filetags.tags_of_file(c, rm_d, rm_n)))
+
+
+
+class Bulk_TagChangeTester(TagChangeTester):
+    def test_apply_tags_bulk(self):
+        """ Testing api.apply_tags_bulk against the per-file tags. """
+        tgs = [('', make_random_word()), (make_random_word(), make_random_word())]
+        pairs = [(*os.path.split(fp), *tg)
+                 for fp in self.filepaths for tg in tgs]
+        with self.connect() as c:
+            added = api.apply_tags_bulk(c, pairs, chunk_size=3)
+        self.assertEqual(len(pairs), added)
+        with self.connect() as c:
+            for fp in self.filepaths:
+                self.assertEqual(set(tgs),
+                        set(filetags.tags_of_file(c, *os.path.split(fp))))
+            for tg in tgs:
+                self.assertEqual(set(os.path.split(fp) for fp in self.filepaths),
+                        set(filetags.files_of_tag(c, *tg)))
+
+    def test_apply_tags_bulk_existing(self):
+        """ Testing that api.apply_tags_bulk skips existing relations. """
+        d, n = os.path.split(choice(self.filepaths))
+        tg = make_random_word()
+        with self.connect() as c:
+            api.apply_tag(c, d, n, tg)
+            added = api.apply_tags_bulk(c, [(d, n, tg, None), (d, n, tg, None)])
+            self.assertEqual(0, added)
+            self.assertEqual([('', tg)], filetags.tags_of_file(c, d, n))
+            self.assertEqual(1, c.execute("SELECT COUNT(*) FROM files").fetchone()[0])
+
+
+    def test_remove_tags_bulk(self):
+        """ Testing api.remove_tags_bulk and its single orphan sweep. """
+        keep, drop = make_random_word(), (make_random_word(), make_random_word())
+        kept_fp = self.filepaths[0]
+        with self.connect() as c:
+            api.apply_tags_bulk(c, [(*os.path.split(fp), *drop)
+                                    for fp in self.filepaths])
+            api.apply_tag(c, *os.path.split(kept_fp), keep)
+            removed = api.remove_tags_bulk(
+                c, [(*os.path.split(fp), *drop) for fp in self.filepaths]
+                   + [('', 'nonexistent', *drop)], chunk_size=2)
+            self.assertEqual(len(self.filepaths), removed)
+            self.assertFalse(tags._exists_tag(c, *drop))
+            self.assertEqual([os.path.split(kept_fp)],
+                    c.execute("SELECT directory, name FROM files").fetchall())
+
+    def test_deferred_cleanup(self):
+        """ Testing remove_tag with clean=False followed by a sweep. """
+        d, n = os.path.split(choice(self.filepaths))
+        tg = make_random_word()
+        with self.connect() as c:
+            api.apply_tag(c, d, n, tg)
+            self.assertEqual(0, api.remove_tag(c, d, n, tg, clean=False))
+            self.assertTrue(tags._exists_tag(c, '', tg))
+            self.assertEqual((1, 1), api.sweep_orphans(c))
+            self.assertFalse(tags._exists_tag(c, '', tg))
+            self.assertEqual((0, 0), api.sweep_orphans(c))
 
 
+class Subtree_TagChangeTester(TagChangeTester):
+    def test_apply_tags_recursive(self):
+        """ Testing api.apply_tags_recursive and api.files_under. """
+        top = self.dirpaths[0]
+        Path(top, 'nested').mkdir()
+        Path(top, 'nested', 'deep').touch()
+        below = sorted(os.path.split(p) for p in self.filepaths
+                       if p.startswith(top + os.sep))
+        below += [(top, 'nested'), (os.path.join(top, 'nested'), 'deep')]
+        tg = ('k', make_random_word())
+        with self.connect() as c:
+            self.assertEqual(len(below), api.apply_tags_recursive(c, top, [tg]))
+            self.assertEqual(0, api.apply_tags_recursive(c, top, [tg]))
+            self.assertEqual(sorted(below), sorted(filetags.files_of_tag(c, *tg)))
+            api.apply_tag(c, *os.path.split(self.filepaths[0]), 'other')
+            self.assertEqual(sorted(below), api.files_under(c, top))
+            self.assertEqual(sorted(below), api.files_under(c, top + os.sep))
+            self.assertEqual([(os.path.join(top, 'nested'), 'deep')],
+                             api.files_under(c, os.path.join(top, 'nested'),
+                                             'k=%s' % tg[1]))
+            self.assertEqual([], api.files_under(c, top, 'other'))
+            self.assertEqual(len(below) + 1, len(api.files_under(c, os.curdir)))
+            self.assertEqual(len(below), api.remove_tags_recursive(c, top, [tg]))
+            self.assertEqual([], api.files_under(c, top))
+
+    def test_apply_tags_recursive_root(self):
+        """ Tagging the whole tree leaves the database's own files alone. """
+        with self.connect() as c:
+            api.apply_tags_recursive(c, '', [('everything', None)])
+            names = set(n for (_, n) in api.files_under(c, ''))
+        self.assertNotIn(database.DEFAULT_DB_NAME, names)
+        self.assertTrue(set(os.path.basename(p) for p in self.filepaths) <= names)
+
+    def test_apply_tags_recursive_missing(self):
+        with self.connect() as c:
+            with self.assertRaises(FileNotFoundError):
+                api.apply_tags_recursive(c, 'nonexistent', [('x', None)])
+
 
 class Merge_TagChangeTester(TagChangeTester):
     def test_merge_tag(self):
@@ -213,9 +319,9 @@ class Merge_TagChangeTester(TagChangeTester):
             for _ in range(randint(2, 5)):
                 fp = os.path.split(choice(self.filepaths))
                 tagged_files.append(fp)
-                with database.get_conn(self.db_name) as c:
+                with self.connect() as c:
                     api.apply_tag(c, *fp, *child_tag)
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 api.merge_tag(c, *parent_tag, *child_tag)
                 self.assertEqual(set(tagged_files),
                         set(filetags.files_of_tag(c, *parent_tag)))
@@ -223,20 +329,42 @@ class Merge_TagChangeTester(TagChangeTester):
                 self.assertFalse(tags._exists_tag(c, *child_tag))
 
 
+    def test_merge_tags(self):
+        """ Testing api.merge_tags with many sources. """
+        dest = (make_random_word(), make_random_word())
+        sources = [('', make_random_word()), (make_random_word(), make_random_word())]
+        expected = set()
+        with self.connect() as c:
+            for tg in [dest] + sources:
+                for _ in range(randint(1, 4)):
+                    fp = os.path.split(choice(self.filepaths))
+                    expected.add(fp)
+                    api.apply_tag(c, *fp, *tg)
+        # Merging shouldn't need to look at the files at all.
+        for fp in self.filepaths:
+            os.remove(fp)
+        with self.connect() as c:
+            self.assertEqual(0, api.merge_tags(c, dest, sources + [('', 'nope')]))
+            self.assertEqual(expected, set(filetags.files_of_tag(c, *dest)))
+            for tg in sources:
+                self.assertFalse(tags._exists_tag(c, *tg))
+            self.assertEqual(1, api.merge_tags(c, dest, [dest]))
+
+
 class Error_TagChangeTester(TagChangeTester):
     def test_add_duplicate_tag(self):
         """ Testing if api.apply_tag handles adding duplicate tags. """
         d, n = os.path.split(choice(self.filepaths))
         for tg in ((make_random_word(),), (make_random_word(), make_random_word())):
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 api.apply_tag(c, d, n, *tg)
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 self.assertEqual(1, api.apply_tag(c, d, n, *tg))
 
     def test_remove_null_tag(self):
         """ Testing if api.remove_tag handles removing tags that aren't there. """
         d, n = os.path.split(choice(self.filepaths))
-        with database.get_conn(self.db_name) as c:
+        with self.connect() as c:
             self.assertEqual(1, api.remove_tag(c, d, n, make_random_word()))
 
 
@@ -247,14 +375,15 @@ class Orphan_TagChangeTester(TagChangeTester):
         fp = choice(self.filepaths)
         for tg in ((make_random_word(),), (make_random_word(), make_random_word())):
             d, n = os.path.split(fp)
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 api.apply_tag(c, d, n, *tg)
             self.assertIsNotNone(conn.execute(
                 "SELECT * FROM files WHERE directory=? AND name=?", os.path.split(fp)).fetchone())
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 api.remove_tag(c, d, n, *tg)
             self.assertIsNone(conn.execute(
                 "SELECT * FROM files WHERE directory=? AND name=?", os.path.split(fp)).fetchone())
+        conn.close()
 
     def test_remove_orphan_tag(self):
         """ Testing api.remove_orphans for tags. """
@@ -262,14 +391,39 @@ class Orphan_TagChangeTester(TagChangeTester):
         fp = choice(self.filepaths)
         for tg in (('', make_random_word(),), (make_random_word(), make_random_word())):
             d, n = os.path.split(fp)
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 api.apply_tag(c, d, n, *tg)
             self.assertIsNotNone(conn.execute(
                 "SELECT * FROM tags WHERE key=? AND value=?", tg).fetchone())
-            with database.get_conn(self.db_name) as c:
+            with self.connect() as c:
                 api.remove_tag(c, d, n, *tg)
             self.assertIsNone(conn.execute(
                 "SELECT * FROM tags WHERE key=? AND value=?", tg).fetchone())
+        conn.close()
+
+    def test_remove_orphan_directories(self):
+        """ Testing that directories left empty go with their last file. """
+        directory = os.path.join('a', 'b', 'c')
+        os.makedirs(directory)
+        Path(directory, 'f').touch()
+        dirs = "SELECT path FROM directories WHERE path != '' ORDER BY path"
+        for clean in (True, False):
+            with self.subTest(clean=clean), self.connect() as c:
+                api.apply_tag(c, directory, 'f', 'foo')
+                self.assertEqual(3, len(c.execute(dirs).fetchall()))
+                api.remove_tag(c, directory, 'f', 'foo', clean=clean)
+                if not clean:
+                    self.assertEqual((1, 1), api.sweep_orphans(c))
+                self.assertEqual([], c.execute(dirs).fetchall())
+        # Not ones repair has looked at, or that still hold something.
+        with self.connect() as c:
+            api.apply_tag(c, directory, 'f', 'foo')
+            api.apply_tag(c, 'a', 'b', 'bar')
+            c.execute("UPDATE directories SET scan_mtime = 0 WHERE path = ?",
+                      (os.path.join('a', 'b'),))
+            api.remove_tag(c, directory, 'f', 'foo')
+            self.assertEqual([('a',), (os.path.join('a', 'b'),)],
+                             c.execute(dirs).fetchall())
 
 
 @unittest.skip("Not even sure if I'm gonna use this.")
@@ -277,7 +431,7 @@ class QueryClass_TagChangeTester(TagChangeTester):
     def test_tagquery_files(self):
         d, n = os.path.split(choice(self.filepaths))
         tg = make_random_word()
-        with database.get_conn(self.db_name) as c:
+        with self.connect() as c:
             api.apply_tag(c, d, n, tg)
             files_of_tag = set(filetags.files_of_tag(c, '', tg))
             tag_query = api.TagQuery(c, tg)
@@ -292,7 +446,7 @@ class QueryClass_TagChangeTester(TagChangeTester):
         t2 = (make_random_word(), make_random_word())
         t2_files = set(os.path.split(choice(self.filepaths)) for _ in range(2))
         all_tagged_files = t1_files + t2_files
-        with database.get_conn(self.db_name) as c:
+        with self.connect() as c:
             for (d, n) in t1_files:
                 api.apply_tag(c, d, n, *t1)
             for (d, n) in t2_files:
@@ -325,22 +479,92 @@ class GetInfo_TagChangeTester(TagChangeTester):
                 filed_tags[(random_key, random_tag)] = files_to_tag
                 for (d, n) in files_to_tag:
                     tagged_files[(d, n)].add((random_key, random_tag))
-                    with database.get_conn(self.db_name) as c:
+                    with self.connect() as c:
                         apply_tag(c, d, n)
         with self.subTest("Testing show_tags."):
             for file, tagged in tagged_files.items():
                 tagged = set((k+'=' if k else '')+t for (k, t) in tagged)
-                with database.get_conn(self.db_name) as c:
+                with self.connect() as c:
                     self.assertEqual(tagged, set(api.show_tags(c, *file)))
         with self.subTest("Testing show_files."):
             for tag_, files_ in filed_tags.items():
                 tag_str = (tag_[0]+'=' if tag_[0] else '')+tag_[1]
                 filed = set(os.path.join(d, n) for (d, n) in files_)
-                with database.get_conn(self.db_name) as c:
+                with self.connect() as c:
                     show_output = set(api.show_files(c, *tag_))
         return
 
 
+class Journal_Tester(DBTester):
+    def entries(self, since=0):
+        return [row[1:] for row in api.changes_since(self.conn, since, batch_size=2)]
+
+    def test_changes_since(self):
+        filetags.tag_files_bulk(self.conn, [('d', 'a', 1, None, False, '', 'foo')])
+        file_id, = self.conn.execute("SELECT id FROM files").fetchone()
+        tag_id, = self.conn.execute("SELECT id FROM tags").fetchone()
+        self.assertEqual([('file', 'insert', file_id, None, None),
+                          ('filetag', 'insert', file_id, tag_id, None),
+                          ('tag', 'insert', None, tag_id, None)],
+                         sorted(self.entries()))
+        seq = api.latest_change(self.conn)
+        self.conn.execute("UPDATE files SET size = 1")  # No change, so no entry.
+        self.conn.execute("UPDATE files SET directory = 'e', name = 'b'")
+        self.assertEqual([('file', 'update', file_id, None, 'd/a')], self.entries(seq))
+        seq = api.latest_change(self.conn)
+        api.remove_tag(self.conn, 'e', 'b', 'foo')
+        self.assertEqual([('filetag', 'delete', file_id, tag_id, 'e/b'),
+                          ('tag', 'delete', None, tag_id, None),
+                          ('file', 'delete', file_id, None, 'e/b')],
+                         self.entries(seq))
+
+    def test_compact(self):
+        for name in 'abc':
+            filetags.tag_files_bulk(self.conn, [('', name, 1, None, False, '', name)])
+        latest = api.latest_change(self.conn)
+        self.assertEqual(0, api.compact_changes(self.conn))  # No consumers yet.
+        api.mark_consumed(self.conn, 'x', 3)
+        api.mark_consumed(self.conn, 'y', 6)
+        self.assertEqual(6, api.consumed(self.conn, 'y'))
+        self.assertEqual(3, api.compact_changes(self.conn))
+        self.assertEqual(4, next(api.changes_since(self.conn))[0])
+        self.assertEqual(latest - 3, api.compact_changes(self.conn, latest))
+        self.assertEqual([], list(api.changes_since(self.conn)))
+        self.assertEqual(latest, api.latest_change(self.conn))
+        self.assertIsNone(api.consumed(self.conn, 'z'))
+
+
+class Retry_Tester(TestCase):
+    def test_retry_on_locked(self):
+        calls = []
+        @api.retry_on_locked(attempts=3, delay=0)
+        def flaky(conn):
+            calls.append(1)
+            if len(calls) < 3:
+                raise sqlite3.OperationalError("database is locked")
+            return 'done'
+        conn = sqlite3.connect(':memory:')
+        self.assertEqual('done', flaky(conn))
+        calls.clear()
+        @api.retry_on_locked(attempts=2, delay=0)
+        def hopeless(conn):
+            calls.append(1)
+            raise sqlite3.OperationalError("database is locked")
+        with self.assertRaises(sqlite3.OperationalError):
+            hopeless(conn)
+        self.assertEqual(2, len(calls))
+
+    def test_other_errors_not_retried(self):
+        calls = []
+        @api.retry_on_locked(delay=0)
+        def broken(conn):
+            calls.append(1)
+            raise sqlite3.OperationalError("no such table: foo")
+        with self.assertRaises(sqlite3.OperationalError):
+            broken(sqlite3.connect(':memory:'))
+        self.assertEqual(1, len(calls))
+
+
 # TODO make this real :(
 class Parser_Tester(TestCase):
     def test_parser_echo(self):
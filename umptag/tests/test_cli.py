@@ -0,0 +1,193 @@
+""" test_cli.py:
+Testcases for umptag.cli and the handlers in umptag.actions. """
+import contextlib
+import io
+import os
+import os.path
+import subprocess
+import sys
+import unittest
+from pathlib import Path
+from unittest import mock
+from . import RealFS_DBTester
+from .. import actions, cli, database, filetags
+
+
+class CLITester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.names = ['a', 'b', 'c d']
+        os.mkdir('sub')
+        self.paths = [os.path.join('sub', n) for n in self.names]
+        for p in self.paths:
+            Path(p).touch()
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.run_cli('init')
+
+    def run_cli(self, *argv, stdin=b''):
+        args = cli.build_parser().parse_args(argv)
+        real_stdin = sys.stdin
+        sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+        try:
+            with contextlib.redirect_stdout(io.StringIO()) as out:
+                code = cli.resolve(args.func)(args)
+        finally:
+            sys.stdin = real_stdin
+        return code, out.getvalue()
+
+    def tags_of(self, path):
+        with contextlib.closing(database.get_conn()) as c:
+            return set(filetags.tags_of_file(c, *os.path.split(path)))
+
+    def test_single_file(self):
+        self.assertEqual(0, self.run_cli('tag', self.paths[0], 'foo', 'k=v')[0])
+        self.assertEqual({('', 'foo'), ('k', 'v')}, self.tags_of(self.paths[0]))
+        self.run_cli('untag', self.paths[0], 'foo')
+        self.assertEqual({('k', 'v')}, self.tags_of(self.paths[0]))
+
+    def test_many_files(self):
+        self.run_cli('tag', '--tags', 'foo bar', *self.paths)
+        for p in self.paths:
+            self.assertEqual({('', 'foo'), ('', 'bar')}, self.tags_of(p))
+
+    def test_stdin(self):
+        for (flags, sep) in (((), b'\n'), (('-0',), b'\0')):
+            with self.subTest(flags=flags):
+                data = sep.join(p.encode() for p in self.paths) + sep
+                code, out = self.run_cli('tag', '--stdin', *flags,
+                                         '--tags', 'raw', stdin=data)
+                self.assertEqual(0, code)
+                for p in self.paths:
+                    self.assertEqual({('', 'raw')}, self.tags_of(p))
+                self.run_cli('untag', '--from-stdin', *flags, 'raw', stdin=data)
+                for p in self.paths:
+                    self.assertEqual(set(), self.tags_of(p))
+
+    def test_recursive(self):
+        os.mkdir(os.path.join('sub', 'deeper'))
+        Path('sub', 'deeper', 'e').touch()
+        Path('outside').touch()
+        code, out = self.run_cli('tag', '-r', 'sub', 'tree')
+        self.assertEqual((0, "Applied 5 tag(s).\n"), (code, out))
+        for p in self.paths + [os.path.join('sub', 'deeper', 'e')]:
+            self.assertEqual({('', 'tree')}, self.tags_of(p))
+        self.assertEqual(set(), self.tags_of('outside'))
+        code, out = self.run_cli('untag', '-r', 'sub', 'tree')
+        self.assertEqual((0, "Removed 5 tag(s).\n"), (code, out))
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(1, self.run_cli('tag', '-r', 'nonexistent', 'x')[0])
+
+    def test_export_import(self):
+        self.run_cli('tag', '--tags', 'foo k=v', *self.paths)
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(0, self.run_cli('export', '--binary', '-o', 'dump')[0])
+        os.remove(database.DEFAULT_DB_NAME)
+        self.run_cli('init')
+        self.assertEqual((0, "Imported 3 file(s), 6 new tagging(s).\n"),
+                         self.run_cli('import', 'dump'))
+        for p in self.paths:
+            self.assertEqual({('', 'foo'), ('k', 'v')}, self.tags_of(p))
+
+    def test_sync(self):
+        self.run_cli('tag', '--tags', 'foo', *self.paths)
+        self.assertEqual((0, "Synced 3 file(s).\n"),
+                         self.run_cli('sync', '--mode', 'sidecar'))
+        self.assertEqual((0, "Synced 0 file(s).\n"),
+                         self.run_cli('sync', '--mode', 'sidecar'))
+        self.assertEqual((0, "Synced 3 file(s).\n"),
+                         self.run_cli('sync', '--mode', 'sidecar', '--full'))
+        self.run_cli('untag', self.paths[0], 'foo')
+        self.assertEqual((0, "Imported 1 new tagging(s).\n"),
+                         self.run_cli('sync', '--import'))
+        code, out = self.run_cli('compact')
+        self.assertRegex(out, r"^Removed [1-9]\d* journal entries\.$")
+        self.assertEqual((0, "Removed 0 journal entries.\n"), self.run_cli('compact'))
+
+    def test_search(self):
+        self.run_cli('tag', self.paths[0], 'foo')
+        os.mkdir('other')
+        os.chdir('other')
+        try:
+            Path('x').touch()
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.run_cli('init')
+            self.run_cli('tag', 'x', 'foo')
+        finally:
+            os.chdir(os.pardir)
+        with mock.patch.dict(os.environ, {'UMPTAG_CATALOGUE': 'catalogue.db'}):
+            code, out = self.run_cli('search', 'foo')
+        self.assertEqual((0, [self.paths[0], os.path.join('other', 'x')]),
+                         (code, out.splitlines()))
+
+    def test_files(self):
+        self.run_cli('tag', '--tags', 'foo', *self.paths[:2])
+        self.run_cli('tag', self.paths[1], 'bar')
+        code, out = self.run_cli('files', 'foo', 'and', 'not', 'bar')
+        self.assertEqual((0, self.paths[:1]), (code, out.splitlines()))
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.assertEqual((1, ''), self.run_cli('files', '(foo'))
+        self.assertTrue(err.getvalue())
+
+    def test_relative_to_database(self):
+        """ Paths are stored relative to the database, wherever we are. """
+        os.chdir('sub')
+        try:
+            self.run_cli('tag', 'a', 'foo')
+            code, out = self.run_cli('tags', 'a')
+        finally:
+            os.chdir(os.pardir)
+        self.assertEqual('foo\n', out)
+        self.assertEqual({('', 'foo')}, self.tags_of(self.paths[0]))
+
+    def test_missing_file_rolls_back(self):
+        with contextlib.redirect_stderr(io.StringIO()):
+            code, _ = self.run_cli('tag', '--tags', 'foo',
+                                   self.paths[0], 'nonexistent')
+        self.assertEqual(1, code)
+        self.assertEqual(set(), self.tags_of(self.paths[0]))
+
+    def test_read_paths(self):
+        data = io.BytesIO(b'one\0two\0three')
+        self.assertEqual(['one', 'two', 'three'],
+                         list(actions._read_paths(data, null=True, chunk_size=2)))
+
+
+class ImportTimeTester(RealFS_DBTester):
+    """ What the quick commands import, all told, from starting up to
+    printing their answer with no daemon running.
+    benchmarks/import_time.py times it. """
+    # Not needed to look things up, and slow to load.
+    heavy = ('umptag.api', 'umptag.daemon', 'umptag.hashing', 'umptag.query',
+             'umptag.repair', 'umptag.session', 'umptag.stats', 'typing',
+             'logging', 'concurrent.futures')
+
+    def setUp(self):
+        super().setUp()
+        Path('a').touch()
+        with contextlib.closing(database.initialize_conn(
+                database.DEFAULT_DB_NAME, True)) as c:
+            filetags.tag_files_bulk(c, [('', 'a', None, None, False, '', 'foo')])
+            c.commit()
+
+    def imported(self, *argv):
+        """ The modules `umptag argv` imports, from -X importtime. """
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+                os.path.abspath(__file__))))
+        env = dict(os.environ, PYTHONPATH=root,
+                   UMPTAG_SOCKET=os.path.abspath('no-daemon.sock'))
+        proc = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c',
+                 'import sys; from umptag import cli; sys.exit(cli.main())', *argv],
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True, check=True)
+        self.assertTrue(proc.stdout)
+        return set(line.split('|')[2].strip() for line in proc.stderr.splitlines()
+                   if line.startswith('import time:') and 'cumulative' not in line)
+
+    def test_no_heavy_imports(self):
+        for (argv, needed) in ((('tags', 'a'), ()),
+                               (('files', 'foo'), ('umptag.query',))):
+            with self.subTest(argv=argv):
+                imported = self.imported(*argv)
+                self.assertEqual([], [m for m in self.heavy
+                                      if m in imported and m not in needed])
@@ -0,0 +1,165 @@
+""" test_daemon.py:
+Testcases for umptag.daemon and umptag.client. """
+import contextlib
+import io
+import os
+import os.path
+import socket
+import stat
+import threading
+from pathlib import Path
+from unittest import mock
+from . import RealFS_DBTester
+from .. import api, cli, client, daemon, database, filetags
+
+
+class DaemonTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        os.mkdir('sub')
+        self.paths = [os.path.abspath(os.path.join('sub', n)) for n in 'abc']
+        for p in self.paths:
+            Path(p).touch()
+        database.initialize_conn(database.DEFAULT_DB_NAME, True).close()
+        self.socket = os.path.abspath('umptag.sock')
+        self.server = daemon.Server(self.socket)
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05,))
+        self.thread.start()
+        self.client = client.Client(self.socket)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.thread.join()
+        self.server.close()
+        super().tearDown()
+
+    def test_roundtrip(self):
+        self.assertEqual("pong", self.client.call('ping'))
+        self.assertEqual(6, self.client.call('apply', paths=self.paths,
+                                             tags=[['foo', None], ['k', 'v']]))
+        self.assertEqual([['', 'foo'], ['k', 'v']],
+                         sorted(self.client.call('tags', path=self.paths[0])))
+        self.assertEqual(sorted(self.paths), sorted(self.client.call(
+                'files', cwd=os.getcwd(), query='foo and k=v')))
+        self.assertEqual(3, self.client.call('remove', paths=self.paths,
+                                             tags=[['foo', None]]))
+        with contextlib.closing(database.get_conn()) as c:
+            self.assertEqual([('k', 'v')],
+                             filetags.tags_of_file(c, 'sub', 'a'))
+
+    def test_errors(self):
+        for (op, kwargs) in (('nonsense', {}),
+                             ('files', {'cwd': os.getcwd(), 'query': 'a and ('}),
+                             ('tags', {'path': '/'})):
+            with self.subTest(op=op):
+                with self.assertRaises(daemon.DaemonError):
+                    self.client.call(op, **kwargs)
+        # Still serving.
+        self.assertEqual("pong", self.client.call('ping'))
+
+    def test_bad_requests(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(5)
+        sock.connect(self.socket)
+        for data in (b'[1,2]', b'"ping"', b'{"op":', b'\xff'):
+            with self.subTest(data=data):
+                sock.sendall(client.HEADER.pack(len(data)) + data)
+                self.assertIn('error', client.recv_message(sock))
+        client.send_message(sock, {'op': 'ping'})
+        self.assertEqual({'result': 'pong'}, client.recv_message(sock))
+        sock.close()
+        self.assertEqual("pong", self.client.call('ping'))
+
+    def test_split_frames(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.socket)
+        data = b'{"op":"ping"}'
+        message = client.HEADER.pack(len(data)) + data
+        for i in range(len(message)):
+            sock.sendall(message[i:i + 1])
+        self.assertEqual({'result': 'pong'}, client.recv_message(sock))
+        sock.close()
+
+    def test_sees_other_writers(self):
+        """ A tag deleted behind the daemon's back mustn't stay cached. """
+        self.client.call('apply', paths=self.paths[:1], tags=[['foo', None]])
+        with contextlib.closing(database.get_conn()) as c:
+            api.remove_tag(c, 'sub', 'a', 'foo')
+            c.commit()
+        self.assertEqual(1, self.client.call('apply', paths=self.paths[1:2],
+                                             tags=[['foo', None]]))
+        self.assertEqual([['', 'foo']],
+                         self.client.call('tags', path=self.paths[1]))
+
+    def test_cli_uses_daemon(self):
+        args = cli.build_parser().parse_args(('tag', '--tags', 'foo bar', 'sub/a'))
+        with contextlib.redirect_stdout(io.StringIO()) as remote:
+            self.assertEqual(0, client.run_command(args, self.socket))
+        self.assertEqual("Applied 2 tag(s).\n", remote.getvalue())
+        for argv in (('tags', 'sub/a'), ('files', 'foo')):
+            with self.subTest(argv=argv):
+                args = cli.build_parser().parse_args(argv)
+                with contextlib.redirect_stdout(io.StringIO()) as remote:
+                    self.assertEqual(0, client.run_command(args, self.socket))
+                with contextlib.redirect_stdout(io.StringIO()) as local:
+                    cli.resolve(args.func)(args)
+                self.assertEqual(local.getvalue(), remote.getvalue())
+        args = cli.build_parser().parse_args(('ls',))
+        self.assertIsNone(client.run_command(args, self.socket))
+
+    def test_cli_tags_here(self):
+        """ `umptag tags` with no file asks about the current directory. """
+        self.client.call('apply', paths=[os.path.abspath('sub')], tags=[['foo', None]])
+        args = cli.build_parser().parse_args(('tags',))
+        for (directory, expected) in (('sub', "foo\n"), (os.curdir, "")):
+            with self.subTest(directory=directory):
+                start = os.getcwd()
+                os.chdir(directory)
+                try:
+                    with contextlib.redirect_stdout(io.StringIO()) as remote:
+                        self.assertEqual(0, client.run_command(args, self.socket))
+                    with contextlib.redirect_stdout(io.StringIO()) as local:
+                        cli.resolve(args.func)(args)
+                finally:
+                    os.chdir(start)
+                self.assertEqual(expected, remote.getvalue())
+                self.assertEqual(local.getvalue(), remote.getvalue())
+
+    def test_stale_socket(self):
+        path = os.path.abspath('stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        server = daemon.Server(path)
+        server.close()
+        with self.assertRaises(daemon.DaemonError):
+            daemon.Server(self.socket)
+
+    def test_private_directory(self):
+        """ Without a runtime directory the socket goes in one of our own. """
+        env = {'TMPDIR': os.path.abspath('tmp'), 'XDG_RUNTIME_DIR': '',
+               'UMPTAG_SOCKET': ''}
+        os.mkdir('tmp')
+        with mock.patch.dict(os.environ, env):
+            server = daemon.Server()
+            try:
+                directory = os.path.dirname(server.path)
+                self.assertEqual(os.path.abspath('tmp'), os.path.dirname(directory))
+                self.assertEqual(0o700, stat.S_IMODE(os.stat(directory).st_mode))
+                self.assertEqual(0o600, stat.S_IMODE(os.stat(server.path).st_mode))
+            finally:
+                server.close()
+            os.chmod(directory, 0o755)
+            with self.assertRaises(daemon.DaemonError):
+                daemon.Server()
+
+    def test_someone_elses_daemon(self):
+        with mock.patch.object(os, 'getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(PermissionError):
+                client.Client(self.socket)
+            args = cli.build_parser().parse_args(('tags', 'sub/a'))
+            self.assertIsNone(client.run_command(args, self.socket))
+            with self.assertRaises(daemon.DaemonError):
+                daemon.Server(self.socket)
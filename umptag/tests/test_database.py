@@ -2,6 +2,8 @@
 Testcases for umptag.database. """
 import sqlite3
 import os
+import multiprocessing
+import time
 from random import randint, choice
 from . import DBTester, RealFS_DBTester
 from .utilities import make_random_word, get_random_hierarchy
@@ -48,8 +50,8 @@ class FetchConnectionTester(RealFS_DBTester):
         pass
 
     def test_init_connection(self):
-        database.initialize_conn(':memory:', new_db=True)
-        database.initialize_conn('.umptag.db', new_db=True)
+        database.initialize_conn(':memory:', new_db=True).close()
+        database.initialize_conn('.umptag.db', new_db=True).close()
         # Test some properties of the connection.
 
     def test_get_conn(self):
@@ -58,6 +60,8 @@ class FetchConnectionTester(RealFS_DBTester):
         c_1 = database.get_conn()
         c_2 = database.get_conn(database.DEFAULT_DB_NAME)
         c_3 = database.get_conn(':memory:')
+        for c in (c_1, c_2, c_3):
+            c.close()
         # Test some properties of the connection.
 
     def test_get_conn_failure(self):
@@ -65,11 +69,12 @@ class FetchConnectionTester(RealFS_DBTester):
             database.get_conn(fail_if_uninitialized=True)
 
     def test_get_conn_altname(self):
-        c = database.get_conn('foobar')
+        database.get_conn('foobar').close()
 
     def test_database_cognancy(self):
         # Setup the database.
-        with database.get_conn() as c:
+        c = database.get_conn()
+        with c:
             c.execute("CREATE TABLE foo ("
                     "id integer PRIMARY KEY,"
                     "second_id integer,"
@@ -79,9 +84,155 @@ class FetchConnectionTester(RealFS_DBTester):
             conn.execute("INSERT INTO foo (id, second_id, bar) VALUES (1, ?, ?)", (5, "moo"))
         database.database_cognant(test_me)()  # Run the wrapped function.
         with self.subTest():
-            outcoming = database.get_conn().execute("SELECT * FROM foo WHERE bar = ?", ("moo",))
+            outcoming = c.execute("SELECT * FROM foo WHERE bar = ?", ("moo",))
             self.assertIsNotNone(outcoming.fetchone())
         with self.subTest():
-            outcoming = database.get_conn().execute("SELECT * FROM foo WHERE bar = ?", ("geez",))
+            outcoming = c.execute("SELECT * FROM foo WHERE bar = ?", ("geez",))
             self.assertIsNone(outcoming.fetchone())
+        c.close()
 
+
+class MigrationTester(RealFS_DBTester):
+    legacy_schema = """
+        CREATE TABLE files (
+            id integer PRIMARY KEY, directory text NOT NULL, name text NOT NULL,
+            size integer, mod_time timestamp, is_dir boolean,
+            CONSTRAINT path UNIQUE (directory, name));
+        CREATE TABLE tags (
+            id integer PRIMARY KEY, key text DEFAULT '' NOT NULL,
+            value text NOT NULL, CONSTRAINT tag_pk UNIQUE (key, value));
+        CREATE TABLE filetag_junction (
+            file_id int, tag_id int,
+            CONSTRAINT file_tag_pk PRIMARY KEY (file_id, tag_id));"""
+
+    def test_new_database_version(self):
+        c = database.get_conn()
+        self.assertEqual(database.SCHEMA_VERSION, database.schema_version(c))
+        c.close()
+
+    def test_migrate_legacy_database(self):
+        c = sqlite3.connect(database.DEFAULT_DB_NAME)
+        c.executescript(self.legacy_schema)
+        c.executemany("INSERT INTO files (id, directory, name) VALUES (?,?,?)",
+                      [(1, '', 'a'), (2, 'd', 'b')])
+        c.executemany("INSERT INTO tags (id, key, value) VALUES (?,?,?)",
+                      [(1, '', 'x'), (2, 'k', 'y')])
+        junction = [(1, 1), (1, 2), (2, 2)]
+        c.executemany("INSERT INTO filetag_junction VALUES (?,?)", junction)
+        c.commit()
+        c.close()
+        c = database.get_conn(fail_if_uninitialized=True)
+        self.assertEqual(database.SCHEMA_VERSION, database.schema_version(c))
+        self.assertEqual(junction, c.execute(
+            "SELECT file_id, tag_id FROM filetag_junction ORDER BY 1, 2").fetchall())
+        sql = c.execute("""SELECT sql FROM sqlite_master
+                WHERE name = 'filetag_junction'""").fetchone()[0]
+        self.assertIn("WITHOUT ROWID", sql)
+        self.assertIsNotNone(c.execute("""SELECT 1 FROM sqlite_master
+                WHERE type = 'index' AND name = 'junction_tag_idx'""").fetchone())
+        plan = ' '.join(str(row) for row in c.execute(
+            "EXPLAIN QUERY PLAN SELECT file_id FROM filetag_junction WHERE tag_id = 2"))
+        self.assertIn("junction_tag_idx", plan)
+        self.assertEqual([(1, 1), (2, 2)], c.execute(
+            "SELECT tag_id, file_count FROM tag_stats ORDER BY 1").fetchall())
+        self.assertEqual([(1, '', 'a'), (2, 'd', 'b')], c.execute(
+            "SELECT id, directory, name FROM files ORDER BY id").fetchall())
+        self.assertEqual([('', None), ('d', 1)], c.execute(
+            "SELECT path, parent_id FROM directories ORDER BY path").fetchall())
+        c.close()
+
+    def test_migrate_directories(self):
+        """ Version 4 to 5: directories get their own table, including the
+        ones only repair had seen, and parents that held no files. """
+        c = database.get_conn()
+        c.executescript("""
+            DROP TRIGGER tag_insert_journal;
+            DROP TRIGGER tag_update_journal;
+            DROP TRIGGER tag_delete_journal;
+            DROP TRIGGER junction_insert_journal;
+            DROP TRIGGER junction_delete_journal;
+            DROP TABLE changes;
+            DROP TABLE sync_state;
+            DROP VIEW files;
+            DROP TABLE file_entries;
+            DROP TABLE directories;
+            CREATE TABLE files (
+                id integer PRIMARY KEY, directory text NOT NULL,
+                name text NOT NULL, size integer, mod_time timestamp,
+                is_dir boolean, hash text,
+                CONSTRAINT path UNIQUE (directory, name));
+            CREATE INDEX files_hash_idx ON files (hash);
+            CREATE TABLE scanned_dirs (directory text PRIMARY KEY,
+                                       mod_time timestamp);
+            INSERT INTO files (id, directory, name, hash) VALUES
+                (7, 'a/b', 'f', 'h'), (8, '', 'g', NULL);
+            INSERT INTO scanned_dirs VALUES ('c', '2018-01-01 00:00:00');
+            PRAGMA user_version = 4;""")
+        c.close()
+        c = database.get_conn(fail_if_uninitialized=True)
+        self.assertEqual([(7, 'a/b', 'f', 'h'), (8, '', 'g', None)], c.execute(
+            "SELECT id, directory, name, hash FROM files ORDER BY id").fetchall())
+        self.assertEqual([('', '', None), ('a', 'a', ''), ('a/b', 'b', 'a'),
+                          ('c', 'c', '')], c.execute("""SELECT d.path, d.name,
+                p.path FROM directories d LEFT JOIN directories p
+                ON p.id = d.parent_id ORDER BY d.path""").fetchall())
+        self.assertEqual([('c',)], c.execute(
+            "SELECT path FROM directories WHERE scan_mtime IS NOT NULL").fetchall())
+        self.assertIsNone(c.execute("""SELECT 1 FROM sqlite_master
+                WHERE name = 'scanned_dirs'""").fetchone())
+        c.close()
+
+
+def _tagging_worker(worker, rounds, names):
+    """ Runs in its own process; tags every file once per round, one
+    transaction per round. """
+    conn = database.get_conn(fail_if_uninitialized=True)
+    for r in range(rounds):
+        api.apply_tags_bulk(conn, (('', n, 'w%d' % worker, 'r%d' % r)
+                                   for n in names))
+    conn.close()
+
+
+class ConcurrencyTester(RealFS_DBTester):
+    """ Several processes tag the same library at once while we read. """
+    writers, rounds, file_count = 3, 15, 300
+
+    def test_pragmas(self):
+        c = database.get_conn()
+        self.assertEqual('wal', c.execute("PRAGMA journal_mode").fetchone()[0])
+        self.assertEqual(2, c.execute("PRAGMA temp_store").fetchone()[0])
+        self.assertEqual(database.PRAGMAS['busy_timeout'],
+                         c.execute("PRAGMA busy_timeout").fetchone()[0])
+        c.close()
+        c = database.get_conn(pragmas={'busy_timeout': 5})
+        self.assertEqual(5, c.execute("PRAGMA busy_timeout").fetchone()[0])
+        c.close()
+
+    def test_readers_never_block(self):
+        names = [make_random_word(8, 8) + str(i) for i in range(self.file_count)]
+        for n in names:
+            open(n, 'w').close()
+        database.get_conn().close()
+        procs = [multiprocessing.Process(target=_tagging_worker,
+                                         args=(w, self.rounds, names))
+                 for w in range(self.writers)]
+        for p in procs:
+            p.start()
+        # A reader that won't wait at all for locks.
+        reader = database.get_conn(pragmas={'journal_mode': 'wal',
+                                            'busy_timeout': 0})
+        reads, slowest = 0, 0.0
+        while any(p.is_alive() for p in procs):
+            start = time.perf_counter()
+            api.run_tag_query(reader, 'w0=r0 or w1=r1')
+            reader.execute("SELECT COUNT(*) FROM filetag_junction").fetchone()
+            slowest = max(slowest, time.perf_counter() - start)
+            reads += 1
+        for p in procs:
+            p.join()
+            self.assertEqual(0, p.exitcode)
+        self.assertGreater(reads, 0)
+        self.assertLess(slowest, 1.0)
+        self.assertEqual(self.writers * self.rounds * self.file_count,
+                reader.execute("SELECT COUNT(*) FROM filetag_junction").fetchone()[0])
+        reader.close()
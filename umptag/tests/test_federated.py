@@ -0,0 +1,112 @@
+""" test_federated.py:
+Testcases for umptag.federated. """
+import os
+import os.path
+import sqlite3
+from unittest import mock
+from . import RealFS_DBTester
+from .. import database, federated, filetags, query
+
+
+class FederatedTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.roots = ['p%d' % i for i in range(5)] + [os.path.join('p0', 'nested')]
+        for (i, root) in enumerate(self.roots):
+            os.makedirs(root, exist_ok=True)
+            conn = database.initialize_conn(
+                os.path.join(root, database.DEFAULT_DB_NAME), True)
+            filetags.tag_files_bulk(conn, [
+                ('', 'all', None, None, False, '', 'common'),
+                ('d', 'odd' if i % 2 else 'even', None, None, False, 'n', str(i))])
+            if i == 3:
+                filetags.tag_files_bulk(conn, [('', 'x', None, None, False, '', 'rare')])
+            conn.commit()
+            conn.close()
+        self.catalogue = federated.open_catalogue(':memory:')
+
+    def tearDown(self):
+        self.catalogue.close()
+        super().tearDown()
+
+    def paths(self):
+        return federated.databases(os.curdir, self.catalogue)
+
+    def test_discover(self):
+        expected = sorted(os.path.abspath(os.path.join(root, database.DEFAULT_DB_NAME))
+                          for root in self.roots)
+        self.assertEqual(expected, self.paths())
+
+    def test_query(self):
+        paths = self.paths()
+        results = list(federated.run_query('common', paths))
+        self.assertEqual([(path, '', 'all') for path in paths], results)
+        self.assertEqual([(os.path.abspath(os.path.join('p3', database.DEFAULT_DB_NAME)),
+                           '', 'x')],
+                         list(federated.run_query('rare', paths)))
+        self.assertEqual(5, len(list(federated.run_query('n= and not n=1', paths))))
+
+    def test_groups(self):
+        """ More databases than can be attached at once. """
+        paths = self.paths()
+        with mock.patch.object(federated, 'attach_limit', return_value=2):
+            results = list(federated.run_query('common or n=4', paths, batch_size=1))
+        self.assertEqual(len(paths) + 1, len(results))
+        self.assertEqual(sorted(results), results)
+
+    def test_skips(self):
+        with open(os.path.join('p1', database.DEFAULT_DB_NAME), 'wb') as f:
+            f.write(b'not a database at all, really' * 100)
+        os.makedirs('other')
+        sqlite3.connect(os.path.join('other', database.DEFAULT_DB_NAME)).execute(
+            "CREATE TABLE t (x)").connection.close()
+        skipped = []
+        paths = federated.databases(os.curdir, self.catalogue, refresh=True)
+        results = list(federated.run_query(
+            'common', paths, on_skip=lambda path, reason: skipped.append(path)))
+        self.assertEqual(len(self.roots) - 1, len(results))
+        self.assertEqual(sorted(os.path.abspath(os.path.join(d, database.DEFAULT_DB_NAME))
+                                for d in ('p1', 'other')), sorted(skipped))
+
+    def test_catalogue(self):
+        first = self.paths()
+        os.makedirs('p9')
+        database.initialize_conn(os.path.join('p9', database.DEFAULT_DB_NAME), True).close()
+        with mock.patch.object(federated, 'discover') as discover:
+            self.assertEqual(first, self.paths())
+            # A directory below a walked root is answered from its walk.
+            self.assertEqual([os.path.abspath(os.path.join('p0', 'nested',
+                                                           database.DEFAULT_DB_NAME))],
+                             federated.databases(os.path.join('p0', 'nested'),
+                                                 self.catalogue))
+            discover.assert_not_called()
+        self.assertEqual(len(first) + 1, len(federated.databases(
+            os.curdir, self.catalogue, refresh=True)))
+        self.assertEqual(len(first) + 1, len(federated.databases(
+            os.curdir, self.catalogue, max_age=0)))
+
+    def test_syntax_error(self):
+        with self.assertRaises(query.QuerySyntaxError):
+            list(federated.run_query('(common', self.paths()))
+
+    def test_rarity(self):
+        """ Each database's terms are ordered by its own statistics, or as
+        written if it has none. """
+        path = os.path.join('p3', database.DEFAULT_DB_NAME)
+        conn = database.initialize_conn(path, False)
+        filetags.tag_files_bulk(conn, [('', name, None, None, False, '', 'common')
+                                       for name in ('x', 'y', 'z')])
+        conn.commit()
+        conn.close()
+        conn = sqlite3.connect(':memory:')
+        try:
+            conn.execute("ATTACH DATABASE ? AS db0", (path,))
+            _, params = query.compile_ids_in(conn, 'db0', 'common and rare')
+            self.assertEqual(['', 'rare', '', 'common'], params)
+            conn.execute("DROP TABLE db0.tag_stats")
+            _, params = query.compile_ids_in(conn, 'db0', 'common and rare')
+            self.assertEqual(['', 'common', '', 'rare'], params)
+        finally:
+            conn.close()
+        self.assertEqual([(os.path.abspath(path), '', 'x')],
+                         list(federated.run_query('common and rare', self.paths())))
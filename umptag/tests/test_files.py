@@ -6,7 +6,7 @@ from sqlite3 import IntegrityError, OperationalError
 # My modules.
 from .. import fs
 from . import DBTester
-from .utilities import make_random_word
+from .utilities import make_random_word, get_random_hierarchy
 
 
 class FileTester(DBTester):
@@ -157,3 +157,90 @@ class TestFileFunctions(DBTester):
                     """SELECT directory, name FROM files WHERE
                     directory = ? AND
                     name = ?""", (d, n)).fetchone())
+
+
+class CollectFilesTester(DBTester):
+    def setUp(self):
+        super().setUp()
+        self.filepaths, self.dirpaths = get_random_hierarchy()
+        for dp in self.dirpaths:
+            self.fs.create_dir(dp)
+        for fp in self.filepaths:
+            self.fs.create_file(fp, contents='x' * randrange(0, 50))
+
+    def walked(self):
+        out = set()
+        for (root, dirs, files) in os.walk(os.curdir):
+            for name in dirs + files:
+                out.add(os.path.split(os.path.normpath(os.path.join(root, name))))
+        return out
+
+    def test_collect_files(self):
+        records = list(fs.collect_files(workers=3))
+        self.assertEqual(self.walked(), set((d, n) for (d, n, *_) in records))
+        self.assertEqual(len(records), len(set((d, n) for (d, n, *_) in records)))
+        for (d, n, size, mod_time, is_dir) in records:
+            path = os.path.join(d, n)
+            self.assertEqual(os.path.isdir(path), is_dir)
+            self.assertEqual(os.stat(path).st_size, size)
+            self.assertEqual(datetime.fromtimestamp(os.stat(path).st_mtime), mod_time)
+
+    def test_collect_files_subdirectory(self):
+        top = self.dirpaths[0]
+        for (d, n, *_) in fs.collect_files(top):
+            self.assertTrue(d == top or d.startswith(top + os.sep))
+
+    def test_collect_files_filters(self):
+        pruned = self.dirpaths[0]
+        records = list(fs.collect_files(exclude=pruned, include='*[a-m]'))
+        for (d, n, *_) in records:
+            self.assertNotIn(pruned, (d.split(os.sep)[0], n))
+            self.assertRegex(n, '[a-m]$')
+
+    def test_add_files(self):
+        records = list(fs.collect_files())
+        fs.add_files(self.conn, records)
+        fs.add_files(self.conn, records)
+        self.assertEqual(len(records), self.conn.execute(
+            "SELECT COUNT(*) FROM files").fetchone()[0])
+
+    def test_files_under(self):
+        fs.add_files(self.conn, fs.collect_files())
+        top = self.dirpaths[0]
+        expected = sorted((d, n) for (d, n) in self.walked()
+                          if d == top or d.startswith(top + os.sep))
+        self.assertEqual(expected, fs.files_under(self.conn, top).fetchall())
+        self.assertEqual(len(self.walked()),
+                         len(fs.files_under(self.conn, '').fetchall()))
+
+
+class DirectoryTester(DBTester):
+    def test_parents_added(self):
+        cache = {}
+        dir_id = fs.get_or_add_dir_id(self.conn, os.path.join('a', 'b', 'c'), cache)
+        self.assertEqual(dir_id, fs.get_or_add_dir_id(self.conn, os.path.join('a', 'b', 'c')))
+        self.assertEqual([('', None), ('a', ''), (os.path.join('a', 'b'), 'a'),
+                          (os.path.join('a', 'b', 'c'), os.path.join('a', 'b'))],
+                         self.conn.execute("""SELECT d.path, p.path FROM directories d
+                LEFT JOIN directories p ON p.id = d.parent_id ORDER BY d.path""").fetchall())
+        self.assertEqual(4, len(cache))
+
+    def test_files_view(self):
+        """ The old files table still works for reading and writing. """
+        self.conn.execute("INSERT INTO files (directory, name, size) VALUES (?,?,?)",
+                          ('x', 'y', 5))
+        self.conn.execute("UPDATE files SET directory = ? WHERE name = ?", ('z', 'y'))
+        self.assertEqual([('z', 'y', 5)], self.conn.execute(
+            "SELECT directory, name, size FROM files").fetchall())
+        self.assertEqual(1, self.conn.execute("""SELECT COUNT(*) FROM file_entries
+                WHERE dir_id = (SELECT id FROM directories WHERE path = 'z')""").fetchone()[0])
+        self.conn.execute("DELETE FROM files WHERE name = ?", ('y',))
+        self.assertEqual(0, self.conn.execute(
+            "SELECT COUNT(*) FROM file_entries").fetchone()[0])
+
+    def test_sibling_prefix(self):
+        """ 'a.b' sorts between 'a' and 'a/', and 'a/' isn't a prefix of it. """
+        for (d, n) in (('a', 'x'), ('a.b', 'y'), (os.path.join('a', 'c'), 'z'), ('ab', 'w')):
+            self.conn.execute("INSERT INTO files (directory, name) VALUES (?,?)", (d, n))
+        self.assertEqual([('a', 'x'), (os.path.join('a', 'c'), 'z')],
+                         fs.files_under(self.conn, 'a').fetchall())
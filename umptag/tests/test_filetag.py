@@ -63,7 +63,7 @@ class TestFiletagJunctionFunctions(JunctionTester):
                 fs._add_file(c, d, n)
                 for pair in self.pairs:  # For each tag, we go through.
                     # with self.subTest(pair=pair):
-                    logging.debug("Using pair <%s=%s>.", (*pair))
+                    logging.debug("Using pair <%s=%s>.", *pair)
                     tags.get_or_add_tag(c, *pair)  # Adding the tag.
                     # We check that it works by getting the ids directly.
                     file_id = fs._get_file_property(c, d, n, 'id')
@@ -119,3 +119,34 @@ class TestFiletagJunctionFunctions(JunctionTester):
                     logging.debug("Files we got back: {}.".format(', '.join('='.join(_) for _ in tagfiles)))
                     self.assertEqual(sorted(seen), sorted(tagfiles))
 
+
+    def test_iter_files_of_tag(self):
+        with self.conn as c:
+            tag = self.pairs[0]
+            for fp in self.fake_filepaths:
+                filetags.tag_file(c, *os.path.split(fp), *tag)
+            for batch_size in (1, 2, 1000):
+                with self.subTest(batch_size=batch_size):
+                    self.assertEqual(
+                        sorted(filetags.files_of_tag(c, *tag)),
+                        sorted(filetags.iter_files_of_tag(
+                            c, *tag, batch_size=batch_size)))
+            d, n = os.path.split(self.fake_filepath)
+            self.assertEqual(filetags.tags_of_file(c, d, n),
+                             list(filetags.iter_tags_of_file(c, d, n, batch_size=1)))
+            self.assertEqual([], list(filetags.iter_files_of_tag(c, *self.pairs[1])))
+
+    def test_exists_predicates(self):
+        with self.conn as c:
+            d, n = os.path.split(self.fake_filepath)
+            tag, other = self.pairs[0], self.pairs[1]
+            self.assertFalse(filetags.file_has_tag(c, d, n, *tag))
+            self.assertFalse(filetags.file_has_tags(c, d, n))
+            self.assertFalse(filetags.tag_has_files(c, *tag))
+            filetags.tag_file(c, d, n, *tag)
+            tags.get_or_add_tag(c, *other)
+            self.assertTrue(filetags.file_has_tag(c, d, n, *tag))
+            self.assertTrue(filetags.file_has_tags(c, d, n))
+            self.assertTrue(filetags.tag_has_files(c, *tag))
+            self.assertFalse(filetags.file_has_tag(c, d, n, *other))
+            self.assertFalse(filetags.tag_has_files(c, *other))
@@ -0,0 +1,64 @@
+""" test_hashing.py:
+Testcases for umptag.hashing. """
+import hashlib
+import os
+from . import RealFS_DBTester
+from .. import api, database, fs, hashing
+
+
+class HashTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.conn = database.initialize_conn(database.DEFAULT_DB_NAME, True)
+        self.contents = {'small': b'hello', 'empty': b'',
+                         'big': os.urandom(3000)}
+        for (name, data) in self.contents.items():
+            with open(name, 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def expected(self, name):
+        return hashlib.blake2b(self.contents[name]).hexdigest()
+
+    def stored(self, name):
+        return fs._get_file_property(self.conn, '', name, 'hash')
+
+    def test_hash_file(self):
+        for name in self.contents:
+            with self.subTest(name=name):
+                self.assertEqual(self.expected(name), hashing.hash_file(name))
+                # Small chunks force the memory-mapped path.
+                self.assertEqual(self.expected(name),
+                                 hashing.hash_file(name, chunk_size=64))
+
+    def test_hash_files_pool(self):
+        paths = [(name, len(data)) for (name, data) in self.contents.items()]
+        paths.append(('nonexistent', 0))
+        got = dict(hashing.hash_files(paths, workers=2, large=1000))
+        self.assertEqual({name: self.expected(name) for name in self.contents},
+                         {k: v for (k, v) in got.items() if k != 'nonexistent'})
+        self.assertIsNone(got['nonexistent'])
+
+    def test_add_file_with_hash(self):
+        fs._add_file(self.conn, '', 'small')
+        fs.get_or_add_file(self.conn, '', 'big', with_hash=True)
+        self.assertIsNone(self.stored('small'))
+        self.assertEqual(self.expected('big'), self.stored('big'))
+
+    def test_fill_hashes(self):
+        for name in self.contents:
+            api.apply_tag(self.conn, '', name, 'foo')
+        self.assertEqual(3, hashing.fill_hashes(self.conn, large=1000))
+        for name in self.contents:
+            self.assertEqual(self.expected(name), self.stored(name))
+        # Nothing changed, so nothing gets rehashed.
+        self.assertEqual(0, hashing.fill_hashes(self.conn))
+        self.contents['small'] = b'goodbye'
+        with open('small', 'wb') as f:
+            f.write(self.contents['small'])
+        self.assertEqual(1, hashing.fill_hashes(self.conn))
+        self.assertEqual(self.expected('small'), self.stored('small'))
+        self.assertEqual(3, hashing.fill_hashes(self.conn, force=True))
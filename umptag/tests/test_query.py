@@ -0,0 +1,97 @@
+""" test_query.py:
+Testcases for umptag.query. """
+import unittest
+from . import DBTester
+from .. import query
+
+
+class ParseTester(unittest.TestCase):
+    def test_terms(self):
+        self.assertEqual(('tag', '', 'foo'), query.parse('foo'))
+        self.assertEqual(('tag', 'year', '2018'), query.parse('year=2018'))
+        self.assertEqual(('key', 'year'), query.parse('year='))
+
+    def test_precedence(self):
+        self.assertEqual(
+            ('or', [('tag', '', 'a'),
+                    ('and', [('tag', '', 'b'), ('not', ('tag', '', 'c'))])]),
+            query.parse('a or b and not c'))
+        self.assertEqual(
+            ('and', [('or', [('tag', '', 'a'), ('tag', '', 'b')]),
+                     ('tag', '', 'c')]),
+            query.parse('(a | b) c'))
+
+    def test_negation_forms(self):
+        expected = ('and', [('tag', '', 'a'), ('not', ('tag', '', 'b'))])
+        for query_str in ('a and not b', 'a & !b', 'a -b', 'a AND NOT b'):
+            with self.subTest(query_str=query_str):
+                self.assertEqual(expected, query.parse(query_str))
+
+    def test_syntax_errors(self):
+        for query_str in ('', '(a or b', 'a or', 'and a', 'a )', '()'):
+            with self.subTest(query_str=query_str):
+                with self.assertRaises(query.QuerySyntaxError):
+                    query.compile_query(query_str)
+
+
+class RunQueryTester(DBTester):
+    def setUp(self):
+        super().setUp()
+        self.tagged = {
+            'a': {('', 'vacation'), ('year', '2018')},
+            'b': {('', 'trip'), ('year', '2018'), ('', 'blurry')},
+            'c': {('', 'trip'), ('year', '2017')},
+            'd': {('', 'vacation'), ('year', '2018'), ('', 'blurry')},
+            'e': {('', 'other')},
+        }
+        for name, file_tags in self.tagged.items():
+            self.conn.execute(
+                "INSERT INTO files (directory, name) VALUES (?,?)", ('', name))
+            for tg in file_tags:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO tags (key, value) VALUES (?,?)", tg)
+                self.conn.execute("""INSERT INTO filetag_junction
+                    SELECT (SELECT id FROM files WHERE name = ?),
+                           (SELECT id FROM tags WHERE key = ? AND value = ?)""",
+                    (name, *tg))
+
+    def check(self, query_str, names):
+        got = query.run_query(self.conn, query_str).fetchall()
+        self.assertEqual([('', n) for n in sorted(names)], got)
+
+    def test_queries(self):
+        cases = [('vacation', 'ad'),
+                 ('vacation trip', ''),
+                 ('vacation or trip', 'abcd'),
+                 ('year=2018', 'abd'),
+                 ('year=', 'abcd'),
+                 ('not year=', 'e'),
+                 ('not blurry', 'ace'),
+                 ('(vacation or trip) and year=2018 and not blurry', 'a'),
+                 ('not (vacation or trip)', 'e'),
+                 ('trip -(year=2017 | blurry)', ''),
+                 ('missing', ''),
+                 ('not missing', 'abcde')]
+        for (query_str, names) in cases:
+            with self.subTest(query_str=query_str):
+                self.check(query_str, names)
+
+    def test_single_statement(self):
+        sql, params = query.compile_query('(vacation or trip) and not blurry')
+        self.assertEqual(1, sql.count('SELECT directory, name FROM files'))
+        self.assertEqual(('', 'vacation', '', 'trip', '', 'blurry'), params)
+        self.assertIs(query.compile_query('(vacation or trip) and not blurry'),
+                      query.compile_query('(vacation or trip) and not blurry'))
+
+    def test_rarest_first(self):
+        """ 'vacation' has two files and 'year=2018' three, so the join
+        starts from vacation however the query is written. """
+        statements = []
+        self.conn.set_trace_callback(statements.append)
+        for query_str in ('year=2018 and vacation', 'vacation and year=2018'):
+            with self.subTest(query_str=query_str):
+                self.check(query_str, 'ad')
+                sql = statements[-1]
+                self.assertIn('CROSS JOIN', sql)
+                self.assertLess(sql.index("'vacation'"), sql.index("'2018'"))
+        self.conn.set_trace_callback(None)
@@ -0,0 +1,116 @@
+""" test_repair.py:
+Testcases for umptag.repair. """
+import os
+import os.path
+from unittest import mock
+from . import RealFS_DBTester
+from .utilities import make_random_word
+from .. import api, database, filetags, fs, hashing, repair
+
+
+class RepairTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.db_name = database.DEFAULT_DB_NAME
+        self.conn = database.initialize_conn(self.db_name, True)
+        for d in ('a', 'b', 'c'):
+            os.mkdir(d)
+        self.files = [('a', 'x'), ('a', 'y'), ('b', 'z')]
+        for i, (d, n) in enumerate(self.files):
+            with open(os.path.join(d, n), 'w') as f:
+                f.write('.' * (i + 1))  # Distinct sizes.
+        self.tag = make_random_word()
+        for (d, n) in self.files:
+            api.apply_tag(self.conn, d, n, self.tag)
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def test_move_to_new_directory(self):
+        repair.repair(self.conn)  # Baseline.
+        os.mkdir('new')
+        os.rename(os.path.join('a', 'x'), os.path.join('new', 'x2'))
+        report = repair.repair(self.conn)
+        self.assertEqual([(os.path.join('a', 'x'), os.path.join('new', 'x2'))],
+                         report.moved)
+        self.assertEqual([], report.missing)
+        self.assertEqual([('', self.tag)],
+                         filetags.tags_of_file(self.conn, 'new', 'x2'))
+        self.assertEqual([], filetags.tags_of_file(self.conn, 'a', 'x'))
+
+    def test_move_to_untracked_directory(self):
+        repair.repair(self.conn)
+        os.rename(os.path.join('b', 'z'), os.path.join('c', 'z'))
+        report = repair.repair(self.conn)
+        self.assertEqual([(os.path.join('b', 'z'), os.path.join('c', 'z'))],
+                         report.moved)
+        self.assertIn(('c', 'z'), filetags.files_of_tag(self.conn, '', self.tag))
+
+    def test_first_repair(self):
+        """ Without a baseline, everything gets scanned. """
+        os.rename(os.path.join('a', 'y'), os.path.join('c', 'y'))
+        report = repair.repair(self.conn)
+        self.assertEqual([(os.path.join('a', 'y'), os.path.join('c', 'y'))],
+                         report.moved)
+
+    def test_missing_and_modified(self):
+        repair.repair(self.conn)
+        os.remove(os.path.join('a', 'x'))
+        with open(os.path.join('b', 'z'), 'a') as f:
+            f.write('more')
+        report = repair.repair(self.conn, full=True)
+        self.assertEqual([os.path.join('a', 'x')], report.missing)
+        self.assertEqual([os.path.join('b', 'z')], report.modified)
+        self.assertEqual(os.stat(os.path.join('b', 'z')).st_size,
+                         fs._get_file_property(self.conn, 'b', 'z', 'size'))
+
+    def test_repair_directories(self):
+        """ Only the directories named are listed, and not what's below. """
+        os.rename(os.path.join('a', 'x'), os.path.join('b', 'x'))
+        os.remove(os.path.join('b', 'z'))
+        with mock.patch.object(fs, '_scan_directory',
+                               wraps=fs._scan_directory) as scan:
+            report = repair.repair_directories(self.conn, ['a', 'b'])
+        self.assertEqual({'a', 'b'}, set(call[0][0] for call in scan.call_args_list))
+        self.assertEqual([(os.path.join('a', 'x'), os.path.join('b', 'x'))],
+                         report.moved)
+        self.assertEqual([os.path.join('b', 'z')], report.missing)
+
+    def test_only_changed_directories_listed(self):
+        repair.repair(self.conn)
+        os.rename(os.path.join('a', 'y'), os.path.join('a', 'y2'))
+        with mock.patch.object(fs, '_scan_directory',
+                               wraps=fs._scan_directory) as scan:
+            report = repair.repair(self.conn)
+        listed = set(call[0][0] for call in scan.call_args_list)
+        # The database's own journal can touch the top directory.
+        self.assertEqual({'a'}, listed - {''})
+        self.assertEqual([(os.path.join('a', 'y'), os.path.join('a', 'y2'))],
+                         report.moved)
+
+    def test_ambiguous_move(self):
+        """ Two candidates look the same, so neither gets picked. """
+        repair.repair(self.conn)
+        os.rename(os.path.join('a', 'x'), os.path.join('c', 'x'))
+        with open(os.path.join('c', 'w'), 'w') as f:
+            f.write('.')
+        st = os.stat(os.path.join('c', 'x'))
+        os.utime(os.path.join('c', 'w'), ns=(st.st_atime_ns, st.st_mtime_ns))
+        report = repair.repair(self.conn)
+        self.assertEqual([], report.moved)
+        self.assertEqual([os.path.join('a', 'x')], report.missing)
+
+    def test_move_matched_by_hash(self):
+        """ A stored hash picks out the right one of two look-alikes. """
+        hashing.fill_hashes(self.conn)
+        repair.repair(self.conn)
+        os.rename(os.path.join('a', 'x'), os.path.join('c', 'x'))
+        with open(os.path.join('c', 'w'), 'w') as f:
+            f.write('#')
+        st = os.stat(os.path.join('c', 'x'))
+        os.utime(os.path.join('c', 'w'), ns=(st.st_atime_ns, st.st_mtime_ns))
+        report = repair.repair(self.conn)
+        self.assertEqual([(os.path.join('a', 'x'), os.path.join('c', 'x'))],
+                         report.moved)
@@ -0,0 +1,141 @@
+""" test_session.py:
+Testcases for umptag.session. """
+import contextlib
+import os
+import os.path
+from pathlib import Path
+from random import choice
+from . import RealFS_DBTester
+from .utilities import make_random_word
+from .. import database, filetags, fs, session, tags
+
+
+class Session_DBTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.db_name = database.DEFAULT_DB_NAME
+        self.filepaths = [make_random_word() for _ in range(4)]
+        for fp in self.filepaths:
+            Path(fp).touch()
+        database.initialize_conn(self.db_name, True).close()
+
+
+class SessionTester(Session_DBTester):
+
+    def test_apply_and_remove(self):
+        d, n = os.path.split(choice(self.filepaths))
+        tg, ktg = make_random_word(), (make_random_word(), make_random_word())
+        with session.Session(self.db_name) as s:
+            self.assertEqual(0, s.apply_tag(d, n, tg))
+            self.assertEqual(0, s.apply_tag(d, n, *ktg))
+            self.assertEqual(1, s.apply_tag(d, n, tg))
+            self.assertEqual({('', tg), ktg}, set(s.tags_of_file(d, n)))
+            self.assertEqual([(d, n)], s.files_of_tag(tg))
+            self.assertEqual([(d, n)], s.query('%s and %s=%s' % (tg, *ktg)))
+            self.assertEqual(0, s.remove_tag(d, n, tg))
+            self.assertEqual(1, s.remove_tag(d, n, tg))
+            self.assertEqual(1, s.remove_tag(d, n, make_random_word()))
+        with contextlib.closing(database.get_conn(self.db_name)) as c:
+            self.assertEqual([ktg], filetags.tags_of_file(c, d, n))
+            self.assertIsNone(c.execute("SELECT id FROM tags WHERE value = ?",
+                                        (tg,)).fetchone())
+
+    def test_orphaned_file_removed(self):
+        d, n = os.path.split(choice(self.filepaths))
+        with session.Session(self.db_name) as s:
+            s.apply_tag(d, n, 'foo')
+            s.remove_tags(d, n, 'foo')
+            self.assertIsNone(s.conn.execute(
+                "SELECT id FROM files WHERE directory = ? AND name = ?",
+                (d, n)).fetchone())
+
+    def test_directory_removed(self):
+        """ The directory cache doesn't hand out ids of directories that
+        went with their last file. """
+        os.makedirs(os.path.join('a', 'b'))
+        for n in ('f', 'g'):
+            Path('a', 'b', n).touch()
+        d = os.path.join('a', 'b')
+        with session.Session(self.db_name) as s:
+            s.apply_tag(d, 'f', 'foo')
+            s.remove_tag(d, 'f', 'foo')
+            s.apply_tag(d, 'g', 'foo')
+            self.assertEqual([(d, 'g')], s.files_of_tag('foo'))
+
+    def test_merge_and_bulk(self):
+        with session.Session(self.db_name) as s:
+            s.apply_tags_bulk((*os.path.split(fp), 'old', None)
+                              for fp in self.filepaths)
+            s.merge_tag('new', None, 'old', None)
+            self.assertEqual(sorted(os.path.split(fp) for fp in self.filepaths),
+                             sorted(s.files_of_tag('new')))
+            self.assertEqual([], s.files_of_tag('old'))
+
+    def test_rollback_on_error(self):
+        d, n = os.path.split(choice(self.filepaths))
+        with self.assertRaises(ZeroDivisionError):
+            with session.Session(self.db_name) as s:
+                s.apply_tag(d, n, 'foo')
+                1 / 0
+        with contextlib.closing(database.get_conn(self.db_name)) as c:
+            self.assertEqual([], filetags.tags_of_file(c, d, n))
+
+
+class TagCacheTester(Session_DBTester):
+    def test_lru(self):
+        cache = session.TagCache(size=2)
+        cache.put('', 'a', 1)
+        cache.put('', 'b', 2)
+        cache.get('', 'a')
+        cache.put('', 'c', 3)
+        self.assertEqual(1, cache.get('', 'a'))
+        self.assertIsNone(cache.get('', 'b'))
+        self.assertEqual(3, cache.get('', 'c'))
+
+    def check_cached_ids(self, s):
+        """ Every cached id has to be the tag's real id. """
+        for ((k, v), tag_id) in s.tag_cache._ids.items():
+            self.assertEqual(tag_id, s.conn.execute(
+                "SELECT id FROM tags WHERE key = ? AND value = ?",
+                (k, v)).fetchone()[0])
+
+    def test_invalidation(self):
+        d, n = os.path.split(self.filepaths[0])
+        d2, n2 = os.path.split(self.filepaths[1])
+        with session.Session(self.db_name) as s:
+            s.apply_tag(d, n, 'foo')
+            s.apply_tag(d2, n2, 'bar')
+            self.assertIsNotNone(s.tag_cache.get('', 'foo'))
+            s.remove_tag(d, n, 'foo')  # Orphaned, so the tag goes.
+            self.assertIsNone(s.tag_cache.get('', 'foo'))
+            s.apply_tag(d, n, 'foo')
+            s.merge_tag('bar', None, 'foo', None)
+            self.assertIsNone(s.tag_cache.get('', 'foo'))
+            s.apply_tag(d, n, 'baz')
+            s.delete_tag('baz')
+            self.assertIsNone(s.tag_cache.get('', 'baz'))
+            s.apply_tag(d, n, 'foo')
+            self.check_cached_ids(s)
+            self.assertEqual({('', 'bar'), ('', 'foo')}, set(s.tags_of_file(d, n)))
+
+    def test_rollback_clears_cache(self):
+        d, n = os.path.split(self.filepaths[0])
+        s = session.Session(self.db_name)
+        s.apply_tag(d, n, 'foo')
+        s.rollback()
+        s.apply_tag(d, n, 'bar')
+        s.apply_tag(d, n, 'foo')
+        self.check_cached_ids(s)
+        self.assertEqual({('', 'bar'), ('', 'foo')}, set(s.tags_of_file(d, n)))
+        s.close()
+
+    def test_deferred_cleanup(self):
+        d, n = os.path.split(self.filepaths[0])
+        with session.Session(self.db_name, deferred_cleanup=True) as s:
+            s.apply_tag(d, n, 'foo')
+            s.remove_tag(d, n, 'foo')
+            self.assertIsNotNone(tags._get_tag_id(s.conn, '', 'foo'))
+            s.commit()
+            self.assertIsNone(tags._get_tag_id(s.conn, '', 'foo'))
+            self.assertIsNone(s.tag_cache.get('', 'foo'))
+            self.assertIsNone(fs._get_file_id(s.conn, d, n))
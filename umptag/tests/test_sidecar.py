@@ -0,0 +1,160 @@
+""" test_sidecar.py:
+Testcases for umptag.sidecar. """
+import errno
+import json
+import os
+import os.path
+import unittest
+from unittest import mock
+from . import RealFS_DBTester
+from .. import api, database, filetags, repair, sidecar
+
+
+def xattrs_work():
+    if not hasattr(os, 'setxattr'):
+        return False
+    try:
+        with open('.probe', 'w'):
+            pass
+        os.setxattr('.probe', sidecar.XATTR, b'[]')
+        return True
+    except OSError:
+        return False
+    finally:
+        if os.path.exists('.probe'):
+            os.remove('.probe')
+
+
+class SidecarTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.conn = database.initialize_conn(database.DEFAULT_DB_NAME, True)
+        os.mkdir('a')
+        self.files = [('', 'x'), ('a', 'y'), ('a', 'z')]
+        for i, (d, n) in enumerate(self.files):
+            with open(os.path.join(d, n), 'w') as f:
+                f.write('.' * (i + 1))  # Distinct sizes, for repair.
+        api.apply_tag(self.conn, '', 'x', 'foo')
+        api.apply_tag(self.conn, 'a', 'y', 'foo')
+        api.apply_tag(self.conn, 'a', 'y', 'year', '2018')
+        self.conn.commit()
+
+    def tearDown(self):
+        self.conn.close()
+        super().tearDown()
+
+    def test_sidecar_mode(self):
+        self.assertEqual(2, sidecar.sync(self.conn, 'sidecar'))
+        self.assertEqual({'x': [['', 'foo']]}, sidecar.read_sidecar(''))
+        self.assertEqual({'y': [['', 'foo'], ['year', '2018']]},
+                         sidecar.read_sidecar('a'))
+
+    def test_incremental(self):
+        sidecar.sync(self.conn, 'sidecar')
+        since, latest = sidecar.pending(self.conn)
+        self.assertEqual(since, latest)
+        self.assertEqual(0, sidecar.sync(self.conn, 'sidecar'))
+        api.apply_tag(self.conn, 'a', 'z', 'bar')
+        self.conn.commit()
+        self.assertEqual(1, sidecar.sync(self.conn, 'sidecar'))
+        self.assertEqual(['y', 'z'], sorted(sidecar.read_sidecar('a')))
+        self.assertEqual(sidecar.pending(self.conn)[1],
+                         sidecar.pending(self.conn)[0])
+
+    def test_removal(self):
+        sidecar.sync(self.conn, 'sidecar')
+        api.remove_tag(self.conn, '', 'x', 'foo')
+        api.remove_tag(self.conn, 'a', 'y', 'year', '2018')
+        self.conn.commit()
+        sidecar.sync(self.conn, 'sidecar')
+        self.assertFalse(os.path.exists(sidecar.SIDECAR_NAME))
+        self.assertEqual({'y': [['', 'foo']]}, sidecar.read_sidecar('a'))
+
+    def test_move(self):
+        repair.repair(self.conn)
+        sidecar.sync(self.conn, 'sidecar')
+        os.rename(os.path.join('a', 'y'), 'y2')
+        repair.repair(self.conn)
+        self.assertEqual(1, sidecar.sync(self.conn, 'sidecar'))
+        self.assertEqual({}, sidecar.read_sidecar('a'))
+        self.assertEqual(['x', 'y2'], sorted(sidecar.read_sidecar('')))
+
+    def test_compacted_away(self):
+        """ Entries removed before they were synced mean a full pass. """
+        sidecar.sync(self.conn, 'sidecar')
+        api.apply_tag(self.conn, 'a', 'z', 'bar')
+        self.conn.commit()
+        api.compact_changes(self.conn, api.latest_change(self.conn))
+        self.assertEqual(3, sidecar.sync(self.conn, 'sidecar'))
+        self.assertIn('z', sidecar.read_sidecar('a'))
+
+    def test_import(self):
+        sidecar.sync(self.conn, 'sidecar')
+        with open(os.path.join('a', sidecar.SIDECAR_NAME)) as f:
+            entries = json.load(f)
+        entries['z'] = [['kind', 'draft']]
+        with open(os.path.join('a', sidecar.SIDECAR_NAME), 'w') as f:
+            json.dump(entries, f)
+        self.assertEqual(1, sidecar.import_tags(self.conn))
+        self.assertIn(('a', 'z'), api.run_tag_query(self.conn, 'kind=draft'))
+        # Nothing else was pending, so the import leaves nothing to sync.
+        self.assertEqual(0, sidecar.sync(self.conn, 'sidecar'))
+
+    def test_import_malformed(self):
+        """ Attributes and sidecar entries of the wrong shape are skipped. """
+        attributes = {'x': b'{"": "foo"}', os.path.join('a', 'y'): b'[["only"]]',
+                      os.path.join('a', 'z'): b'[["k", 1]]'}
+
+        def getxattr(path, attribute):
+            if path not in attributes:
+                raise OSError(errno.ENODATA, "No data available")
+            return attributes[path]
+
+        with open(os.path.join('a', sidecar.SIDECAR_NAME), 'w') as f:
+            json.dump({'y': {'kind': 'draft'}, 'z': [['kind', 'draft']]}, f)
+        with mock.patch.object(os, 'getxattr', side_effect=getxattr, create=True):
+            self.assertEqual(1, sidecar.import_tags(self.conn))
+        self.assertEqual([('a', 'z')], api.run_tag_query(self.conn, 'kind='))
+        with open(sidecar.SIDECAR_NAME, 'w') as f:
+            f.write('[not json')
+        self.assertEqual(0, sidecar.import_tags(self.conn))
+
+    def test_import_chunks(self):
+        with open(os.path.join('a', sidecar.SIDECAR_NAME), 'w') as f:
+            json.dump({'z': [['', 'one'], ['', 'two'], ['', 'three']]}, f)
+        with mock.patch.object(filetags, 'tag_files_bulk',
+                               wraps=filetags.tag_files_bulk) as bulk:
+            self.assertEqual(3, sidecar.import_tags(self.conn, chunk_size=2))
+        self.assertEqual([2, 1], [len(call[0][1]) for call in bulk.call_args_list])
+
+    def test_bad_mode(self):
+        with self.assertRaises(ValueError):
+            sidecar.sync(self.conn, 'nowhere')
+
+    def test_xattr_mode(self):
+        if not xattrs_work():
+            raise unittest.SkipTest("No extended attributes here.")
+        self.assertEqual(2, sidecar.sync(self.conn, 'auto'))
+        self.assertEqual([['', 'foo'], ['year', '2018']], json.loads(
+            os.getxattr(os.path.join('a', 'y'), sidecar.XATTR)))
+        self.assertEqual({}, sidecar.read_sidecar('a'))
+        api.remove_tag(self.conn, '', 'x', 'foo')
+        self.conn.commit()
+        sidecar.sync(self.conn, 'xattr')
+        with self.assertRaises(OSError):
+            os.getxattr('x', sidecar.XATTR)
+
+    def test_auto_without_xattrs(self):
+        """ Where xattrs can't be set or removed, auto keeps to sidecars,
+        taking tags off them too. """
+        unsupported = OSError(errno.ENOTSUP, "Operation not supported")
+        with mock.patch.object(os, 'setxattr', side_effect=unsupported, create=True), \
+                mock.patch.object(os, 'removexattr', side_effect=unsupported, create=True):
+            self.assertEqual(2, sidecar.sync(self.conn, 'auto'))
+            self.assertEqual({'x': [['', 'foo']]}, sidecar.read_sidecar(''))
+            # Its row stays, so it's written out with no tags.
+            api.remove_tag(self.conn, '', 'x', 'foo', clean=False)
+            self.conn.commit()
+            self.assertEqual(1, sidecar.sync(self.conn, 'auto'))
+        self.assertFalse(os.path.exists(sidecar.SIDECAR_NAME))
+        self.assertIn('y', sidecar.read_sidecar('a'))
@@ -0,0 +1,63 @@
+""" test_stats.py:
+Testcases for umptag.stats and the triggers behind it. """
+from datetime import datetime
+from . import DBTester
+from .. import filetags, stats, tags
+
+
+class StatsTester(DBTester):
+    def setUp(self):
+        super().setUp()
+        self.now = datetime.now()
+        self.tag_files([('f%d' % i, '', 'common') for i in range(6)]
+                       + [('f%d' % i, '', 'rare') for i in range(3)]
+                       + [('f%d' % i, 'year', str(2017 + i % 2)) for i in range(4)])
+
+    def tag_files(self, triples):
+        filetags.tag_files_bulk(self.conn, [('', n, 0, self.now, False, k, v)
+                                            for (n, k, v) in triples])
+
+    def check_counts(self):
+        """ The maintained counts have to match a recount. """
+        self.assertEqual(
+            self.conn.execute("""SELECT tag_id, COUNT(*) FROM filetag_junction
+                GROUP BY tag_id ORDER BY tag_id""").fetchall(),
+            self.conn.execute("""SELECT tag_id, file_count FROM tag_stats
+                WHERE file_count > 0 ORDER BY tag_id""").fetchall())
+
+    def test_counts(self):
+        self.assertEqual(6, stats.tag_count(self.conn, '', 'common'))
+        self.assertEqual(3, stats.tag_count(self.conn, '', 'rare'))
+        self.assertEqual(0, stats.tag_count(self.conn, '', 'missing'))
+        self.assertEqual(4, stats.key_count(self.conn, 'year'))
+        self.assertEqual(('', 'common', 6), stats.top_tags(self.conn, 1)[0])
+        self.check_counts()
+
+    def test_counts_follow_changes(self):
+        filetags.untag_file(self.conn, '', 'f0', '', 'common')
+        self.check_counts()
+        filetags.untag_files_bulk(self.conn, [('', 'f1', '', 'rare')])
+        filetags.merge_tags(self.conn, ('', 'common'), [('', 'rare')])
+        self.check_counts()
+        self.assertEqual(6, stats.tag_count(self.conn, '', 'common'))
+        filetags.sweep_orphans(self.conn)
+        tags.get_or_add_tag(self.conn, '', 'lonely')
+        self.assertEqual(0, stats.tag_count(self.conn, '', 'lonely'))
+        tags.delete_tag(self.conn, '', 'lonely')
+        self.assertIsNone(self.conn.execute("""SELECT 1 FROM tag_stats
+            WHERE tag_id NOT IN (SELECT id FROM tags)""").fetchone())
+        stats.rebuild(self.conn)
+        self.check_counts()
+
+    def test_cooccurrence(self):
+        self.assertEqual([], stats.top_pairs(self.conn))
+        stats.refresh_cooccurrence(self.conn, top_n=2)
+        # Only the two most used tags are paired up.
+        self.assertEqual([('', 'common', '', 'rare', 3)],
+                         stats.top_pairs(self.conn))
+        stats.refresh_cooccurrence(self.conn)
+        self.assertEqual([('', 'rare', 3), ('year', '2017', 2), ('year', '2018', 2)],
+                         stats.cooccurring(self.conn, '', 'common'))
+        tags.delete_tag(self.conn, '', 'rare')
+        self.assertEqual([('year', '2017', 2), ('year', '2018', 2)],
+                         stats.cooccurring(self.conn, '', 'common'))
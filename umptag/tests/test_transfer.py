@@ -0,0 +1,88 @@
+""" test_transfer.py:
+Testcases for umptag.transfer. """
+import io
+import sqlite3
+from datetime import datetime
+from . import DBTester
+from .. import database, filetags, fs, transfer
+
+
+class TransferTester(DBTester):
+    def setUp(self):
+        super().setUp()
+        now = datetime(2018, 1, 2, 3, 4, 5, 678)
+        filetags.tag_files_bulk(self.conn, [
+            ('', 'a', 10, now, False, '', 'foo'),
+            ('', 'a', 10, now, False, 'year', '2018'),
+            ('d/e', 'bé', None, None, None, '', 'foo'),
+            ('d', 'e', 0, now, True, 'kind', 'dir')])
+        fs.add_files(self.conn, [('', 'untagged', 1, now, False)])
+        self.conn.execute("UPDATE files SET hash = 'h' WHERE name = 'a'")
+        self.conn.commit()
+
+    def contents(self, conn):
+        return (conn.execute("""SELECT directory, name, size, mod_time, is_dir, hash
+                    FROM files ORDER BY 1, 2""").fetchall(),
+                conn.execute("""SELECT directory, name, key, value
+                    FROM filetag_junction J
+                    INNER JOIN files ON files.id = J.file_id
+                    INNER JOIN tags ON tags.id = J.tag_id ORDER BY 1, 2, 3, 4""").fetchall())
+
+    def new_conn(self):
+        conn = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES)
+        database._initialize_tables(conn.cursor())
+        return conn
+
+    def test_roundtrip(self):
+        for binary in (False, True):
+            with self.subTest(binary=binary):
+                out = io.BytesIO()
+                self.assertEqual((3, 4), transfer.dump(self.conn, out, binary))
+                other = self.new_conn()
+                self.assertEqual((4, 4), transfer.load(other, io.BytesIO(out.getvalue()),
+                                                       chunk_size=2))
+                self.assertEqual(self.contents(self.conn), self.contents(other))
+                self.assertEqual((4, 0), transfer.load(other, io.BytesIO(out.getvalue())))
+                self.assertEqual(self.contents(self.conn), self.contents(other))
+
+    def test_merge(self):
+        """ Existing rows win; relations are added alongside them. """
+        other = self.new_conn()
+        filetags.tag_files_bulk(other, [('', 'a', 99, None, False, '', 'mine')])
+        out = io.BytesIO()
+        transfer.dump(self.conn, out)
+        self.assertEqual((4, 4), transfer.load(other, io.BytesIO(out.getvalue())))
+        self.assertEqual([('', 'foo'), ('', 'mine'), ('year', '2018')],
+                         sorted(filetags.tags_of_file(other, '', 'a')))
+        self.assertEqual((99, 'h'), other.execute(
+            "SELECT size, hash FROM files WHERE name = 'a'").fetchone())
+
+    def test_binary_is_smaller(self):
+        sizes = []
+        for binary in (False, True):
+            out = io.BytesIO()
+            transfer.dump(self.conn, out, binary)
+            sizes.append(len(out.getvalue()))
+        self.assertLess(sizes[1], sizes[0])
+
+    def test_bad_input(self):
+        for data in (b'', b'{"umptag": "dump", "version": 99}\n', b'SQLite format 3\0',
+                     transfer.MAGIC + b'\0\0\0\x05T'):
+            with self.subTest(data=data):
+                with self.assertRaises(transfer.DumpError):
+                    transfer.load(self.new_conn(), io.BytesIO(data))
+
+    def test_malformed_records(self):
+        header = b'{"umptag": "dump", "version": 1}\n'
+        tag = transfer.encode_binary(('tag', 1, '', 'a'))[transfer.HEADER.size:]
+        bodies = (b'T\x80', b'T\x01\x05ab', b'T\x01\x00\x01\xff', b'F', tag + b'x')
+        for data in ([header + b'["t", 1, "", "a"\n', header + b'["f", "a"]\n',
+                      header + b'["t", "1", "", "a"]\n', header + b'{"t": 1}\n',
+                      header + b'["f", "", "a", null, null, null, null, ["1"]]\n']
+                     + [transfer.MAGIC + transfer.HEADER.pack(len(body)) + body
+                        for body in bodies]):
+            with self.subTest(data=data):
+                conn = self.new_conn()
+                with self.assertRaises(transfer.DumpError):
+                    transfer.load(conn, io.BytesIO(data))
+                conn.close()
@@ -0,0 +1,134 @@
+""" test_watch.py:
+Testcases for umptag.watch. """
+import os
+import os.path
+import threading
+import unittest
+from . import RealFS_DBTester
+from .. import api, database, filetags, watch
+
+
+class WatchTester(RealFS_DBTester):
+    def setUp(self):
+        super().setUp()
+        self.conn = database.initialize_conn(database.DEFAULT_DB_NAME, True)
+        for d in ('a', 'b'):
+            os.mkdir(d)
+        # Identical, so only the events can tell them apart.
+        for n in ('x', 'y'):
+            open(os.path.join('a', n), 'w').close()
+        api.apply_tag(self.conn, 'a', 'x', 'foo')
+        api.apply_tag(self.conn, 'a', 'y', 'bar')
+        self.conn.commit()
+        try:
+            self.watcher = watch.Watcher(self.conn, debounce=0)
+        except OSError as e:
+            self.conn.close()
+            raise unittest.SkipTest("Can't watch here: %s" % e)
+
+    def tearDown(self):
+        self.watcher.close()
+        self.conn.close()
+        super().tearDown()
+
+    def settle(self):
+        """ Takes in the events there are and flushes them. """
+        self.watcher.process(0.5)
+        while self.watcher.process(0.05):
+            pass
+        return self.watcher.flush()
+
+    def test_rename(self):
+        os.rename(os.path.join('a', 'x'), os.path.join('b', 'x2'))
+        report = self.settle()
+        self.assertEqual([(os.path.join('a', 'x'), os.path.join('b', 'x2'))],
+                         report.moved)
+        self.assertEqual([('', 'foo')], filetags.tags_of_file(self.conn, 'b', 'x2'))
+        self.assertEqual([('', 'bar')], filetags.tags_of_file(self.conn, 'a', 'y'))
+
+    def test_rename_directory(self):
+        os.rename('a', 'c')
+        self.settle()
+        self.assertEqual([('c', 'x'), ('c', 'y')], sorted(self.conn.execute(
+            "SELECT directory, name FROM files").fetchall()))
+        # Its watch went with it.
+        with open(os.path.join('c', 'x'), 'w') as f:
+            f.write('edited')
+        self.assertEqual([os.path.join('c', 'x')], self.settle().modified)
+
+    def test_new_directory(self):
+        os.mkdir('n')
+        self.settle()
+        os.rename(os.path.join('a', 'y'), os.path.join('n', 'y'))
+        self.settle()
+        with open(os.path.join('n', 'y'), 'w') as f:
+            f.write('edited')
+        report = self.settle()
+        self.assertEqual([os.path.join('n', 'y')], report.modified)
+        self.assertEqual(6, self.conn.execute(
+            "SELECT size FROM files WHERE name = 'y'").fetchone()[0])
+
+    def test_rename_over(self):
+        """ The file that was replaced goes, tags and all. """
+        os.rename(os.path.join('a', 'x'), os.path.join('a', 'y'))
+        self.settle()
+        self.assertEqual([('', 'foo')], filetags.tags_of_file(self.conn, 'a', 'y'))
+        self.assertEqual([], filetags.files_of_tag(self.conn, '', 'bar'))
+
+    def test_deleted(self):
+        os.remove(os.path.join('a', 'y'))
+        self.assertEqual([os.path.join('a', 'y')], self.settle().missing)
+
+    def test_moved_out(self):
+        os.rename('a', os.path.join(os.pardir, '.ump_outside'))
+        try:
+            report = self.settle()
+        finally:
+            os.rename(os.path.join(os.pardir, '.ump_outside'), 'elsewhere')
+        self.assertEqual([os.path.join('a', 'x'), os.path.join('a', 'y')],
+                         sorted(report.missing))
+        self.assertNotIn('a', self.watcher.wds)
+
+    def test_ignores_database(self):
+        api.apply_tag(self.conn, 'a', 'x', 'baz')
+        self.conn.commit()
+        self.watcher.process(0.2)
+        self.assertFalse(self.watcher.pending)
+
+    def test_run(self):
+        stop = threading.Event()
+        reports = []
+
+        def on_flush(report):
+            reports.append(report)
+            stop.set()
+
+        os.rename(os.path.join('a', 'x'), os.path.join('a', 'z'))
+        timeout = threading.Timer(10, stop.set)
+        timeout.start()
+        try:
+            self.watcher.run(stop, on_flush)
+        finally:
+            timeout.cancel()
+        self.assertEqual([(os.path.join('a', 'x'), os.path.join('a', 'z'))],
+                         reports[0].moved)
+
+
+class PollTester(RealFS_DBTester):
+    def test_poll(self):
+        conn = database.initialize_conn(database.DEFAULT_DB_NAME, True)
+        with open('x', 'w') as f:
+            f.write('x')
+        api.apply_tag(conn, '', 'x', 'foo')
+        conn.commit()
+        os.rename('x', 'z')
+        stop = threading.Event()
+        reports = []
+
+        def on_flush(report):
+            reports.append(report)
+            stop.set()
+
+        watch.poll(conn, interval=0, stop=stop, on_flush=on_flush)
+        conn.close()
+        self.assertEqual([('x', 'z')], reports[0].moved)
@@ -0,0 +1,312 @@
+""" transfer.py
+Streams a database's files and tags out to a compact dump and back in,
+for moving tag sets between machines or merging them. Neither side holds
+more than a batch in memory, apart from the importer's map of tag ids.
+
+A dump is a stream of records, the tags before the files that use them:
+
+    ('tag', id, key, value)
+    ('file', directory, name, size, mod_time, is_dir, hash, [tag id, ...])
+
+Ids are the exporting database's own and only tie a dump together;
+mod_time is the stored text. There are two encodings:
+
+- NDJSON: a header line {"umptag": "dump", "version": 1}, then a JSON
+  array per line, ["t", ...] or ["f", ...].
+- Binary: MAGIC, then each record as a 4-byte big-endian length and a
+  body: b'T' or b'F', then the fields. Integers are unsigned LEB128
+  varints and strings a varint length followed by UTF-8. File records
+  start with a byte of FLAGS saying which of the nullable fields follow.
+
+`load` stages each chunk of files in temporary tables the way
+`filetags.tag_files_bulk` does, but joins the tags by id, since the dump
+already numbers them. Files, tags and relations that already exist are
+left as they are. """
+import itertools
+import json
+import struct
+
+from . import api, filetags, fs, tags
+
+
+VERSION = 1
+MAGIC = b'UMPTAG\x00\x01'
+HEADER = struct.Struct('>I')
+# Which of a file record's nullable fields are present, and is_dir's value.
+HAS_SIZE, HAS_MOD_TIME, HAS_IS_DIR, IS_DIR, HAS_HASH = 1, 2, 4, 8, 16
+
+
+class DumpError(ValueError):
+    """ The stream isn't a dump this version can read. """
+
+
+def _records(c, batch_size):
+    yield from (('tag', id_, key, value) for (id_, key, value) in
+                filetags._stream(c.execute(
+                    "SELECT id, key, value FROM tags ORDER BY id"), batch_size))
+    # The casts keep the stored values, whatever converters the connection has.
+    cursor = c.execute("""SELECT directory, name, size,
+            CAST(mod_time AS text), CAST(is_dir AS integer), hash,
+            (SELECT group_concat(tag_id) FROM filetag_junction
+             WHERE file_id = files.id)
+            FROM files ORDER BY id""")
+    for (*row, tag_ids) in filetags._stream(cursor, batch_size):
+        yield ('file', *row, [int(i) for i in tag_ids.split(',')] if tag_ids else [])
+
+
+# Binary encoding.
+def _put_uint(buf, n):
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def _put_str(buf, s):
+    data = s.encode('utf-8', 'surrogatepass')
+    _put_uint(buf, len(data))
+    buf += data
+
+
+def _get_uint(data, pos):
+    n = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _get_str(data, pos):
+    size, pos = _get_uint(data, pos)
+    if pos + size > len(data):
+        raise IndexError("string runs past the end of the record")
+    return data[pos:pos + size].decode('utf-8', 'surrogatepass'), pos + size
+
+
+def encode_binary(record):
+    buf = bytearray()
+    if record[0] == 'tag':
+        (_, id_, key, value) = record
+        buf += b'T'
+        _put_uint(buf, id_)
+        _put_str(buf, key)
+        _put_str(buf, value)
+    else:
+        (_, directory, name, size, mod_time, is_dir, hash_, tag_ids) = record
+        flags = ((size is not None and HAS_SIZE)
+                 | (mod_time is not None and HAS_MOD_TIME)
+                 | (is_dir is not None and HAS_IS_DIR)
+                 | (bool(is_dir) and IS_DIR)
+                 | (hash_ is not None and HAS_HASH))
+        buf += b'F'
+        buf.append(flags)
+        _put_str(buf, directory)
+        _put_str(buf, name)
+        if size is not None:
+            _put_uint(buf, size)
+        if mod_time is not None:
+            _put_str(buf, mod_time)
+        if hash_ is not None:
+            _put_str(buf, hash_)
+        _put_uint(buf, len(tag_ids))
+        for tag_id in tag_ids:
+            _put_uint(buf, tag_id)
+    return HEADER.pack(len(buf)) + buf
+
+
+def decode_binary(body):
+    try:
+        record, pos = _decode_binary(body)
+    except (IndexError, UnicodeDecodeError):
+        raise DumpError("A record is truncated or corrupt.") from None
+    if pos != len(body):
+        raise DumpError("A record has %d bytes left over." % (len(body) - pos))
+    return record
+
+
+def _decode_binary(body):
+    """ Returns (record, where it ended). """
+    kind = body[:1]
+    if kind == b'T':
+        id_, pos = _get_uint(body, 1)
+        key, pos = _get_str(body, pos)
+        value, pos = _get_str(body, pos)
+        return ('tag', id_, key, value), pos
+    if kind != b'F':
+        raise DumpError("Unknown record type %r." % kind)
+    flags = body[1]
+    directory, pos = _get_str(body, 2)
+    name, pos = _get_str(body, pos)
+    size = mod_time = is_dir = hash_ = None
+    if flags & HAS_SIZE:
+        size, pos = _get_uint(body, pos)
+    if flags & HAS_MOD_TIME:
+        mod_time, pos = _get_str(body, pos)
+    if flags & HAS_IS_DIR:
+        is_dir = int(bool(flags & IS_DIR))
+    if flags & HAS_HASH:
+        hash_, pos = _get_str(body, pos)
+    count, pos = _get_uint(body, pos)
+    tag_ids = []
+    for _ in range(count):
+        tag_id, pos = _get_uint(body, pos)
+        tag_ids.append(tag_id)
+    return ('file', directory, name, size, mod_time, is_dir, hash_, tag_ids), pos
+
+
+def _read_binary(stream):
+    while True:
+        header = stream.read(HEADER.size)
+        if not header:
+            return
+        if len(header) < HEADER.size:
+            raise DumpError("Dump ends mid-record.")
+        (size,) = HEADER.unpack(header)
+        body = stream.read(size)
+        if len(body) < size:
+            raise DumpError("Dump ends mid-record.")
+        yield decode_binary(body)
+
+
+# NDJSON encoding.
+def encode_json(record):
+    return (json.dumps([record[0][0], *record[1:]], separators=(',', ':'))
+            .encode('utf-8') + b'\n')
+
+
+# The JSON types of each kind of record's fields, after the first.
+_FIELDS = {
+    'tag': (int, str, str),
+    'file': (str, str, (int, type(None)), (str, type(None)),
+             (int, type(None)), (str, type(None)), list),
+}
+
+
+def _checked(record):
+    """ Returns the record if its fields are as `dump` writes them. """
+    (kind, *fields) = record
+    types = _FIELDS[kind]
+    if (len(fields) != len(types)
+            or not all(isinstance(f, t) for (f, t) in zip(fields, types))
+            or kind == 'file' and not all(isinstance(i, int) for i in fields[-1])):
+        raise DumpError("Malformed %s record: %s" % (kind, json.dumps(fields)[:200]))
+    return record
+
+
+def _read_json(lines):
+    try:
+        header = json.loads(next(lines, b'{}'))
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get('umptag') != 'dump':
+        raise DumpError("Not an umptag dump.")
+    if header.get('version') != VERSION:
+        raise DumpError("Can't read version %r dumps." % header.get('version'))
+    for (number, line) in enumerate(lines, 2):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            raise DumpError("Line %d isn't JSON." % number) from None
+        if not isinstance(row, list) or not row:
+            raise DumpError("Line %d isn't a record." % number)
+        kind, *fields = row
+        if kind == 't':
+            yield _checked(('tag', *fields))
+        elif kind == 'f':
+            yield _checked(('file', *fields))
+        else:
+            raise DumpError("Unknown record type %r." % kind)
+
+
+def read_records(stream):
+    """ Yields the records from a binary stream in either encoding.
+    Raises DumpError at the first one that isn't well formed. """
+    start = stream.read(len(MAGIC))
+    if start == MAGIC:
+        return _read_binary(stream)
+    first = start if b'\n' in start else start + stream.readline()
+    return _read_json(itertools.chain([first], stream))
+
+
+def dump(c, out, binary=False, batch_size=1000):
+    """ Writes every tag and file to the binary stream `out`.
+    Returns (tags, files) written. """
+    counts = {'tag': 0, 'file': 0}
+    if binary:
+        out.write(MAGIC)
+        encode = encode_binary
+    else:
+        out.write(json.dumps({'umptag': 'dump', 'version': VERSION})
+                  .encode('utf-8') + b'\n')
+        encode = encode_json
+    for record in _records(c, batch_size):
+        out.write(encode(record))
+        counts[record[0]] += 1
+    return counts['tag'], counts['file']
+
+
+def _load_chunk(c, files, tag_ids):
+    """ Stages a chunk of file records, one row per file plus (file, tag id)
+    pairs, and inserts what's new with one statement per table. """
+    c.execute("""CREATE TEMP TABLE IF NOT EXISTS staged_dump_files (
+            seq integer PRIMARY KEY, directory text, name text, size integer,
+            mod_time timestamp, is_dir boolean)""")
+    c.execute("""CREATE TEMP TABLE IF NOT EXISTS staged_dump_tags (
+            seq integer, tag_id integer)""")
+    c.execute("DELETE FROM staged_dump_files")
+    c.execute("DELETE FROM staged_dump_tags")
+    c.executemany("""INSERT INTO staged_dump_files
+            (seq, directory, name, size, mod_time, is_dir) VALUES (?,?,?,?,?,?)""",
+            ((seq, *record[1:6]) for (seq, record) in enumerate(files)))
+    try:
+        c.executemany("INSERT INTO staged_dump_tags (seq, tag_id) VALUES (?,?)",
+                      ((seq, tag_ids[i]) for (seq, record) in enumerate(files)
+                       for i in record[7]))
+    except KeyError as e:
+        raise DumpError("A file has undefined tag %s." % e.args[0]) from None
+    dir_ids = {}
+    for (directory,) in c.execute(
+            "SELECT DISTINCT directory FROM staged_dump_files").fetchall():
+        fs.get_or_add_dir_id(c, directory, dir_ids)
+    c.execute("""INSERT OR IGNORE INTO file_entries
+            (dir_id, name, size, mod_time, is_dir)
+            SELECT directories.id, S.name, S.size, S.mod_time, S.is_dir
+            FROM staged_dump_files S
+            INNER JOIN directories ON directories.path = S.directory""")
+    c.executemany("""UPDATE file_entries SET hash = ? WHERE hash IS NULL AND id =
+            (SELECT id FROM files WHERE directory = ? AND name = ?)""",
+            [(record[6], record[1], record[2]) for record in files
+             if record[6] is not None])
+    return c.execute("""INSERT OR IGNORE INTO filetag_junction (file_id, tag_id)
+            SELECT files.id, T.tag_id FROM staged_dump_tags T
+            INNER JOIN staged_dump_files S ON S.seq = T.seq
+            INNER JOIN files ON files.directory = S.directory
+                AND files.name = S.name""").rowcount
+
+
+def load(c, stream, chunk_size=10000):
+    """ Merges a dump from the binary stream `stream` into the database, in
+    a single transaction. Rows already there win over the dump's, except
+    that a missing hash is filled in.
+    Returns (files read, new file-tag relations). """
+    tag_ids = {}  # The dump's tag ids -> ours.
+    files, file_count, added = [], 0, 0
+    with api.write_transaction(c):
+        for record in read_records(stream):
+            if record[0] == 'tag':
+                tag_ids[record[1]] = tags.get_or_add_tag_id(c, record[2], record[3])
+                continue
+            files.append(record)
+            if len(files) >= chunk_size:
+                added += _load_chunk(c, files, tag_ids)
+                file_count += len(files)
+                files = []
+        if files:
+            added += _load_chunk(c, files, tag_ids)
+            file_count += len(files)
+    return file_count, added
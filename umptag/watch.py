@@ -0,0 +1,271 @@
+""" watch.py
+Keeps the files table current while it runs, so that tags follow files
+as they're moved and rows pick up edits as they happen, rather than at
+the next `umptag repair`.
+
+On Linux this listens to inotify, through ctypes. Only directories are
+watched, one watch apiece however many files they hold, and an event
+just marks its directory as changed. Once things have been quiet for
+`debounce` seconds (or `max_delay` has gone by regardless), the renames
+whose two halves both arrived are applied as they are, with no guessing
+from sizes and times, and then each changed directory is listed and
+reconciled on its own with `repair.repair_directories`. If the kernel's
+queue overflows, everything gets a full repair.
+
+Where there's no inotify, or not enough watches for the tree, `poll`
+runs a repair every so often instead. Paths are relative to the current
+directory, as when tagging. """
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from . import database, repair
+
+
+# From <sys/inotify.h>.
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+# What a directory's watch listens for. Writes are only seen once the file
+# is closed, so something writing steadily doesn't keep the batch open.
+DIR_EVENTS = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_ONLYDIR)
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+Event = namedtuple('Event', ['wd', 'mask', 'cookie', 'name'])
+
+
+class Inotify:
+    """ An inotify instance. Raises OSError if there isn't one to be had. """
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise OSError(errno.ENOSYS, "inotify isn't available here") from None
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = init(os.O_NONBLOCK | getattr(os, 'O_CLOEXEC', 0))
+        if self.fd < 0:
+            self._raise()
+
+    @staticmethod
+    def _raise(path=None):
+        err = ctypes.get_errno()
+        if err == errno.ENOSPC:
+            raise OSError(err, "Out of inotify watches; raise "
+                          "fs.inotify.max_user_watches, or poll instead", path)
+        raise OSError(err, os.strerror(err), path)
+
+    def add_watch(self, path, mask=DIR_EVENTS):
+        """ Returns the watch descriptor, which is the same for every path
+        to the same directory. """
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            self._raise(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)  # Only fails if it's already gone.
+
+    def read(self, timeout=None):
+        """ Returns the events waiting, after up to `timeout` seconds for
+        the first of them. """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, pos = [], 0
+        while pos < len(data):
+            (wd, mask, cookie, size) = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = os.fsdecode(data[pos:pos + size].rstrip(b'\0'))
+            pos += size
+            events.append(Event(wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    """ Watches root_dir and every directory below it. `run` does the
+    rest; `process` and `flush` are its steps, for driving it by hand.
+    ignore :: names whose events are dropped; by default the database's
+              own files, or each commit would set off another batch. """
+    def __init__(self, c, root_dir=os.curdir, debounce=0.5, max_delay=5.0,
+                 ignore=(database.DEFAULT_DB_NAME,)):
+        root = os.path.normpath(root_dir)
+        self.root = '' if root == os.curdir else root
+        self.c = c
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.ignore = tuple(ignore)
+        self.inotify = Inotify()
+        self.paths = {}  # wd -> directory
+        self.wds = {}  # directory -> wd
+        self.dirty = set()  # Directories to reconcile.
+        self.moves = []  # (old, new) paths, in the order they happened.
+        self.moved_from = {}  # cookie -> (path, is_dir), awaiting the other half.
+        self.overflowed = False
+        try:
+            self._watch_tree(self.root)
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        self.inotify.close()
+
+    @property
+    def pending(self):
+        return bool(self.dirty or self.moves or self.moved_from or self.overflowed)
+
+    def _watch(self, directory):
+        try:
+            wd = self.inotify.add_watch(directory or os.curdir)
+        except (FileNotFoundError, NotADirectoryError):
+            return  # Gone again already; its parent's events will say so.
+        self.wds.pop(self.paths.get(wd), None)
+        self.paths[wd] = directory
+        self.wds[directory] = wd
+
+    def _watch_tree(self, top):
+        """ Watches top and every directory below it. Returns them all. """
+        self._watch(top)
+        found = [top]
+        for (dirpath, dirnames, _) in os.walk(top or os.curdir):
+            for name in dirnames:
+                path = os.path.normpath(os.path.join(dirpath, name))
+                self._watch(path)
+                found.append(path)
+        return found
+
+    def _unwatch_tree(self, top):
+        """ Stops watching top and what's below it. Returns them all. """
+        gone = [d for d in self.wds if repair._under(d, top)]
+        for directory in gone:
+            wd = self.wds.pop(directory)
+            self.paths.pop(wd, None)
+            self.inotify.rm_watch(wd)
+        return gone
+
+    def _rename_tree(self, old, new):
+        """ The watches follow a renamed directory; this follows them. """
+        def renamed(path):
+            return new + path[len(old):] if repair._under(path, old) else path
+        self.paths = {wd: renamed(d) for (wd, d) in self.paths.items()}
+        self.wds = {d: wd for (wd, d) in self.paths.items()}
+        self.dirty = set(map(renamed, self.dirty))
+
+    def _handle(self, event):
+        if event.mask & IN_Q_OVERFLOW:
+            self.overflowed = True
+            return
+        directory = self.paths.get(event.wd)
+        if event.mask & IN_IGNORED:  # The watch was removed.
+            if directory is not None and self.wds.get(directory) == event.wd:
+                del self.wds[directory]
+            self.paths.pop(event.wd, None)
+            return
+        if directory is None or not event.name or event.name.startswith(self.ignore):
+            return
+        path = os.path.join(directory, event.name)
+        is_dir = bool(event.mask & IN_ISDIR)
+        if event.mask & IN_MOVED_FROM:
+            self.moved_from[event.cookie] = (path, is_dir)
+            return
+        if event.mask & IN_MOVED_TO and event.cookie in self.moved_from:
+            (old, _) = self.moved_from.pop(event.cookie)
+            self.moves.append((old, path))
+            if is_dir:
+                self._rename_tree(old, path)
+            return
+        self.dirty.add(directory)
+        if is_dir and event.mask & (IN_CREATE | IN_MOVED_TO):
+            self.dirty.update(self._watch_tree(path))
+        elif is_dir and event.mask & IN_DELETE:
+            self.dirty.add(path)
+
+    def process(self, timeout=None):
+        """ Reads and notes the events that arrive within `timeout` seconds.
+        Returns how many there were. """
+        events = self.inotify.read(timeout)
+        for event in events:
+            self._handle(event)
+        return len(events)
+
+    def flush(self):
+        """ Applies everything noted since the last flush. Returns a Report. """
+        # Renames that were never finished went somewhere we can't see.
+        for (path, is_dir) in self.moved_from.values():
+            self.dirty.add(os.path.dirname(path))
+            if is_dir:
+                self.dirty.update(self._unwatch_tree(path))
+        self.moved_from.clear()
+        moved = repair.apply_moves(self.c, self.moves).moved
+        self.moves = []
+        if self.overflowed:
+            self.overflowed = False
+            self._watch_tree(self.root)  # For directories made meanwhile.
+            report = repair.repair(self.c, self.root, full=True)
+        else:
+            report = repair.repair_directories(self.c, self.dirty)
+        self.dirty = set()
+        return report._replace(moved=moved + report.moved)
+
+    def run(self, stop=None, on_flush=None):
+        """ Keeps going until `stop`, a threading.Event, is set. Each flush's
+        Report goes to `on_flush`. """
+        first = last = None  # When the batch started, and its latest event.
+        while stop is None or not stop.is_set():
+            if self.pending:
+                timeout = max(0, min(last + self.debounce, first + self.max_delay)
+                              - time.monotonic())
+            else:
+                timeout = 1.0  # To notice `stop`.
+            if self.process(timeout):
+                last = time.monotonic()
+                if first is None and self.pending:
+                    first = last
+            if self.pending and time.monotonic() >= min(last + self.debounce,
+                                                        first + self.max_delay):
+                report = self.flush()
+                first = last = None
+                if on_flush is not None:
+                    on_flush(report)
+
+
+def poll(c, root_dir=os.curdir, interval=5.0, full_every=12, stop=None,
+         on_flush=None):
+    """ Repairs root_dir every `interval` seconds until `stop` is set, for
+    where `Watcher` can't go. Those repairs only notice directories that
+    have changed, so every `full_every`th is a full one, to catch files
+    edited in place. Reports with anything in them go to `on_flush`. """
+    stop = stop or threading.Event()
+    rounds = 0
+    while not stop.is_set():
+        report = repair.repair(c, root_dir, rounds > 0 and rounds % full_every == 0)
+        rounds += 1
+        if on_flush is not None and any(report):
+            on_flush(report)
+        stop.wait(interval)